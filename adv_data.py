@@ -0,0 +1,210 @@
+"""
+Advertising data helpers shared by the scanner and the cloud side decoder.
+"""
+
+import uuid
+
+#Reference Bluetooth Specification Assigned Numbers Doc, Common Data Types Section
+BT_COMMON_DATA_TYPES_LOOKUP = {
+    0x01: 'FLAGS',
+    0x02: 'INCOMPLETE_LIST_OF_16-BIT_SERVICE_CLASS_UUIDS',
+    0x03: 'COMPLETE_LIST_OF_16-BIT_SERVICE_CLASS_UUIDS',
+    0x04: 'INCOMPLETE_LIST_OF_32-BIT_SERVICE_CLASS_UUIDS',
+    0x05: 'COMPLETE_LIST_OF_32-BIT_SERVICE_CLASS_UUIDS',
+    0x06: 'INCOMPLETE_LIST_OF_128-BIT_SERVICE_CLASS_UUIDS',
+    0x07: 'COMPLETE_LIST_OF_128-BIT_SERVICE_CLASS_UUIDS',
+    0x08: 'SHORTENED_LOCAL_NAME',
+    0x09: 'COMPLETE_LOCAL_NAME',
+    0x0A: 'TX_POWER_LEVEL',
+    0x0D: 'CLASS_OF_DEVICE',
+    0x0E: 'SIMPLE_PAIRING_HASH_C-192',
+    0x0F: 'SIMPLE_PAIRING_RANDOMIZER_R-192',
+    0x10: 'DEVICE_ID', #Also listed as Security Manager TK Value
+    0x11: 'SECURITY_MANAGER_OUT_OF_BAND_FLAGS',
+    0x12: 'SLAVE_CONNECTION_INTERVAL_RANGE',
+    0x14: 'LIST_OF_16-BIT_SERVICE_SOLICITATION_UUIDS',
+    0x15: 'LIST_OF_128-BIT_SERVICE_SOLICITATION_UUIDS',
+    0x16: 'SERVICE_DATA_16-BIT_UUID',
+    0x17: 'PUBLIC_TARGET_ADDRESS',
+    0x18: 'RANDOM_TARGET_ADDRESS',
+    0x19: 'APPEARANCE',
+    0x1A: 'ADVERTISING_INTERVAL',
+    0x1B: 'LE_BLUETOOTH_DEVICE_ADDRESS',
+    0x1C: 'LE_ROLE',
+    0x1D: 'SIMPLE_PAIRING_HASH_C-256',
+    0x1E: 'SIMPLE_PAIRING_RANDOMIZER_R-256',
+    0x1F: 'LIST_OF_32-BIT_SERVICE_SOLICITATION_UUIDS',
+    0x20: 'SERVICE_DATA_32-BIT_UUID',
+    0x21: 'SERVICE_DATA_128-BIT_UUID',
+    0x22: 'LE_SECURE_CONNECTIONS_CONFIRMATION_VALUE',
+    0x23: 'LE_SECURE_CONNECTIONS_RANDOM_VALUE',
+    0x24: 'URI',
+    0x25: 'INDOOR_POSITIONING',
+    0x26: 'TRANSPORT_DISCOVERY_DATA',
+    0x27: 'LE_SUPPORTED_FEATURES',
+    0x28: 'CHANNEL_MAP_UPDATE_INDICATION',
+    0x29: 'PB-ADV',
+    0x2A: 'MESH_MESSAGE',
+    0x2B: 'MESH_BEACON',
+    0x2C: 'BIGINFO',
+    0x2D: 'BROADCAST_CODE',
+    0x2E: 'RESOLVABLE_SET_IDENTIFIER',
+    0x2F: 'ADVERTISING_INTERVAL_LONG',
+    0x30: 'BROADCAST_NAME',
+    0x3D: '3D_INFORMATION',
+    0xFF: 'MANUFACTURER_SPECIFIC_DATA'
+}
+
+BT_COMMON_DATA_TYPES_STR = [0x08, 0x09]
+
+# AD types of the typed accessors of AdvData
+AD_TYPE_UUID16_INCOMPLETE = 0x02
+AD_TYPE_UUID16_COMPLETE = 0x03
+AD_TYPE_UUID128_INCOMPLETE = 0x06
+AD_TYPE_UUID128_COMPLETE = 0x07
+AD_TYPE_SHORTENED_LOCAL_NAME = 0x08
+AD_TYPE_COMPLETE_LOCAL_NAME = 0x09
+AD_TYPE_SERVICE_DATA_16 = 0x16
+AD_TYPE_SERVICE_DATA_128 = 0x21
+AD_TYPE_MANUFACTURER_SPECIFIC_DATA = 0xFF
+
+class AdvData:
+    """ Lazy view of the AD structures of an advertising data buffer.
+
+    The constructor only records the type and the offsets of each AD
+    structure. Values are returned as memoryview slices of the original
+    buffer and decoded on access. Malformed data never raises: indexing
+    stops at the first AD structure that runs past the end of the buffer
+    and the malformed attribute is set.
+    """
+    __slots__ = ('_view', '_fields', 'malformed')
+
+    def __init__(self, adv_data):
+        self._view = memoryview(adv_data)
+        # List of (AD type, data start offset, data end offset)
+        self._fields = []
+        self.malformed = False
+        size = len(self._view)
+        i = 0
+        while i < size:
+            ad_field_length = self._view[i]
+            if ad_field_length == 0:
+                # Zero length marks the end of significant data
+                break
+            end = i + 1 + ad_field_length
+            if end > size:
+                self.malformed = True
+                break
+            self._fields.append((self._view[i + 1], i + 2, end))
+            i = end
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __iter__(self):
+        """ Iterate over (AD type, data memoryview) pairs. """
+        view = self._view
+        for ad_type, start, end in self._fields:
+            yield ad_type, view[start:end]
+
+    def types(self):
+        """ Return the AD types in order of appearance. """
+        return [field[0] for field in self._fields]
+
+    def get(self, ad_type):
+        """ Return the data of the first AD structure of the given type or None. """
+        for field_type, start, end in self._fields:
+            if field_type == ad_type:
+                return self._view[start:end]
+        return None
+
+    def get_all(self, *ad_types):
+        """ Return the data of all AD structures matching any of the given types. """
+        return [self._view[start:end] for field_type, start, end in self._fields if field_type in ad_types]
+
+    @staticmethod
+    def name(ad_type):
+        """ Return the name of an AD type, or the type itself if unknown. """
+        return BT_COMMON_DATA_TYPES_LOOKUP.get(ad_type, ad_type)
+
+    @property
+    def local_name(self):
+        """ Complete local name, or the shortened one if only that is present. """
+        data = self.get(AD_TYPE_COMPLETE_LOCAL_NAME)
+        if data is None:
+            data = self.get(AD_TYPE_SHORTENED_LOCAL_NAME)
+            if data is None:
+                return None
+        return str(data, 'utf-8', 'replace')
+
+    @property
+    def uuid16_list(self):
+        """ 16-bit service class UUIDs as integers. """
+        uuids = []
+        for data in self.get_all(AD_TYPE_UUID16_INCOMPLETE, AD_TYPE_UUID16_COMPLETE):
+            uuids.extend(int.from_bytes(data[j:j + 2], 'little') for j in range(0, len(data) - 1, 2))
+        return uuids
+
+    @property
+    def uuid128_list(self):
+        """ 128-bit service class UUIDs as uuid.UUID instances. """
+        uuids = []
+        for data in self.get_all(AD_TYPE_UUID128_INCOMPLETE, AD_TYPE_UUID128_COMPLETE):
+            uuids.extend(uuid.UUID(bytes=bytes(data[j:j + 16])[::-1]) for j in range(0, len(data) - 15, 16))
+        return uuids
+
+    @property
+    def service_data(self):
+        """ Service data keyed on the 16-bit UUID as integer or the 128-bit UUID as uuid.UUID. """
+        service_data = {}
+        for data in self.get_all(AD_TYPE_SERVICE_DATA_16):
+            if len(data) >= 2:
+                service_data[int.from_bytes(data[:2], 'little')] = data[2:]
+        for data in self.get_all(AD_TYPE_SERVICE_DATA_128):
+            if len(data) >= 16:
+                service_data[uuid.UUID(bytes=bytes(data[:16])[::-1])] = data[16:]
+        return service_data
+
+    @property
+    def manufacturer_data(self):
+        """ Tuple of (company ID, data memoryview) or None. """
+        data = self.get(AD_TYPE_MANUFACTURER_SPECIFIC_DATA)
+        if data is None or len(data) < 2:
+            return None
+        return int.from_bytes(data[:2], 'little'), data[2:]
+
+    @property
+    def company_id(self):
+        """ Bluetooth SIG company identifier of the manufacturer specific data or None. """
+        manufacturer_data = self.manufacturer_data
+        return manufacturer_data[0] if manufacturer_data is not None else None
+
+    def has_service(self, uuid_bytes):
+        """ Check for a 16 or 128-bit service UUID given in advertising (little endian) byte order. """
+        if len(uuid_bytes) == 2:
+            ad_types = (AD_TYPE_UUID16_INCOMPLETE, AD_TYPE_UUID16_COMPLETE)
+        elif len(uuid_bytes) == 16:
+            ad_types = (AD_TYPE_UUID128_INCOMPLETE, AD_TYPE_UUID128_COMPLETE)
+        else:
+            raise ValueError("Invalid UUID length.")
+        step = len(uuid_bytes)
+        for data in self.get_all(*ad_types):
+            for j in range(0, len(data) - step + 1, step):
+                if data[j:j + step] == uuid_bytes:
+                    return True
+        return False
+
+    def to_dict(self):
+        """ Decode all AD structures to a dict of names and string values. """
+        adv_data_dict = {}
+        for ad_type, ad_data in self:
+            ad_field_name = BT_COMMON_DATA_TYPES_LOOKUP.get(ad_type, ad_type)
+            if ad_type in BT_COMMON_DATA_TYPES_STR:
+                adv_data_dict[ad_field_name] = str(ad_data, 'utf-8', 'replace')
+            else:
+                adv_data_dict[ad_field_name] = '0x' + ad_data.hex().upper()
+        return adv_data_dict
+
+def parse_adv_data(adv_data):
+    """ Decode advertising data to a dict, see AdvData.to_dict. """
+    return AdvData(adv_data).to_dict()
@@ -0,0 +1,88 @@
+"""
+Per device deduplication of advertisement reports.
+"""
+
+import threading
+import time
+
+class AggregateStats:
+    """ Presence and signal strength summary of identical reports within one window. """
+    __slots__ = ('first_seen', 'last_seen', 'count', 'rssi_min', 'rssi_max', 'rssi_sum', 'evt')
+
+    def __init__(self, evt, timestamp):
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.count = 1
+        self.rssi_min = evt.rssi
+        self.rssi_max = evt.rssi
+        self.rssi_sum = evt.rssi
+        self.evt = evt
+
+    def update(self, evt, timestamp):
+        self.last_seen = timestamp
+        self.count += 1
+        if evt.rssi < self.rssi_min:
+            self.rssi_min = evt.rssi
+        elif evt.rssi > self.rssi_max:
+            self.rssi_max = evt.rssi
+        self.rssi_sum += evt.rssi
+        self.evt = evt
+
+    @property
+    def rssi_mean(self):
+        return self.rssi_sum / self.count
+
+class ReportAggregator:
+    """ Collapse identical advertisement reports into one record per flush window.
+
+    Reports are keyed on (address, advertising SID, advertising data). The
+    raw data is part of the key instead of a digest of it, so distinct
+    payloads never collide. On flush, encode(evt, timestamp, stats) is called
+    once per key with the latest event and the result is put to out_queue.
+    """
+    def __init__(self, out_queue, encode, window=10, max_entries=10000):
+        self.out_queue = out_queue
+        self.encode = encode
+        self.window = float(window)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._window_start = time.monotonic()
+        self.reports_in = 0
+        self.records_out = 0
+
+    def add(self, evt, timestamp):
+        """ Account a scanner report event received at timestamp. """
+        key = (evt.address, getattr(evt, 'adv_sid', None), evt.data)
+        with self._lock:
+            self.reports_in += 1
+            stats = self._entries.get(key)
+            if stats is not None:
+                stats.update(evt, timestamp)
+                return
+            overflow = len(self._entries) >= self.max_entries
+            if overflow:
+                # Bound the memory use by closing the window early
+                entries = self._swap()
+            self._entries[key] = AggregateStats(evt, timestamp)
+        if overflow:
+            self._emit(entries)
+
+    def flush(self, force=False):
+        """ Emit the aggregated records if the window has elapsed or force is set. """
+        with self._lock:
+            if not force and time.monotonic() - self._window_start < self.window:
+                return
+            entries = self._swap()
+        self._emit(entries)
+
+    def _swap(self):
+        entries = self._entries
+        self._entries = {}
+        self._window_start = time.monotonic()
+        return entries
+
+    def _emit(self, entries):
+        for stats in entries.values():
+            self.out_queue.put(self.encode(stats.evt, stats.last_seen, stats))
+        self.records_out += len(entries)
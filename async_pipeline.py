@@ -0,0 +1,245 @@
+"""
+asyncio runtime for the scan -> process -> publish pipeline.
+
+Instead of the App thread, the PeriodicTimer thread and the shared report
+queue, one event loop runs a chain of stages connected by bounded
+asyncio.Queue instances:
+
+    bridge -> reports -> process -> records -> publish
+           -> control -> dispatch
+
+The bridge is the only extra thread, it blocks on the App event queue and
+hands events over to the loop. Scanner reports are dropped when the process
+stage falls behind, all other events, e.g. system_boot, go to the unbounded
+control queue and are never lost. Publishes are awaited concurrently, capped at
+max_inflight unacknowledged QoS1 messages.
+
+The stages keep the instrumentation of the threaded runtime: events_total and
+report_parse_seconds of the Apps, the publish latency of the publisher and, if
+register_metrics is called, the depth and drops of the stage queues.
+"""
+
+import asyncio
+import collections
+import logging
+import threading
+import time
+
+from awscrt import mqtt
+
+REPORT_EVENTS = (
+    "bt_evt_scanner_legacy_advertisement_report",
+    "bt_evt_scanner_extended_advertisement_report")
+
+class StageQueue(asyncio.Queue):
+    """ Bounded asyncio queue that drops and counts items offered while full. """
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.dropped = 0
+        self.high_water = 0
+
+    def offer(self, item):
+        """ Add an item unless the queue is full, never blocks. """
+        try:
+            self.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        if self.qsize() > self.high_water:
+            self.high_water = self.qsize()
+
+class _OfferQueue:
+    """ out_queue of a ReportAggregator offering its records to a StageQueue. """
+    def __init__(self, stage_queue):
+        self.put = stage_queue.offer
+
+class AsyncPipeline:
+    """ Run one or more Apps and an aws_pipe publisher on an asyncio event loop. """
+    def __init__(self, apps, publisher, queue_size=1000, max_inflight=100, report_filter=None):
+        if publisher.spool is not None:
+            raise ValueError("The asyncio runtime does not support the spool")
+        if not isinstance(apps, (list, tuple)):
+            apps = [apps]
+        self.apps = apps
+        self.aggregators = [app.aggregator for app in apps if app.aggregator is not None]
+        self.publisher = publisher
+        self.queue_size = queue_size
+        self.max_inflight = max_inflight
+        # Optional callable(evt) returning False for reports to be discarded
+        self.report_filter = report_filter
+        self.log = logging.getLogger(type(self).__name__)
+        self._stop = threading.Event()
+        # Name to StageQueue, filled in by run()
+        self.stages = collections.OrderedDict()
+
+    def register_metrics(self, registry):
+        """ Expose the depth and the drops of the stage queues in a metrics.Registry. """
+        registry.gauge("stage_queue_size", "Items waiting in an asyncio stage queue", ("stage",),
+            callback=lambda: {(name,): queue.qsize() for name, queue in self.stages.items()})
+        registry.gauge("stage_queue_high_water", "Highest number of items waiting in an asyncio stage queue",
+            ("stage",), callback=lambda: {(name,): queue.high_water for name, queue in self.stages.items()})
+        registry.counter("stage_queue_dropped_total", "Items dropped because an asyncio stage queue was full",
+            ("stage",), callback=lambda: {(name,): queue.dropped for name, queue in self.stages.items()})
+
+    async def run(self):
+        """ Open the device and run all stages until cancelled. """
+        loop = asyncio.get_running_loop()
+        self.control = asyncio.Queue()
+        self.reports = StageQueue(self.queue_size)
+        self.records = StageQueue(self.queue_size)
+        self.stages.update(reports=self.reports, records=self.records)
+        self.inflight = asyncio.Semaphore(self.max_inflight)
+        self.pending = set()
+        for aggregator in self.aggregators:
+            aggregator.out_queue = _OfferQueue(self.records)
+
+        bridges = []
+        for app in self.apps:
+            app.lib.open()
+            app.reset()
+            bridge = threading.Thread(target=self._bridge, args=(loop, app), daemon=True)
+            bridge.start()
+            bridges.append(bridge)
+        stages = [
+            asyncio.create_task(self._dispatch()),
+            asyncio.create_task(self._process()),
+            asyncio.create_task(self._publish()),
+        ]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            self._stop.set()
+            for app in self.apps:
+                app.stop()
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            await self._drain()
+            for bridge in bridges:
+                bridge.join()
+            for app in self.apps:
+                app.commands.close()
+                app.lib.close()
+
+    def _bridge(self, loop, app):
+        """ Forward BGAPI events of an App from the library thread to the event loop. """
+        while not self._stop.is_set():
+            # Returns None when woken up by app.stop()
+            evt = app.wait_event()
+            if evt is None:
+                continue
+            if evt in REPORT_EVENTS:
+                loop.call_soon_threadsafe(self.reports.offer, (app, evt, time.time()))
+            else:
+                loop.call_soon_threadsafe(self.control.put_nowait, (app, evt))
+
+    async def _dispatch(self):
+        """ Handle the events other than scanner reports in a worker thread, one at a time. """
+        while True:
+            app, evt = await self.control.get()
+            # Handlers may issue blocking BGAPI commands
+            await asyncio.to_thread(app.dispatch, evt)
+
+    async def _process(self):
+        """ Filter, aggregate and encode reports. """
+        while True:
+            app, evt, timestamp = await self.reports.get()
+            # Reports bypass App.dispatch, count them here like it does
+            if app.event_counts is not None:
+                app.event_counts[evt._str] += 1
+            parse_time = app.parse_time
+            if parse_time is not None:
+                started = time.perf_counter()
+            if self.report_filter is not None and not self.report_filter(evt):
+                continue
+            if app.aggregator is not None:
+                app.aggregator.add(evt, timestamp)
+            else:
+                self.records.offer(app.encode_report(evt, timestamp))
+            if parse_time is not None:
+                parse_time.observe(time.perf_counter() - started)
+
+    async def _publish(self):
+        """ Collect records into batches and publish them without waiting for each PUBACK. """
+        publisher = self.publisher
+        while True:
+            deadline = time.monotonic() + publisher.flush_period
+            evt_list = []
+            while len(evt_list) < publisher.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                record = await self._get_record(remaining)
+                if record is None:
+                    break
+                evt_list.append(record)
+            for aggregator in self.aggregators:
+                aggregator.flush()
+            while not self.records.empty() and len(evt_list) < publisher.batch_size:
+                evt_list.append(self.records.get_nowait())
+            if not evt_list:
+                continue
+            elapsed = 0
+            for batch in publisher.make_batches(evt_list):
+                elapsed += await self._publish_batch(batch)
+            if publisher.encode_time is not None:
+                publisher.encode_time.observe(elapsed)
+
+    async def _get_record(self, timeout):
+        """ Return the next record, or None if none arrives within timeout seconds.
+
+        asyncio.wait_for may swallow the cancellation of the stage when a record
+        arrives at the same time, and the pipeline then never stops.
+        """
+        getter = asyncio.ensure_future(self.records.get())
+        try:
+            await asyncio.wait((getter,), timeout=timeout)
+        except asyncio.CancelledError:
+            if getter.done() and not getter.cancelled():
+                # Leave the record to _drain
+                self.records.offer(getter.result())
+            getter.cancel()
+            raise
+        if getter.done():
+            return getter.result()
+        getter.cancel()
+        return None
+
+    async def _publish_batch(self, batch):
+        """ Publish a batch once a publish slot is free, return the seconds spent on encoding and handing it over. """
+        await self.inflight.acquire()
+        started = time.perf_counter()
+        payload = self.publisher.encode_batch(batch)
+        publish_future, _ = self.publisher.mqtt_connection.publish(
+            topic=self.publisher.topic,
+            payload=payload,
+            qos=mqtt.QoS.AT_LEAST_ONCE)
+        self.publisher.track_publish(publish_future)
+        stats = self.publisher.stats
+        stats.reports += len(batch)
+        stats.messages += 1
+        stats.payload_bytes += len(payload)
+        task = asyncio.ensure_future(self._await_puback(asyncio.wrap_future(publish_future)))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return time.perf_counter() - started
+
+    async def _await_puback(self, future):
+        try:
+            await future
+        except Exception as err:
+            self.log.error("Publish failed: %s", err)
+        finally:
+            self.inflight.release()
+
+    async def _drain(self):
+        """ Publish the remaining records and wait for the outstanding PUBACKs. """
+        for aggregator in self.aggregators:
+            aggregator.flush(force=True)
+        evt_list = []
+        while not self.records.empty():
+            evt_list.append(self.records.get_nowait())
+        for batch in self.publisher.make_batches(evt_list):
+            await self._publish_batch(batch)
+        if self.pending:
+            await asyncio.wait(self.pending, timeout=self.publisher.drain_timeout)
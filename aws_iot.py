@@ -1,47 +1,190 @@
 import queue
 import json
+import gzip
 import time
 
 from awscrt import mqtt
 from awsiot import mqtt_connection_builder, iotshadow
 from periodic_timer import PeriodicTimer
+from report_codec import encode_batch_header
+from spool import Spool
 
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 import sys
 import threading
 import traceback
 from uuid import uuid4
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # AWS Values
 from aws_cert_path import *
 AWS_IOT_ENDPOINT = "al9jms4pkzeur-ats.iot.us-east-1.amazonaws.com"
 TOPIC_PREFIX = "dt/bt_scan_log_v1/"
-SHADOW_PROPERTY = "scan_period_s"
-SHADOW_VALUE_DEFAULT = "yo donkey"
+# AWS IoT Core rejects publishes with a payload larger than 128 KB
+IOT_MAX_PAYLOAD_BYTES = 128 * 1024
+COMPRESSION_TYPES = (None, "gzip", "zstd")
+# json: queue holds report dicts, binary: queue holds report_codec records
+ENCODING_TYPES = ("json", "binary")
+
+class PublishStats:
+    """ Counters describing how reports were packed into MQTT messages. """
+    def __init__(self):
+        self.reports = 0
+        self.messages = 0
+        self.payload_bytes = 0
+        self.raw_bytes = 0
+
+    @property
+    def messages_saved(self):
+        """ Number of publishes avoided compared to one message per report. """
+        return self.reports - self.messages
+
+    def __str__(self):
+        return (f"reports={self.reports} messages={self.messages} "
+                f"messages_saved={self.messages_saved} "
+                f"raw_bytes={self.raw_bytes} payload_bytes={self.payload_bytes}")
 
 class LockedData:
     def __init__(self):
         self.lock = threading.Lock()
-        self.shadow_value = None
         self.disconnect_called = False
         self.request_tokens = set()
 
+def add_publish_arguments(parser):
+    """ Add the batching and compression options of aws_pipe to an argument parser. """
+    parser.add_argument(
+        "--flush_period",
+        type=float,
+        help="Seconds between two flushes of the report queue",
+        default=1)
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        help="Maximum number of reports in one MQTT message",
+        default=500)
+    parser.add_argument(
+        "--batch_bytes",
+        type=int,
+        help="Maximum uncompressed size of one MQTT message in bytes",
+        default=IOT_MAX_PAYLOAD_BYTES)
+    parser.add_argument(
+        "--compression",
+        choices=[c for c in COMPRESSION_TYPES if c is not None],
+        help="Compress the MQTT payload",
+        default=None)
+    parser.add_argument(
+        "--encoding",
+        choices=ENCODING_TYPES,
+        help="Report encoding, binary uses the compact report_codec format",
+        default="json")
+    parser.add_argument(
+        "--spool",
+        help="SQLite file to keep payloads in until they are acknowledged",
+        default=None)
+    parser.add_argument(
+        "--spool_max_bytes",
+        type=int,
+        help="Maximum size of the spooled payloads, the oldest ones are dropped above it",
+        default=64 * 1024 * 1024)
+    parser.add_argument(
+        "--replay_rate",
+        type=float,
+        help="Maximum number of spooled messages published per second",
+        default=20)
+
+def pipe_kwargs_from_args(args):
+    """ Return aws_pipe keyword arguments from options added by add_publish_arguments. """
+    return dict(
+        flush_period=args.flush_period,
+        batch_size=args.batch_size,
+        max_batch_bytes=args.batch_bytes,
+        compression=args.compression,
+        encoding=args.encoding,
+        spool=Spool(args.spool, args.spool_max_bytes) if args.spool else None,
+        replay_rate=args.replay_rate)
+
 class aws_pipe():
-    def __init__(self, bt_to_aws_queue):
+    def __init__(self, bt_to_aws_queue, flush_period=1, batch_size=500,
+                 max_batch_bytes=IOT_MAX_PAYLOAD_BYTES, compression=None, encoding="json",
+                 aggregators=(), spool=None, replay_rate=20, max_inflight=100,
+                 flush_threshold=None, drain_timeout=5, mqtt_connection=None):
+        if compression not in COMPRESSION_TYPES:
+            raise ValueError(f"Unknown compression '{compression}', expected one of {COMPRESSION_TYPES}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        if encoding not in ENCODING_TYPES:
+            raise ValueError(f"Unknown encoding '{encoding}', expected one of {ENCODING_TYPES}")
+        if max_batch_bytes > IOT_MAX_PAYLOAD_BYTES:
+            raise ValueError(f"max_batch_bytes exceeds the AWS IoT limit of {IOT_MAX_PAYLOAD_BYTES} bytes")
         self.bt_to_aws_queue = bt_to_aws_queue
-        self.mqtt_connection = mqtt_connection_builder.mtls_from_path(
-            endpoint=AWS_IOT_ENDPOINT,
-            cert_filepath=AWS_CERT_FILENAME,
-            pri_key_filepath=AWS_PRI_KEY_FILENAME,
-            ca_filepath=AWS_CA_FILENAME,
-            on_connection_interrupted=self.on_connection_interrupted,
-            on_connection_resumed=self.on_connection_resumed,
-            client_id=AWS_CLIENT_ID,
-            clean_session=False,
-            keep_alive_secs=30)
+        self.flush_period = flush_period
+        self.batch_size = max(1, batch_size)
+        self.max_batch_bytes = max_batch_bytes
+        self.compression = compression
+        self.encoding = encoding
+        # aggregator.ReportAggregator instances feeding bt_to_aws_queue, one per radio
+        self.aggregators = list(aggregators)
+        # Optional spool.Spool, payloads are published from it and removed on PUBACK
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.max_inflight = max_inflight
+        self.inflight_lock = threading.Lock()
+        self.inflight = set()
+        # Highest spool id handed over to the MQTT client, only changed by publish_spool
+        self.spool_cursor = 0
+        # Spool ids whose publish failed, publish_spool rewinds the cursor to the lowest one
+        self.failed_rows = set()
+        self.connected = False
+        # Queue size that triggers a flush before the period has elapsed
+        self.flush_threshold = flush_threshold if flush_threshold is not None else self.batch_size
+        # The threshold follows the batch size unless it was given explicitly
+        self.threshold_is_batch_size = flush_threshold is None
+        self.drain_timeout = drain_timeout
+        if compression == "zstd":
+            self.zstd_compressor = zstandard.ZstdCompressor()
+        self.stats = PublishStats()
+        self.topic = f"{TOPIC_PREFIX}{AWS_CLIENT_ID}"
+        self.metrics_topic = f"{TOPIC_PREFIX}{AWS_CLIENT_ID}/metrics"
+        # Instruments of a metrics.Registry, None unless register_metrics was called
+        self.publish_latency = None
+        self.publish_failures = None
+        self.encode_time = None
+        # Publishes waiting for PUBACK, only counted with metrics
+        self.unacked = 0
+        self.metrics_timer = None
+        self.interruptions = 0
+        self.resumptions = 0
+        if encoding == "binary":
+            self.batch_prefix = encode_batch_header(AWS_CLIENT_ID)
+            self.batch_separator = b''
+            self.batch_suffix = b''
+        else:
+            self.batch_prefix = b'['
+            self.batch_separator = b','
+            self.batch_suffix = b']'
+        # A connection passed in, e.g. a local stand-in for benchmarks, is used as is
+        if mqtt_connection is None:
+            mqtt_connection = mqtt_connection_builder.mtls_from_path(
+                endpoint=AWS_IOT_ENDPOINT,
+                cert_filepath=AWS_CERT_FILENAME,
+                pri_key_filepath=AWS_PRI_KEY_FILENAME,
+                ca_filepath=AWS_CA_FILENAME,
+                on_connection_interrupted=self.on_connection_interrupted,
+                on_connection_resumed=self.on_connection_resumed,
+                client_id=AWS_CLIENT_ID,
+                clean_session=False,
+                keep_alive_secs=30)
+        self.mqtt_connection = mqtt_connection
         connect_future = self.mqtt_connection.connect()
         connect_future.result()
-        #self.shadow_client = iotshadow.IotShadowClient(self.mqtt_connection)
+        self.connected = True
+        self.shadow_client = None
+        # Called with the desired shadow state, returns the state to report
+        self.shadow_handler = None
+        self.shadow_executor = None
         print("Connected!")
         self.locked_data = LockedData()
         self.thing_name = AWS_CLIENT_ID
@@ -49,80 +192,291 @@ class aws_pipe():
     def get_thing_name(self):
         return self.thing_name
 
-        # Subscribe to necessary topics.
-        # Note that is **is** important to wait for "accepted/rejected" subscriptions
-        # to succeed before publishing the corresponding "request".
-        #print("Subscribing to Update responses...")
-        #update_accepted_subscribed_future, _ = self.shadow_client.subscribe_to_update_shadow_accepted(
-        #    request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=SHADOW_THING_NAME),
-        #    qos=mqtt.QoS.AT_LEAST_ONCE,
-        #    callback=self.on_update_shadow_accepted)
-
-        #update_rejected_subscribed_future, _ = self.shadow_client.subscribe_to_update_shadow_rejected(
-        #    request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=SHADOW_THING_NAME),
-        #    qos=mqtt.QoS.AT_LEAST_ONCE,
-        #    callback=self.on_update_shadow_rejected)
-
-        # Wait for subscriptions to succeed
-        #update_accepted_subscribed_future.result()
-        #update_rejected_subscribed_future.result()
-
-        #print("Subscribing to Get responses...")
-        #get_accepted_subscribed_future, _ = self.shadow_client.subscribe_to_get_shadow_accepted(
-        #    request=iotshadow.GetShadowSubscriptionRequest(thing_name=SHADOW_THING_NAME),
-        #    qos=mqtt.QoS.AT_LEAST_ONCE,
-        #    callback=self.on_get_shadow_accepted)
-
-        #get_rejected_subscribed_future, _ = self.shadow_client.subscribe_to_get_shadow_rejected(
-        #    request=iotshadow.GetShadowSubscriptionRequest(thing_name=SHADOW_THING_NAME),
-        #    qos=mqtt.QoS.AT_LEAST_ONCE,
-        #    callback=self.on_get_shadow_rejected)
-
-        # Wait for subscriptions to succeed
-        #get_accepted_subscribed_future.result()
-        #get_rejected_subscribed_future.result()
-
-        #print("Subscribing to Delta events...")
-        #delta_subscribed_future, _ = self.shadow_client.subscribe_to_shadow_delta_updated_events(
-        #    request=iotshadow.ShadowDeltaUpdatedSubscriptionRequest(thing_name=SHADOW_THING_NAME),
-        #    qos=mqtt.QoS.AT_LEAST_ONCE,
-        #    callback=self.on_shadow_delta_updated)
-
-        # Wait for subscription to succeed
-        #delta_subscribed_future.result()
+    def on_timer_expire(self, evt_queue):
+        self.flush(evt_queue)
 
+    def flush(self, evt_queue, force=False):
+        """ Publish the queued reports and return the futures of the publishes.
 
-    def on_timer_expire(self, evt_queue):
+        force also flushes an aggregation window that has not elapsed yet.
+        """
+        for aggregator in self.aggregators:
+            aggregator.flush(force)
+        futures = []
         evt_list = []
         while True:
             try:
                 evt_list.append(evt_queue.get(block=False))
             except queue.Empty:
                 break
-        print(f"\r\nParsing {len(evt_list)} events\r\n")
-        for adv_data in evt_list:
-            topic = f"{TOPIC_PREFIX}{AWS_CLIENT_ID}"
-            message_json = json.dumps(adv_data)
-            print(message_json)
-            print("Publish...")
-            self.mqtt_connection.publish(
-                topic=topic,
-                payload=message_json,
+        if evt_list:
+            print(f"\r\nParsing {len(evt_list)} events\r\n")
+            started = time.perf_counter()
+            for batch in self.make_batches(evt_list):
+                if self.spool is not None:
+                    self.spool.append(self.encode_batch(batch), len(batch))
+                else:
+                    futures.append(self.publish_batch(batch))
+            if self.encode_time is not None:
+                self.encode_time.observe(time.perf_counter() - started)
+        if self.spool is not None:
+            futures.extend(self.publish_spool())
+        elif not evt_list:
+            return futures
+        print(f"Publish stats: {self.stats}")
+        return futures
+
+    def encode_report(self, report):
+        """ Return the bytes of a single report within a batch. """
+        if isinstance(report, (bytes, bytearray)):
+            # Already encoded by the producer or a ShardedPipeline worker
+            return report
+        return json.dumps(report, separators=(',', ':')).encode('utf-8')
+
+    def make_batches(self, evt_list):
+        """ Split reports into payloads bounded by batch_size and max_batch_bytes.
+
+        The byte ceiling is applied to the uncompressed payload, so compressed
+        batches always stay below it as well.
+        """
+        framing_bytes = len(self.batch_prefix) + len(self.batch_suffix)
+        separator_bytes = len(self.batch_separator)
+        batch = []
+        batch_bytes = framing_bytes
+        for report in evt_list:
+            encoded = self.encode_report(report)
+            added_bytes = len(encoded) + (separator_bytes if batch else 0)
+            if batch and (len(batch) >= self.batch_size or batch_bytes + added_bytes > self.max_batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = framing_bytes
+                added_bytes = len(encoded)
+            if batch_bytes + added_bytes > self.max_batch_bytes:
+                print(f"Report of {len(encoded)} bytes exceeds the batch byte ceiling")
+            batch.append(encoded)
+            batch_bytes += added_bytes
+        if batch:
+            yield batch
+
+    def encode_batch(self, batch):
+        """ Frame encoded reports to a single payload and compress it if configured. """
+        payload = self.batch_prefix + self.batch_separator.join(batch) + self.batch_suffix
+        self.stats.raw_bytes += len(payload)
+        if self.compression == "gzip":
+            payload = gzip.compress(payload)
+        elif self.compression == "zstd":
+            payload = self.zstd_compressor.compress(payload)
+        return payload
+
+    def publish_batch(self, batch):
+        """ Publish a list of encoded reports as a single MQTT message. """
+        payload = self.encode_batch(batch)
+        publish_future, _ = self.mqtt_connection.publish(
+            topic=self.topic,
+            payload=payload,
+            qos=mqtt.QoS.AT_LEAST_ONCE)
+        self.track_publish(publish_future)
+        self.stats.reports += len(batch)
+        self.stats.messages += 1
+        self.stats.payload_bytes += len(payload)
+        return publish_future
+
+    def track_publish(self, publish_future):
+        """ Measure the time until the PUBACK of a publish, if metrics are enabled. """
+        if self.publish_latency is None:
+            return
+        started = time.monotonic()
+        with self.inflight_lock:
+            self.unacked += 1
+        publish_future.add_done_callback(lambda future: self.on_publish_complete(future, started))
+
+    def on_publish_complete(self, future, started):
+        with self.inflight_lock:
+            self.unacked -= 1
+        try:
+            future.result()
+        except Exception:
+            self.publish_failures.inc()
+            return
+        self.publish_latency.observe(time.monotonic() - started)
+
+    def publish_spool(self):
+        """ Publish spooled payloads, limited by replay_rate and max_inflight. """
+        futures = []
+        if not self.connected:
+            return futures
+        with self.inflight_lock:
+            if self.failed_rows:
+                self.spool_cursor = min(self.spool_cursor, min(self.failed_rows) - 1)
+                self.failed_rows.clear()
+            budget = min(
+                max(1, int(self.replay_rate * self.flush_period)),
+                self.max_inflight - len(self.inflight))
+        if budget <= 0:
+            return futures
+        for row_id, count, payload in self.spool.read(self.spool_cursor, budget):
+            self.spool_cursor = row_id
+            with self.inflight_lock:
+                if row_id in self.inflight:
+                    # Still waiting for PUBACK after a rewind
+                    continue
+                self.inflight.add(row_id)
+            publish_future, _ = self.mqtt_connection.publish(
+                topic=self.topic,
+                payload=payload,
                 qos=mqtt.QoS.AT_LEAST_ONCE)
+            publish_future.add_done_callback(
+                lambda future, row_id=row_id: self.on_spool_publish_complete(future, row_id))
+            self.track_publish(publish_future)
+            futures.append(publish_future)
+            self.stats.reports += count
+            self.stats.messages += 1
+            self.stats.payload_bytes += len(payload)
+        if self.spool.length > len(self.inflight):
+            print(f"Spool holds {self.spool.length} messages, {self.spool.dropped} dropped")
+        return futures
+
+    def on_spool_publish_complete(self, future, row_id):
+        """ Remove a payload from the spool once its PUBACK has arrived. """
+        with self.inflight_lock:
+            self.inflight.discard(row_id)
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Publish of spooled message {row_id} failed: {e}")
+                # Published again on the next flush, which rewinds the cursor
+                self.failed_rows.add(row_id)
+                return
+        self.spool.ack(row_id)
 
     def start_pipe(self):
-        self.t = PeriodicTimer(1, self.on_timer_expire, [self.bt_to_aws_queue])
+        self.t = PeriodicTimer(self.flush_period, self.on_timer_expire, [self.bt_to_aws_queue])
+        if hasattr(self.bt_to_aws_queue, 'set_threshold_callback'):
+            self.bt_to_aws_queue.set_threshold_callback(self.flush_threshold, self.t.trigger)
         self.t.start()
 
+    def set_flush_period(self, flush_period):
+        """ Change the flush period, also while the pipe is running. """
+        self.flush_period = flush_period
+        t = getattr(self, 't', None)
+        if t is not None:
+            t.set_period(flush_period)
+
+    def set_batch_size(self, batch_size):
+        """ Change the number of reports per message and, unless set explicitly, the flush threshold. """
+        self.batch_size = max(1, batch_size)
+        if self.threshold_is_batch_size:
+            self.flush_threshold = self.batch_size
+            t = getattr(self, 't', None)
+            if t is not None and hasattr(self.bt_to_aws_queue, 'set_threshold_callback'):
+                self.bt_to_aws_queue.set_threshold_callback(self.flush_threshold, t.trigger)
+
+    def register_metrics(self, registry):
+        """ Expose the publish counters, latency and connection state in a metrics.Registry. """
+        self.publish_latency = registry.histogram("publish_latency_seconds", "Time from publish to PUBACK")
+        self.publish_failures = registry.counter("publish_failures_total", "Publishes that failed or timed out")
+        self.encode_time = registry.histogram("batch_encode_seconds",
+            "Time to batch, encode and hand over the reports of one flush")
+        registry.gauge("publish_inflight", "Publishes waiting for PUBACK", callback=lambda: self.unacked)
+        registry.counter("published_reports_total", "Reports handed over to the MQTT client",
+            callback=lambda: self.stats.reports)
+        registry.counter("published_messages_total", "MQTT messages handed over to the MQTT client",
+            callback=lambda: self.stats.messages)
+        registry.counter("published_bytes_total", "Payload bytes of the MQTT messages after compression",
+            callback=lambda: self.stats.payload_bytes)
+        registry.counter("published_raw_bytes_total", "Payload bytes of the MQTT messages before compression",
+            callback=lambda: self.stats.raw_bytes)
+        registry.gauge("mqtt_connected", "1 while the MQTT connection is up", callback=lambda: int(self.connected))
+        registry.counter("mqtt_interruptions_total", "Interruptions of the MQTT connection",
+            callback=lambda: self.interruptions)
+        registry.counter("mqtt_resumptions_total", "Resumptions of the MQTT connection",
+            callback=lambda: self.resumptions)
+        if self.spool is not None:
+            registry.gauge("spool_messages", "Payloads in the spool waiting for PUBACK",
+                callback=lambda: self.spool.length)
+            registry.counter("spool_dropped_total", "Spooled payloads dropped above the size limit",
+                callback=lambda: self.spool.dropped)
+
+    def start_metrics(self, registry, period):
+        """ Publish the samples of a metrics.Registry as JSON to the metrics topic every period seconds. """
+        self.metrics_timer = PeriodicTimer(period, self.publish_metrics, [registry])
+        self.metrics_timer.start()
+
+    def publish_metrics(self, registry):
+        if not self.connected:
+            # Metrics are not worth buffering, the next period reports the current values
+            return
+        payload = json.dumps({
+            'thing_name': self.thing_name,
+            'timestamp': time.time(),
+            'metrics': registry.to_dict(),
+        })
+        self.mqtt_connection.publish(
+            topic=self.metrics_topic,
+            payload=payload,
+            qos=mqtt.QoS.AT_MOST_ONCE)
+
     def disconnect(self):
         try:
             self.t.stop()
         except AttributeError:
             pass
+        if self.metrics_timer is not None:
+            self.metrics_timer.stop()
+        with self.locked_data.lock:
+            self.locked_data.disconnect_called = True
+        if self.shadow_executor is not None:
+            self.shadow_executor.shutdown(wait=True)
+        # Publish whatever is left and give the PUBACKs a chance to arrive
+        futures = self.flush(self.bt_to_aws_queue, force=True)
+        if futures:
+            _, not_done = wait(futures, timeout=self.drain_timeout)
+            if not_done:
+                print(f"{len(not_done)} messages not acknowledged before disconnect")
         disconnect_future = self.mqtt_connection.disconnect()
         disconnect_future.result()
+        if self.spool is not None:
+            self.spool.close()
         print("Disconnected!")   
 
+    def start_shadow(self, handler):
+        """ Apply the desired state of the device shadow with handler and report what it returns.
+
+        handler is called with a dict of the changed desired properties, on a
+        worker thread, and returns a dict of all reported properties. It is
+        called with an empty dict to report the initial state.
+        """
+        self.shadow_handler = handler
+        self.shadow_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+        self.shadow_client = iotshadow.IotShadowClient(self.mqtt_connection)
+
+        # Wait for the accepted/rejected subscriptions before publishing requests
+        futures = [
+            self.shadow_client.subscribe_to_update_shadow_accepted(
+                request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=self.thing_name),
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=self.on_update_shadow_accepted)[0],
+            self.shadow_client.subscribe_to_update_shadow_rejected(
+                request=iotshadow.UpdateShadowSubscriptionRequest(thing_name=self.thing_name),
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=self.on_update_shadow_rejected)[0],
+            self.shadow_client.subscribe_to_get_shadow_accepted(
+                request=iotshadow.GetShadowSubscriptionRequest(thing_name=self.thing_name),
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=self.on_get_shadow_accepted)[0],
+            self.shadow_client.subscribe_to_get_shadow_rejected(
+                request=iotshadow.GetShadowSubscriptionRequest(thing_name=self.thing_name),
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=self.on_get_shadow_rejected)[0],
+            self.shadow_client.subscribe_to_shadow_delta_updated_events(
+                request=iotshadow.ShadowDeltaUpdatedSubscriptionRequest(thing_name=self.thing_name),
+                qos=mqtt.QoS.AT_LEAST_ONCE,
+                callback=self.on_shadow_delta_updated)[0],
+        ]
+        for future in futures:
+            future.result()
+        self.get_shadow()
+
     def get_shadow(self):
         with self.locked_data.lock:
             # use a unique token so we can correlate this "request" message to
@@ -130,16 +484,18 @@ class aws_pipe():
             token = str(uuid4())
 
             publish_get_future = self.shadow_client.publish_get_shadow(
-                request=iotshadow.GetShadowRequest(thing_name=SHADOW_THING_NAME, client_token=token),
+                request=iotshadow.GetShadowRequest(thing_name=self.thing_name, client_token=token),
                 qos=mqtt.QoS.AT_LEAST_ONCE)
 
             self.locked_data.request_tokens.add(token)
 
         # Ensure that publish succeeds
-        publish_get_future.result()     
+        publish_get_future.result()
 
     def on_connection_interrupted(self, connection, error, **kwargs):
         print("Connection interrupted. error: {}".format(error))
+        self.connected = False
+        self.interruptions += 1
 
     def on_resubscribe_complete(self, resubscribe_future):
         resubscribe_results = resubscribe_future.result()
@@ -152,6 +508,8 @@ class aws_pipe():
     # Callback when an interrupted connection is re-established.
     def on_connection_resumed(self, connection, return_code, session_present, **kwargs):
         print("Connection resumed. return_code: {} session_present: {}".format(return_code, session_present))
+        self.connected = True
+        self.resumptions += 1
 
         if return_code == mqtt.ConnectReturnCode.ACCEPTED and not session_present:
             print("Session did not persist. Resubscribing to existing topics...")
@@ -161,194 +519,96 @@ class aws_pipe():
             # evaluate result with a callback instead.
             resubscribe_future.add_done_callback(self.on_resubscribe_complete)
     
-    def set_local_value_due_to_initial_query(self, reported_value):
-        with self.locked_data.lock:
-            self.locked_data.shadow_value = reported_value
+    def apply_shadow_state(self, desired):
+        """ Apply desired shadow properties and report the resulting state. Runs on the shadow executor. """
+        try:
+            reported = self.shadow_handler(desired or {})
+        except Exception:
+            traceback.print_exc()
+            return
+        self.report_shadow(reported)
 
-    def change_shadow_value(self, value):
+    def submit_shadow_state(self, desired):
+        """ Apply desired shadow properties off the MQTT event-loop thread. """
+        try:
+            self.shadow_executor.submit(self.apply_shadow_state, desired)
+        except RuntimeError:
+            # Executor shut down by disconnect
+            pass
+
+    def report_shadow(self, reported):
         with self.locked_data.lock:
-            if self.locked_data.shadow_value == value:
-                print("Local value is already '{}'.".format(value))
-                print("Enter desired value: ") # remind user they can input new values
+            if self.locked_data.disconnect_called:
                 return
-
-            print("Changed local shadow value to '{}'.".format(value))
-            self.locked_data.shadow_value = value
-
-            print("Updating reported shadow value to '{}'...".format(value))
-
-            # use a unique token so we can correlate this "request" message to
-            # any "response" messages received on the /accepted and /rejected topics
             token = str(uuid4())
-
-            # if the value is "clear shadow" then send a UpdateShadowRequest with None
-            # for both reported and desired to clear the shadow document completely.
-            if value == "clear_shadow":
-                tmp_state = iotshadow.ShadowState(reported=None, desired=None, reported_is_nullable=True, desired_is_nullable=True)
-                request = iotshadow.UpdateShadowRequest(
-                    thing_name=SHADOW_THING_NAME,
-                    state=tmp_state,
-                    client_token=token,
-                )
-            # Otherwise, send a normal update request
-            else:
-                # if the value is "none" then set it to a Python none object to
-                # clear the individual shadow property
-                if value == "none":
-                    value = None
-
-                request = iotshadow.UpdateShadowRequest(
-                thing_name=SHADOW_THING_NAME,
-                state=iotshadow.ShadowState(
-                    reported={ SHADOW_PROPERTY: value },
-                    desired={ SHADOW_PROPERTY: value },
-                    ),
-                    client_token=token,
-                )
-
+            request = iotshadow.UpdateShadowRequest(
+                thing_name=self.thing_name,
+                state=iotshadow.ShadowState(reported=reported),
+                client_token=token,
+            )
             future = self.shadow_client.publish_update_shadow(request, mqtt.QoS.AT_LEAST_ONCE)
-
             self.locked_data.request_tokens.add(token)
+        future.add_done_callback(self.on_publish_update_shadow)
 
-            future.add_done_callback(self.on_publish_update_shadow)
-
+    def take_request_token(self, token, message):
+        """ Return True if token belongs to a request of this session. """
+        with self.locked_data.lock:
+            try:
+                self.locked_data.request_tokens.remove(token)
+                return True
+            except KeyError:
+                print(f"Ignoring {message} message due to unexpected token.")
+                return False
 
     def on_get_shadow_accepted(self, response):
         # type: (iotshadow.GetShadowResponse) -> None
-        try:
-            with self.locked_data.lock:
-                # check that this is a response to a request from this session
-                try:
-                    self.locked_data.request_tokens.remove(response.client_token)
-                except KeyError:
-                    print("Ignoring get_shadow_accepted message due to unexpected token.")
-                    return
-
-                print("Finished getting initial shadow state.")
-                if self.locked_data.shadow_value is not None:
-                    print("  Ignoring initial query because a delta event has already been received.")
-                    return
-
-            if response.state:
-                print(response.state)
-                if response.state.delta:
-                    value = response.state.delta.get(SHADOW_PROPERTY)
-                    if value:
-                        print("  Shadow contains delta value '{}'.".format(value))
-                        self.change_shadow_value(value)
-                        return
-
-                if response.state.reported:
-                    value = response.state.reported.get(SHADOW_PROPERTY)
-                    if value:
-                        print("  Shadow contains reported value '{}'.".format(value))
-                        self.set_local_value_due_to_initial_query(response.state.reported[SHADOW_PROPERTY])
-                        return
-
-            print("  Shadow document lacks '{}' property. Setting defaults...".format(SHADOW_PROPERTY))
-            self.change_shadow_value(SHADOW_VALUE_DEFAULT)
+        if not self.take_request_token(response.client_token, "get_shadow_accepted"):
             return
-
-        except Exception as e:
-            exit(e)
+        delta = response.state.delta if response.state else None
+        if delta:
+            print(f"Shadow contains delta {delta}")
+        # Without a delta the current settings are reported, so the shadow reflects the device
+        self.submit_shadow_state(delta)
 
     def on_get_shadow_rejected(self, error):
         # type: (iotshadow.ErrorResponse) -> None
-        try:
-            # check that this is a response to a request from this session
-            with self.locked_data.lock:
-                try:
-                    self.locked_data.request_tokens.remove(error.client_token)
-                except KeyError:
-                    print("Ignoring get_shadow_rejected message due to unexpected token.")
-                    return
-
-            if error.code == 404:
-                print("Thing has no shadow document. Creating with defaults...")
-                self.change_shadow_value(SHADOW_VALUE_DEFAULT)
-            else:
-                exit("Get request was rejected. code:{} message:'{}'".format(
-                    error.code, error.message))
-
-        except Exception as e:
-            exit(e)
+        if not self.take_request_token(error.client_token, "get_shadow_rejected"):
+            return
+        if error.code == 404:
+            print("Thing has no shadow document, reporting current settings")
+            self.submit_shadow_state({})
+        else:
+            print(f"Get shadow request was rejected. code:{error.code} message:'{error.message}'")
 
     def on_shadow_delta_updated(self, delta):
         # type: (iotshadow.ShadowDeltaUpdatedEvent) -> None
-        try:
-            print("Received shadow delta event.")
-            if delta.state and (SHADOW_PROPERTY in delta.state):
-                value = delta.state[SHADOW_PROPERTY]
-                if value is None:
-                    print("  Delta reports that '{}' was deleted. Resetting defaults...".format(SHADOW_PROPERTY))
-                    self.change_shadow_value(SHADOW_VALUE_DEFAULT)
-                    return
-                else:
-                    print("  Delta reports that desired value is '{}'. Changing local value...".format(value))
-                    if (delta.client_token is not None):
-                        print ("  ClientToken is: " + delta.client_token)
-                    self.change_shadow_value(value)
-            else:
-                print("  Delta did not report a change in '{}'".format(SHADOW_PROPERTY))
-
-        except Exception as e:
-            exit(e)
+        if delta.state:
+            print(f"Received shadow delta {delta.state}")
+            self.submit_shadow_state(delta.state)
 
     def on_update_shadow_accepted(self, response):
         # type: (iotshadow.UpdateShadowResponse) -> None
-        try:
-            # check that this is a response to a request from this session
-            with self.locked_data.lock:
-                try:
-                    self.locked_data.request_tokens.remove(response.client_token)
-                except KeyError:
-                    print("Ignoring update_shadow_accepted message due to unexpected token.")
-                    return
-
-            try:
-                if response.state.reported != None:
-                    if SHADOW_PROPERTY in response.state.reported:
-                        print("Finished updating reported shadow value to '{}'.".format(response.state.reported[SHADOW_PROPERTY])) # type: ignore
-                    else:
-                        print ("Could not find shadow property with name: '{}'.".format(SHADOW_PROPERTY)) # type: ignore
-                else:
-                    print("Shadow states cleared.") # when the shadow states are cleared, reported and desired are set to None
-            except:
-                exit("Updated shadow is missing the target property")
-
-        except Exception as e:
-            exit(e)
+        if not self.take_request_token(response.client_token, "update_shadow_accepted"):
+            return
+        if response.state and response.state.reported is not None:
+            print(f"Reported shadow state {response.state.reported}")
 
     def on_update_shadow_rejected(self, error):
         # type: (iotshadow.ErrorResponse) -> None
-        try:
-            # check that this is a response to a request from this session
-            with self.locked_data.lock:
-                try:
-                    self.locked_data.request_tokens.remove(error.client_token)
-                except KeyError:
-                    print("Ignoring update_shadow_rejected message due to unexpected token.")
-                    return
-
-            exit("Update request was rejected. code:{} message:'{}'".format(
-                error.code, error.message))
-
-        except Exception as e:
-            exit(e)
-
+        if not self.take_request_token(error.client_token, "update_shadow_rejected"):
+            return
+        print(f"Update shadow request was rejected. code:{error.code} message:'{error.message}'")
 
     def on_publish_update_shadow(self, future):
         #type: (Future) -> None
         try:
             future.result()
-            print("Update request published.")
         except Exception as e:
-            print("Failed to publish update request.")
-            exit(e)
-        
+            print(f"Failed to publish shadow update: {e}")
+
 if __name__ =="__main__":
     myq = queue.Queue()
     pipe = aws_pipe(myq)
-    pipe.get_shadow()
+    pipe.start_shadow(lambda desired: desired)
     time.sleep(5)
     pipe.disconnect()
\ No newline at end of file
@@ -0,0 +1,343 @@
+"""
+Micro-benchmarks of the per report functions that bound the gateway throughput.
+
+Each benchmark times one operation on realistic inputs, 31 byte legacy and
+1650 byte extended advertising data. Its rounds alternate with rounds of a
+fixed reference workload, pure Python or a bytes join for the benchmarks
+bound by memory copies, and the median of the per round ratios to the
+reference is what --compare uses: the speed of the host and its drift
+cancel out, and rounds disturbed by other processes are ignored. The
+rounds are spread over several fresh processes, since the speed of some
+benchmarks depends on the memory layout of the process. The standard error
+of the median, estimated from the interquartile range of the ratios, is
+kept as the noise of the benchmark.
+
+--save writes the results to a baseline file, --compare runs the
+benchmarks again and flags the ones slower than the baseline by more than
+--threshold, or by more than the noise of both runs allows, with exit code
+1 if there are any. bench_baseline.json is recorded with CPython 3.11 on
+x86_64 Linux, record a new one before a change if the comparison runs
+elsewhere:
+
+    python bench_micro.py --compare bench_baseline.json
+    python bench_micro.py --save bench_baseline.json
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import platform
+import queue
+import statistics
+import sys
+import threading
+import time
+import timeit
+
+from adv_data import AdvData, parse_adv_data
+from report_queue import ReportQueue
+from reports import RawReport, report_to_dict, report_to_record, serialize_report
+from sim_scenarios import AD_FLAGS, ad_structure, ibeacon_data, manufacturer_data
+from util import find_service_in_advertisement
+try:
+    import cpc_connector
+except (ImportError, OSError):
+    # Linux only, the CPC benchmarks are skipped elsewhere
+    cpc_connector = None
+
+BASELINE_VERSION = 3
+THING_NAME = "bench"
+BATCH_SIZE = 500
+# Standard errors of the ratio of two medians a benchmark may be slower by chance
+NOISE_FACTOR = 3
+
+_benchmarks = {}
+# Benchmarks timed against another workload than reference_workload
+_references = {}
+
+def benchmark(name, reference=None):
+    """ Register a function returning the operation to time, the setup is not timed. """
+    def decorator(func):
+        _benchmarks[name] = func
+        if reference is not None:
+            _references[name] = reference
+        return func
+    return decorator
+
+# Legacy advertising data is at most 31 bytes
+LEGACY_DATA = manufacturer_data(0x02FF, bytes(range(24)))
+IBEACON_DATA = ibeacon_data(bytes(range(16)), 1, 2)
+
+def extended_data(size=1650):
+    """ Return extended advertising data of size bytes: flags, 16-bit UUIDs, a name and manufacturer data. """
+    data = AD_FLAGS + ad_structure(0x03, b'\x0f\x18\x0d\x18\x12\x18') + ad_structure(0x09, b'bench-extended')
+    while len(data) < size:
+        # A structure holds up to 254 bytes of value
+        chunk = min(254, size - len(data) - 2)
+        data += ad_structure(0xFF, (0x02FF).to_bytes(2, 'little') + bytes(max(0, chunk - 2)))
+    return data[:size]
+
+EXTENDED_DATA = extended_data()
+
+def raw(data, extended):
+    if extended:
+        return RawReport(0, True, 1, '00:0b:57:01:02:03', 0, -67, 12, data, 4, 3, 0)
+    return RawReport(0, False, 3, '00:0b:57:01:02:03', 0, -67, 37, data, 127, None, 0)
+
+@benchmark("parse_adv_data/legacy")
+def bench_parse_legacy():
+    return lambda: parse_adv_data(LEGACY_DATA)
+
+@benchmark("parse_adv_data/extended")
+def bench_parse_extended():
+    return lambda: parse_adv_data(EXTENDED_DATA)
+
+@benchmark("AdvData.local_name/extended")
+def bench_local_name():
+    return lambda: AdvData(EXTENDED_DATA).local_name
+
+@benchmark("find_service_in_advertisement/legacy")
+def bench_find_service_legacy():
+    # The searched UUID is missing, so the whole data is scanned
+    return lambda: find_service_in_advertisement(IBEACON_DATA, b'\xaa\xfe')
+
+@benchmark("find_service_in_advertisement/extended")
+def bench_find_service_extended():
+    return lambda: find_service_in_advertisement(EXTENDED_DATA, b'\x12\x18')
+
+@benchmark("report_to_dict/legacy")
+def bench_report_dict_legacy():
+    report = raw(LEGACY_DATA, False)
+    return lambda: report_to_dict(report, False, 1700000000.0, THING_NAME, 0)
+
+@benchmark("report_to_dict/extended")
+def bench_report_dict_extended():
+    report = raw(EXTENDED_DATA, True)
+    return lambda: report_to_dict(report, True, 1700000000.0, THING_NAME, 0)
+
+@benchmark("report_to_record/legacy")
+def bench_report_record_legacy():
+    report = raw(LEGACY_DATA, False)
+    return lambda: report_to_record(report, False, 1700000000.0, 0)
+
+@benchmark("batch_json/500")
+def bench_batch_json():
+    reports = [report_to_dict(raw(LEGACY_DATA, False), False, 1700000000.0 + i, THING_NAME, 0)
+               for i in range(BATCH_SIZE)]
+    # Serialization and framing as done by aws_pipe.make_batches and encode_batch
+    return lambda: b'[' + b','.join([serialize_report(report) for report in reports]) + b']'
+
+@benchmark("batch_json_dumps/500")
+def bench_batch_json_dumps():
+    reports = [report_to_dict(raw(LEGACY_DATA, False), False, 1700000000.0 + i, THING_NAME, 0)
+               for i in range(BATCH_SIZE)]
+    # One json.dumps of the whole list, for comparison
+    return lambda: json.dumps(reports).encode('utf-8')
+
+COPY_CHUNKS = [bytes((i % 256,)) * 60 for i in range(BATCH_SIZE)]
+
+def copy_workload():
+    """ Join of bytes objects, the reference of benchmarks bound by memory copies rather than the interpreter. """
+    return b''.join(COPY_CHUNKS)
+
+@benchmark("batch_binary/500", reference=copy_workload)
+def bench_batch_binary():
+    records = [report_to_record(raw(LEGACY_DATA, False), False, 1700000000.0 + i, 0) for i in range(BATCH_SIZE)]
+    return lambda: b''.join(records)
+
+def put_drain(q, item, count=BATCH_SIZE):
+    for _ in range(count):
+        q.put(item)
+    while True:
+        try:
+            q.get(block=False)
+        except queue.Empty:
+            return
+
+@benchmark("ReportQueue.put_drain/500")
+def bench_report_queue():
+    q = ReportQueue()
+    item = report_to_record(raw(LEGACY_DATA, False), False, 1700000000.0, 0)
+    return lambda: put_drain(q, item)
+
+@benchmark("queue.Queue.put_drain/500")
+def bench_queue():
+    q = queue.Queue()
+    item = report_to_record(raw(LEGACY_DATA, False), False, 1700000000.0, 0)
+    return lambda: put_drain(q, item)
+
+class FrameEndpoint:
+    """ Stand-in for a CPC endpoint, every read returns the same frame. """
+    def __init__(self, frame):
+        self.frame = frame
+
+    def readinto(self, buffer, nonblock=False):
+        buffer[:len(self.frame)] = self.frame
+        return len(self.frame)
+
+if cpc_connector is not None:
+    class FrameConnector(cpc_connector.SerialConnectorCPC):
+        """ SerialConnectorCPC reading from a FrameEndpoint, libcpc is not loaded. """
+        def __init__(self, frame):
+            self.endpoint = FrameEndpoint(frame)
+            self.io_cond = threading.Condition()
+            self.active_io = 0
+            self.resetting = False
+            self.read_buff = bytearray(cpc_connector.READ_BUFF_SIZE)
+            self.read_view = memoryview(self.read_buff)
+            self.read_pos = 0
+            self.write_pos = 0
+            self.nonblock = False
+
+    def read_message(connector):
+        # Header start, rest of the header and payload, like BGLib
+        header = connector.read(1) + connector.read(3)
+        return connector.read(((header[0] & 0x07) << 8) | header[1])
+
+    def event_frame(data):
+        payload = bytes(22) + bytes((len(data),)) + data
+        return bytes((0xA0 | (len(payload) >> 8), len(payload) & 0xFF, 5, 0)) + payload
+
+    @benchmark("SerialConnectorCPC.read/legacy")
+    def bench_cpc_read_legacy():
+        connector = FrameConnector(event_frame(LEGACY_DATA))
+        return lambda: read_message(connector)
+
+    @benchmark("SerialConnectorCPC.read/extended")
+    def bench_cpc_read_extended():
+        connector = FrameConnector(event_frame(EXTENDED_DATA[:250]))
+        return lambda: read_message(connector)
+
+def reference_workload():
+    """ Dict, string and bytes operations like the benchmarked code, independent of the repo. """
+    fields = {}
+    for i in range(50):
+        fields[f"field{i}"] = i * 3
+    return b",".join(str(value).encode() for value in fields.values())
+
+def calls_per_round(timer, min_time):
+    """ Return the number of calls taking about min_time seconds. """
+    number = 1
+    while True:
+        seconds = timer.timeit(number)
+        if seconds >= min_time / 10:
+            return max(1, int(number * min_time / seconds))
+        number *= 2
+
+def measure(operation, min_time, rounds, reference=reference_workload):
+    """ Return the times per call in seconds and their ratios to the reference of rounds alternating with the reference. """
+    reference = timeit.Timer(reference)
+    timer = timeit.Timer(operation)
+    reference_number = calls_per_round(reference, min_time)
+    number = calls_per_round(timer, min_time)
+    times = []
+    ratios = []
+    for _ in range(rounds):
+        reference_seconds = reference.timeit(reference_number) / reference_number
+        seconds = timer.timeit(number) / number
+        times.append(seconds)
+        ratios.append(seconds / reference_seconds)
+    return times, ratios
+
+def measure_all(names, min_time, rounds):
+    """ Return a dict of benchmark names to the times and ratios of their rounds, run in a worker process. """
+    return {name: measure(_benchmarks[name](), min_time, rounds, _references.get(name, reference_workload))
+            for name in names}
+
+def summarize(times, ratios):
+    """ Return the median time per call in seconds, the median ratio to the reference and the noise of the ratio. """
+    relative = statistics.median(ratios)
+    if len(ratios) < 2:
+        return times[0], relative, 0.0
+    quartiles = statistics.quantiles(ratios, n=4)
+    # Standard error of the median of normally distributed rounds, relative to it
+    sigma = (quartiles[2] - quartiles[0]) / 1.349
+    return statistics.median(times), relative, 1.2533 * sigma / len(ratios) ** 0.5 / relative
+
+def run(selected, min_time, rounds, processes):
+    names = [name for name in _benchmarks if not selected or any(pattern in name for pattern in selected)]
+    samples = {name: ([], []) for name in names}
+    # The speed of some benchmarks depends on the memory layout of the process,
+    # fresh processes sample it like the rounds sample the load of the host
+    context = multiprocessing.get_context("spawn")
+    for index in range(processes):
+        print(f"Process {index + 1}/{processes}", flush=True)
+        with context.Pool(1) as pool:
+            measured = pool.apply(measure_all, (names, min_time, rounds))
+        for name, (times, ratios) in measured.items():
+            samples[name][0].extend(times)
+            samples[name][1].extend(ratios)
+    results = {}
+    for name, (times, ratios) in samples.items():
+        seconds, relative, noise = summarize(times, ratios)
+        results[name] = {
+            'ns_per_op': round(seconds * 1e9, 1),
+            'ops_per_s': round(1 / seconds, 1),
+            'relative': round(relative, 6),
+            'noise': round(noise, 4),
+        }
+        print(f"{name:45s} {seconds * 1e9:12.1f} ns/op {1 / seconds:14.1f} ops/s "
+              f"{relative:10.4f} x ref +-{noise * 100:5.1f}%")
+    return results
+
+def compare(results, baseline, threshold):
+    """ Print the ratio of the relative times to the baseline and return the names of the regressed benchmarks. """
+    if baseline.get('version') != BASELINE_VERSION:
+        raise ValueError(f"Baseline version {baseline.get('version')} is not {BASELINE_VERSION}, save a new one")
+    regressions = []
+    print(f"\n{'benchmark':45s} {'baseline':>12s} {'current':>12s} {'ratio':>7s} {'limit':>7s}  (x reference)")
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f"{name:45s} {'-':>12s} {result['relative']:12.4f}")
+            continue
+        ratio = result['relative'] / base['relative']
+        # A noisy benchmark needs a larger slowdown to count
+        limit = max(threshold, 1 + NOISE_FACTOR * math.hypot(base['noise'], result['noise']))
+        flag = ""
+        if ratio > limit:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / limit:
+            flag = "  faster"
+        print(f"{name:45s} {base['relative']:12.4f} {result['relative']:12.4f} {ratio:7.2f} {limit:7.2f}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog = 'bench_micro',
+                    description = __doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('filter', nargs='*', help="Only run benchmarks whose name contains one of these")
+    parser.add_argument('--save', help="Write the results to this baseline file")
+    parser.add_argument('--compare', help="Compare the results to this baseline file")
+    parser.add_argument('--threshold', type=float, default=1.25,
+        help="Slowdown factor above which a benchmark counts as regressed")
+    parser.add_argument('--min_time', type=float, default=0.05, help="Minimum seconds per round")
+    parser.add_argument('--rounds', type=int, default=3, help="Number of rounds per process")
+    parser.add_argument('--processes', type=int, default=6,
+        help="Number of processes running the rounds one after the other, the median round of all counts")
+    args = parser.parse_args()
+
+    results = run(args.filter, args.min_time, args.rounds, args.processes)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                'version': BASELINE_VERSION,
+                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2)
+        print(f"Baseline written to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmarks regressed beyond their limit")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+End-to-end benchmark of the scanner to publisher pipeline, without radio or AWS.
+
+Each scenario of sim_scenarios is turned into a BGAPI capture, which a
+ReplayConnector plays back to the real ble_scan.App. The reports go through
+the ReportQueue and aws_pipe as in production, but aws_pipe publishes to
+LocalMqttConnection, an in-process stand-in for the MQTT connection. A
+real site recording made with --record can be benchmarked with --capture.
+
+Per scenario the results hold the sustained report rate, the scan to
+publish latency percentiles, the CPU time per 1000 reports, the RSS growth
+and the drop counts. They are written as JSON to --output, so that the
+files of two releases can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+import ble_scan
+from aws_iot import aws_pipe, add_publish_arguments, pipe_kwargs_from_args
+from bgapi_capture import CaptureWriter, ReplayConnector, encode_message, message_key, read_capture, \
+    split_messages, RX
+from report_codec import decompress, iter_records, BATCH_MAGIC
+from report_queue import add_queue_arguments, queue_from_args
+from sim_scenarios import AdvertiserSim, SCENARIOS, load_scenario
+from util import BT_XAPI
+from xapi_cache import load_api
+
+RESULTS_VERSION = 1
+
+class LocalMqttConnection:
+    """ In-process stand-in for the methods of awscrt.mqtt.Connection used by aws_pipe.
+
+    Payloads are kept with their publish time, PUBACKs complete after puback_delay.
+    """
+    def __init__(self, puback_delay=0):
+        self.puback_delay = puback_delay
+        self.lock = threading.Lock()
+        self.published = []
+        self.packet_id = 0
+
+    @staticmethod
+    def _done(result=None):
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def connect(self):
+        return self._done({'session_present': False})
+
+    def disconnect(self):
+        return self._done()
+
+    def publish(self, topic, payload, qos):
+        with self.lock:
+            self.packet_id += 1
+            packet_id = self.packet_id
+            self.published.append((time.time(), payload))
+        if self.puback_delay <= 0:
+            return self._done({'packet_id': packet_id}), packet_id
+        future = Future()
+        timer = threading.Timer(self.puback_delay, future.set_result, [{'packet_id': packet_id}])
+        timer.daemon = True
+        timer.start()
+        return future, packet_id
+
+def report_message(api, raw):
+    """ Return the scanner report event of a RawReport. """
+    if raw.extended:
+        return encode_message(api, "scanner", "extended_advertisement_report", event=True,
+            event_flags=raw.event_flags, address=raw.address, address_type=raw.address_type,
+            bonding=0xFF, rssi=raw.rssi, channel=raw.channel, target_address_type=0,
+            adv_sid=raw.adv_sid, primary_phy=1, secondary_phy=2, tx_power=raw.tx_power,
+            periodic_interval=raw.periodic_interval, data=raw.data)
+    return encode_message(api, "scanner", "legacy_advertisement_report", event=True,
+        event_flags=raw.event_flags, address=raw.address, address_type=raw.address_type,
+        bonding=0xFF, rssi=raw.rssi, channel=raw.channel, target_address_type=0, data=raw.data)
+
+def write_scenario_capture(path, scenario, seed, duration, api):
+    """ Write the capture of a booting NCP reporting the advertisements of a scenario. """
+    writer = CaptureWriter(path)
+    sim = AdvertiserSim(scenario, seed)
+    start = sim.start
+    major, minor, patch = (int(part) for part in api.version.split(".")[:3])
+    # The commands App sends on start and boot, and their responses
+    writer.tx(encode_message(api, "system", "reset"), start)
+    writer.rx(encode_message(api, "system", "boot", event=True, major=major, minor=minor, patch=patch), start)
+    writer.rx(encode_message(api, "system", "get_identity_address", response=True,
+        address="00:0b:57:00:00:00"), start)
+    for command in ("set_parameters", "start"):
+        writer.rx(encode_message(api, "scanner", command, response=True), start)
+    for timestamp, raw in sim.generate(start + duration):
+        writer.rx(report_message(api, raw), timestamp)
+    writer.close()
+
+def count_reports(path, api):
+    """ Return the number of scanner report events in a capture. """
+    scanner = api["scanner"]
+    keys = {(api.device_id, scanner.index, scanner.events[name].index)
+            for name in ("legacy_advertisement_report", "extended_advertisement_report")}
+    chunks = ((timestamp, data) for timestamp, direction, data in read_capture(path) if direction == RX)
+    return sum(1 for _, message in split_messages(chunks) if message[0] & 0x80 and message_key(message) in keys)
+
+def report_timestamps(payload):
+    """ Return the scan timestamps of the reports in a published payload. """
+    payload = decompress(payload)
+    if payload[:4] == BATCH_MAGIC:
+        return [record[0] for _, record, _, _ in iter_records(payload)]
+    return [report['timestamp'] for report in json.loads(payload)]
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of sorted values. """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def rss_kb():
+    """ Return the resident set size of the process, None where it is unknown. """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def run_capture(name, path, offered, args):
+    """ Replay a capture through App, ReportQueue and aws_pipe and return the measurements. """
+    out_queue = queue_from_args(args)
+    # App puts its reports to the module level queue of ble_scan
+    ble_scan.bt_to_aws_queue = out_queue
+    connection = LocalMqttConnection(args.puback_delay)
+    pipe = aws_pipe(out_queue, mqtt_connection=connection, **pipe_kwargs_from_args(args))
+    replay = ReplayConnector(path, args.speed, apis=[BT_XAPI])
+    app = ble_scan.App(replay, pipe.get_thing_name(), encoding=args.encoding,
+        aggregate_window=args.aggregate_window)
+    if app.aggregator is not None:
+        pipe.aggregators = [app.aggregator]
+    rss_start = rss_kb()
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    pipe.start_pipe()
+    app.start()
+    replay.finished.wait()
+    # Dispatch what the receiver thread has queued before stopping the App
+    while app.pending_events():
+        time.sleep(0.01)
+    app.stop()
+    app.join()
+    pipe.disconnect()
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+    rss_end = rss_kb()
+
+    latencies = []
+    for publish_time, payload in connection.published:
+        latencies.extend(publish_time - timestamp for timestamp in report_timestamps(payload))
+    latencies.sort()
+    scanned = app.aggregator.reports_in if app.aggregator is not None else out_queue.enqueued + out_queue.dropped
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+    return {
+        'scenario': name,
+        'reports_offered': offered,
+        'reports_scanned': scanned,
+        'reports_published': len(latencies),
+        'messages': len(connection.published),
+        'payload_bytes': pipe.stats.payload_bytes,
+        'queue_dropped': out_queue.dropped,
+        'queue_high_water': out_queue.high_water,
+        # Reports of the capture that never reached the App, e.g. still queued when the replay ended
+        'reports_lost': offered - scanned,
+        'wall_s': round(wall, 3),
+        'reports_per_s': round(scanned / wall, 1) if wall else None,
+        'latency_p50_ms': ms(percentile(latencies, 0.50)),
+        'latency_p99_ms': ms(percentile(latencies, 0.99)),
+        'latency_max_ms': ms(latencies[-1] if latencies else None),
+        'cpu_ms_per_1k_reports': round(cpu * 1e6 / scanned, 3) if scanned else None,
+        'rss_start_kb': rss_start,
+        'rss_growth_kb': None if rss_start is None or rss_end is None else rss_end - rss_start,
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(
+                    prog = 'bench_pipeline',
+                    description = __doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_publish_arguments(parser)
+    add_queue_arguments(parser)
+    parser.add_argument('--scenarios', nargs='+', default=["office", "retail", "stadium"],
+        help=f"Built-in scenarios ({', '.join(SCENARIOS)}) or JSON files of Scenario arguments")
+    parser.add_argument('--capture', nargs='+', default=[],
+        help="Capture files recorded with --record, benchmarked in addition to the scenarios")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds of simulated time per scenario")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the simulations")
+    parser.add_argument('--speed', type=float, default=1.0,
+        help="Replay speed as a multiple of real time, 0 replays as fast as possible")
+    parser.add_argument('--aggregate_window', type=float, default=0,
+        help="Seconds to collapse identical reports of a device into one record, 0 disables aggregation")
+    parser.add_argument('--puback_delay', type=float, default=0.05,
+        help="Seconds until the local MQTT stand-in acknowledges a publish")
+    parser.add_argument('--output', default="bench_results.json", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    api = load_api(BT_XAPI)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = [(path, path) for path in args.capture]
+        for name in args.scenarios:
+            path = os.path.join(tmp, f"{os.path.basename(name)}.bgcp")
+            print(f"Generating {args.duration}s of scenario {name}")
+            write_scenario_capture(path, load_scenario(name), args.seed, args.duration, api)
+            runs.append((name, path))
+        for name, path in runs:
+            offered = count_reports(path, api)
+            print(f"Benchmarking {name}: {offered} reports")
+            result = run_capture(name, path, offered, args)
+            print(json.dumps(result))
+            results.append(result)
+
+    output = {
+        'version': RESULTS_VERSION,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'settings': vars(args),
+        'results': results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""
+Capture and replay of the raw byte stream between the host and an NCP.
+
+RecordingConnector wraps any connector returned by util.get_connector and
+writes every chunk read from and written to it, with a timestamp, to a
+capture file. ReplayConnector plays a capture file back to BGLib, events
+paced like in the recording, N times faster or as fast as possible.
+
+Capture file layout (little endian), gzip compressed if the name ends in .gz:
+    magic           4 bytes  b'BGCP'
+    version         uint8
+    start           float64  seconds since the epoch of the first record
+Followed by records of:
+    offset          float64  seconds since start
+    direction       uint8    0: received from the NCP, 1: sent to the NCP
+    length          uint16
+    data            length bytes
+Received chunks within COALESCE_GAP of the first one are merged into one record.
+"""
+
+import collections
+import gzip
+import logging
+import os.path
+import struct
+import threading
+import time
+
+from bgapi.connector import Connector
+from xapi_cache import load_apis
+
+CAPTURE_MAGIC = b'BGCP'
+CAPTURE_VERSION = 1
+FILE_HEADER = struct.Struct('<4sBd')
+RECORD_HEADER = struct.Struct('<dBH')
+RX = 0
+TX = 1
+COALESCE_GAP = 0.001
+# Largest record, keeps the length in a uint16
+MAX_RECORD = 0xFFFF
+
+# BGAPI message header, see bgapi.serdeser
+BGAPI_HEADER_LENGTH = 4
+BGAPI_EVENT = 0x80
+
+log = logging.getLogger(__name__)
+
+def open_capture(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class CaptureWriter:
+    """ Append timestamped chunks to a capture file. """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+        self._start = None
+        self._pending = bytearray()
+        self._pending_time = 0
+        self.records = 0
+
+    def _write_record(self, timestamp, direction, data):
+        if self._file is None:
+            if self._start is None:
+                self._file = open_capture(self.path, "wb")
+                self._start = timestamp
+                self._file.write(FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, timestamp))
+            else:
+                # Reopened connector, gzip appends a new member which reads back seamlessly
+                self._file = open_capture(self.path, "ab")
+        for pos in range(0, len(data), MAX_RECORD):
+            chunk = data[pos:pos + MAX_RECORD]
+            self._file.write(RECORD_HEADER.pack(timestamp - self._start, direction, len(chunk)))
+            self._file.write(chunk)
+            self.records += 1
+
+    def _flush_pending(self):
+        if self._pending:
+            self._write_record(self._pending_time, RX, bytes(self._pending))
+            self._pending.clear()
+
+    def rx(self, data, timestamp=None):
+        """ Record data received from the NCP. """
+        if not data:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            if self._pending and timestamp - self._pending_time > COALESCE_GAP:
+                self._flush_pending()
+            if not self._pending:
+                self._pending_time = timestamp
+            self._pending += data
+
+    def tx(self, data, timestamp=None):
+        """ Record data sent to the NCP. """
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            self._flush_pending()
+            self._write_record(timestamp, TX, bytes(data))
+
+    def close(self):
+        with self._lock:
+            self._flush_pending()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def read_capture(path):
+    """ Yield (timestamp, direction, data) records of a capture file. """
+    with open_capture(path, "rb") as f:
+        magic, version, start = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            raise ValueError(f"{path} is not a version {CAPTURE_VERSION} BGAPI capture")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            offset, direction, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                log.warning("%s is truncated", path)
+                return
+            yield start + offset, direction, data
+
+def split_messages(chunks):
+    """ Split (timestamp, data) chunks of a byte stream into (timestamp, message) BGAPI messages.
+
+    A message gets the timestamp of the chunk completing it.
+    """
+    buffer = bytearray()
+    for timestamp, data in chunks:
+        buffer += data
+        while len(buffer) >= BGAPI_HEADER_LENGTH:
+            length = BGAPI_HEADER_LENGTH + (((buffer[0] & 0x07) << 8) | buffer[1])
+            if len(buffer) < length:
+                break
+            yield timestamp, bytes(buffer[:length])
+            del buffer[:length]
+
+# struct codes of the fixed size BGAPI parameter formats
+PARAM_CODES = {
+    "int8": "b", "uint8": "B", "int16": "h", "uint16": "H",
+    "int32": "i", "uint32": "I", "int64": "q", "uint64": "Q",
+}
+# Fixed size byte string formats and their length
+PARAM_BYTES = {"uuid_128": 16, "aes_key_128": 16, "sl_bt_uuid_16_t": 2}
+
+def encode_params(params, values):
+    """ Serialize BGAPI parameters from a dict of values, missing ones are zero or empty. """
+    payload = bytearray()
+    for param in params:
+        value = values.get(param.name)
+        if param.format in PARAM_CODES:
+            payload += struct.pack("<" + PARAM_CODES[param.format], value or 0)
+        elif param.format == "bd_addr":
+            payload += bytes.fromhex((value or "00:00:00:00:00:00").replace(":", ""))[::-1]
+        elif param.format == "uint8array":
+            payload += bytes((len(value or b""),)) + bytes(value or b"")
+        elif param.format == "uint16array":
+            payload += struct.pack("<H", len(value or b"")) + bytes(value or b"")
+        elif param.format in PARAM_BYTES:
+            payload += bytes(value or b"").ljust(PARAM_BYTES[param.format], b"\0")
+        else:
+            raise ValueError(f"Can't encode {param.format} parameter {param.name}")
+    return bytes(payload)
+
+def encode_message(api, class_name, name, event=False, response=False, **values):
+    """ Return the bytes of a BGAPI event, command or command response, e.g. to build a capture. """
+    api_class = api[class_name]
+    if event:
+        node = api_class.events[name]
+        params = node.params
+    else:
+        node = api_class.commands[name]
+        params = node.returns if response else node.params
+    payload = encode_params(params, values)
+    return bytes((
+        (BGAPI_EVENT if event else 0) | (api.device_id << 3) | (len(payload) >> 8),
+        len(payload) & 0xFF, api_class.index, node.index)) + payload
+
+def message_key(message):
+    """ Return (device id, class, command) of a BGAPI message. """
+    return ((message[0] & 0x78) >> 3, message[2], message[3])
+
+class RecordingConnector(Connector):
+    """ Pass-through connector writing all traffic to a capture file. """
+    def __init__(self, connector, path):
+        self.wrapped = connector
+        self.writer = CaptureWriter(path)
+
+    def __getattr__(self, name):
+        # Connector specific attributes, e.g. reset_listeners of SerialConnectorCPC
+        return getattr(self.wrapped, name)
+
+    def open(self):
+        self.wrapped.open()
+
+    def close(self):
+        self.wrapped.close()
+        self.writer.close()
+
+    def write(self, data):
+        self.writer.tx(data)
+        self.wrapped.write(data)
+
+    def read(self, size=1):
+        data = self.wrapped.read(size)
+        self.writer.rx(data)
+        return data
+
+    def set_read_timeout(self, timeout):
+        self.wrapped.set_read_timeout(timeout)
+
+    def set_write_timeout(self, timeout):
+        self.wrapped.set_write_timeout(timeout)
+
+class ReplayConnector(Connector):
+    """ Connector playing back the NCP side of a capture file.
+
+    Events are delivered at their recorded time relative to the first one,
+    divided by speed, or without delay if speed is 0. Command responses are
+    not replayed in stream order but as the answer to the next write of the
+    same command. Commands without a recorded response get a success
+    response with zero return values, built from apis (XAPI paths or
+    ParsedApis), unless the recording shows that they have none, e.g.
+    system.reset. finished is set once the last event has been read.
+    """
+    def __init__(self, path, speed=1.0, apis=()):
+        self.path = path
+        self.speed = speed
+        self.apis = {api.device_id: api for api in load_apis(list(apis))}
+        self.events = []
+        self.responses = collections.defaultdict(collections.deque)
+        self.silent_commands = set()
+        self._load()
+        self.finished = threading.Event()
+        self._cond = threading.Condition()
+        self._read_timeout = None
+        self._buffer = bytearray()
+        self._urgent = bytearray()
+        self._next = 0
+        self._wall_start = None
+
+    def _load(self):
+        rx = []
+        sent = []
+        answered = set()
+        for timestamp, direction, data in read_capture(self.path):
+            if direction == RX:
+                rx.append((timestamp, data))
+            else:
+                sent.extend(message_key(message) for _, message in split_messages([(timestamp, data)]))
+        for timestamp, message in split_messages(rx):
+            if message[0] & BGAPI_EVENT:
+                self.events.append((timestamp, message))
+            else:
+                key = message_key(message)
+                self.responses[key].append(message)
+                answered.add(key)
+        self.silent_commands = set(sent) - answered
+        self.first_event = self.events[0][0] if self.events else 0
+
+    def open(self):
+        with self._cond:
+            self._buffer.clear()
+            self._urgent.clear()
+
+    def close(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def write(self, data):
+        responses = []
+        for _, message in split_messages([(0, data)]):
+            key = message_key(message)
+            if self.responses[key]:
+                responses.append(self.responses[key].popleft())
+            elif key not in self.silent_commands:
+                responses.append(self.synthesize_response(key))
+        if responses:
+            with self._cond:
+                for response in responses:
+                    self._urgent += response
+                self._cond.notify_all()
+
+    def synthesize_response(self, key):
+        """ Return a success response to a command, all return values zero. """
+        device_id, class_index, command_index = key
+        try:
+            api = self.apis[device_id]
+            api_class = api[class_index]
+            command = api_class.commands[command_index]
+        except KeyError:
+            # Unknown API, a result code only, BGLib fills the missing return values with None
+            return bytes((device_id << 3, 2, class_index, command_index, 0, 0))
+        return encode_message(api, api_class.name, command.name, response=True)
+
+    def read(self, size=1):
+        with self._cond:
+            deadline = None if self._read_timeout is None else time.monotonic() + self._read_timeout
+            while not self._urgent and not self._buffer:
+                if self._next >= len(self.events):
+                    self.finished.set()
+                    wait = None
+                else:
+                    if self._wall_start is None:
+                        self._wall_start = time.monotonic()
+                    timestamp, message = self.events[self._next]
+                    due = 0 if self.speed <= 0 else \
+                        self._wall_start + (timestamp - self.first_event) / self.speed - time.monotonic()
+                    if due <= 0:
+                        self._buffer += message
+                        self._next += 1
+                        break
+                    wait = due
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return bytes()
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+            # A response is never inserted into the middle of an event
+            source = self._buffer if self._buffer else self._urgent
+            data = bytes(source[:size])
+            del source[:size]
+            return data
+
+    def set_read_timeout(self, timeout):
+        self._read_timeout = timeout
+
+    def set_write_timeout(self, timeout):
+        pass
+
+def capture_path(path, index, count):
+    """ Return the capture file of connection index, numbered if there is more than one. """
+    if count == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    if ext == ".gz":
+        root, inner = os.path.splitext(root)
+        ext = inner + ext
+    return f"{root}.{index}{ext}"
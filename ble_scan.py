@@ -1,159 +1,195 @@
 import argparse
-import queue
+import asyncio
+import concurrent.futures
 import time
 
-from util import BluetoothApp, ArgumentParser, get_connector
-from aws_iot import aws_pipe
-
-#Reference Bluetooth Specification Assigned Numbers Doc, Common Data Types Section
-BT_COMMON_DATA_TYPES_LOOKUP = {
-    0x01: 'FLAGS',
-    0x02: 'INCOMPLETE_LIST_OF_16-BIT_SERVICE_CLASS_UUIDS',
-    0x03: 'COMPLETE_LIST_OF_16-BIT_SERVICE_CLASS_UUIDS',
-    0x04: 'INCOMPLETE_LIST_OF_32-BIT_SERVICE_CLASS_UUIDS',
-    0x05: 'COMPLETE_LIST_OF_32-BIT_SERVICE_CLASS_UUIDS',
-    0x06: 'INCOMPLETE_LIST_OF_128-BIT_SERVICE_CLASS_UUIDS',
-    0x07: 'COMPLETE_LIST_OF_128-BIT_SERVICE_CLASS_UUIDS',
-    0x08: 'SHORTENED_LOCAL_NAME',
-    0x09: 'COMPLETE_LOCAL_NAME',
-    0x0A: 'TX_POWER_LEVEL',
-    0x0D: 'CLASS_OF_DEVICE',
-    0x0E: 'SIMPLE_PAIRING_HASH_C-192',
-    0x0F: 'SIMPLE_PAIRING_RANDOMIZER_R-192',
-    0x10: 'DEVICE_ID', #Also listed as Security Manager TK Value
-    0x11: 'SECURITY_MANAGER_OUT_OF_BAND_FLAGS',
-    0x12: 'SLAVE_CONNECTION_INTERVAL_RANGE',
-    0x14: 'LIST_OF_16-BIT_SERVICE_SOLICITATION_UUIDS',
-    0x15: 'LIST_OF_128-BIT_SERVICE_SOLICITATION_UUIDS',
-    0x16: 'SERVICE_DATA_16-BIT_UUID',
-    0x17: 'PUBLIC_TARGET_ADDRESS',
-    0x18: 'RANDOM_TARGET_ADDRESS',
-    0x19: 'APPEARANCE',
-    0x1A: 'ADVERTISING_INTERVAL',
-    0x1B: 'LE_BLUETOOTH_DEVICE_ADDRESS',
-    0x1C: 'LE_ROLE',
-    0x1D: 'SIMPLE_PAIRING_HASH_C-256',
-    0x1E: 'SIMPLE_PAIRING_RANDOMIZER_R-256',
-    0x1F: 'LIST_OF_32-BIT_SERVICE_SOLICITATION_UUIDS',
-    0x20: 'SERVICE_DATA_32-BIT_UUID',
-    0x21: 'SERVICE_DATA_128-BIT_UUID',
-    0x22: 'LE_SECURE_CONNECTIONS_CONFIRMATION_VALUE',
-    0x23: 'LE_SECURE_CONNECTIONS_RANDOM_VALUE',
-    0x24: 'URI',
-    0x25: 'INDOOR_POSITIONING',
-    0x26: 'TRANSPORT_DISCOVERY_DATA',
-    0x27: 'LE_SUPPORTED_FEATURES',
-    0x28: 'CHANNEL_MAP_UPDATE_INDICATION',
-    0x29: 'PB-ADV',
-    0x2A: 'MESH_MESSAGE',
-    0x2B: 'MESH_BEACON',
-    0x2C: 'BIGINFO',
-    0x2D: 'BROADCAST_CODE',
-    0x2E: 'RESOLVABLE_SET_IDENTIFIER',
-    0x2F: 'ADVERTISING_INTERVAL_LONG',
-    0x30: 'BROADCAST_NAME',
-    0x3D: '3D_INFORMATION',
-    0xFF: 'MANUFACTURER_SPECIFIC_DATA'
-}
-
-BT_COMMON_DATA_TYPES_STR = [0x08, 0x09]
-
-def parse_adv_data(adv_data):
-    i = 0
-    adv_data_dict = {}
-    while i < len(adv_data):
-        ad_field_length = adv_data[i]
-        ad_field_type = adv_data[i + 1]
-        ad_data = adv_data[i + 2: i + 1 + ad_field_length]
-        try:
-            ad_field_name = BT_COMMON_DATA_TYPES_LOOKUP[ad_field_type]
-            if ad_field_type in BT_COMMON_DATA_TYPES_STR:
-                adv_data_dict[ad_field_name] = ad_data.decode('utf-8')
-            else:
-                adv_data_dict[ad_field_name] = '0x' + ad_data.hex().upper()
-                #adv_data_dict[ad_field_name] = base64.b64encode(ad_data).decode('utf-8')
-        except KeyError:
-            #adv_data_dict[ad_field_type] = base64.b64encode(ad_data).decode('utf-8')
-            adv_data_dict[ad_field_type] = '0x' + ad_data.hex().upper()
+import bgapi
 
-        i += ad_field_length + 1
-    return adv_data_dict
+from util import BluetoothApp, ArgumentParser, get_connector, handles
+from aws_iot import aws_pipe, add_publish_arguments, pipe_kwargs_from_args
+from reports import encode_report, raw_report, EXTENDED_REPORT
+from aggregator import ReportAggregator
+from report_queue import ReportQueue, add_queue_arguments, queue_from_args
+from async_pipeline import AsyncPipeline
+from sharded_pipeline import ShardedPipeline
+from scan_filter import ScanFilter, add_filter_arguments, filter_from_args
+from scan_tuning import ScanTuner, SCAN_PHYS
+from metrics import PARSE_BUCKETS, add_metrics_arguments, metrics_from_args, server_from_args
 
-bt_to_aws_queue = queue.Queue()
+bt_to_aws_queue = ReportQueue()
 
 class App(BluetoothApp):
     """ Application derived from generic BluetoothApp. """
-    def __init__(self, connector, thing_name):
+    # Commands are created for these classes only
+    BGAPI_CLASSES = {"bt": ("system", "gap", "advertiser", "scanner", "sync", "connection")}
+
+    def __init__(self, connector, thing_name, encoding="json", aggregate_window=0, radio_id=0, scan_phy=1,
+                 sharder=None, scan_filter=None):
         self.thing_name = thing_name
+        self.encoding = encoding
+        # Index of the radio in multi-radio mode, reported with every advertisement
+        self.radio_id = radio_id
+        self.scan_phy = scan_phy
+        # scanner.set_parameters values, time in units of 0.625ms, see scan_tuning
+        self.scan_mode = 1
+        self.scan_interval = 16000
+        self.scan_window = 1600
+        self.scanning = False
+        if scan_filter is None:
+            scan_filter = ScanFilter()
+        self.discover_mode = scan_filter.discover_mode_value
+        # Host side part of the filter, None if it accepts everything
+        self.report_filter = scan_filter if scan_filter.active else None
+        # Addresses loaded into the controller accept list on boot, the host check stays as a fallback
+        self.accept_list = sorted(scan_filter.addresses)
+        if self.accept_list:
+            # The accept list is filled with a command of the security manager
+            self.BGAPI_CLASSES = {"bt": self.BGAPI_CLASSES["bt"] + ("sm",)}
+        # Optional ShardedPipeline doing the parsing and aggregation in worker processes
+        self.sharder = sharder
+        self.aggregator = None
+        # metrics.Histogram of the time spent per report, None unless register_metrics was called
+        self.parse_time = None
+        if aggregate_window > 0:
+            self.aggregator = ReportAggregator(bt_to_aws_queue, self.encode_report, aggregate_window)
         super().__init__(connector=connector)
-    def event_handler(self, evt):
-        """ Override default event handler of the parent class. """
-        # This event indicates the device has started and the radio is ready.
-        # Do not call any stack command before receiving this boot event!
-        if evt == "bt_evt_system_boot":
-            self.adv_handle = None
-            print("BT system boot")
-            #self.gattdb_init()
-            #self.adv_start()
-            self.scan_start()
-
-        # This event indicates that a new connection was opened.
-        elif evt == "bt_evt_connection_opened":
-            print("Connection opened")
-
-        # This event indicates that a connection was closed.
-        elif evt == "bt_evt_connection_closed":
-            print("Connection closed")
-            self.adv_start()
-
-        elif evt == "bt_evt_scanner_legacy_advertisement_report" or evt == "bt_evt_scanner_extended_advertisement_report":
-            adv_data = parse_adv_data(evt.data)
-            # scanner_thing_name is fixed based on MQTT CLIENT_ID which must be the same as the Thing name
-            # found in aws_cert_path.py and imported by aws_iot.py
-            adv_data['scanner_thing_name'] = self.thing_name
-            adv_data['timestamp'] = time.time()
-            adv_data['DATETIME'] = time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime(adv_data['timestamp']))
-            adv_data['PDU'] = 'LEGACY' if evt == "bt_evt_scanner_legacy_advertisement_report" else 'EXTENDED'
-            adv_data['CONNECTABLE'] = True if evt.event_flags & 1 else False
-            adv_data['SCANNABLE'] = True if evt.event_flags & 2 else False
-            adv_data['DIRECTED'] = True if evt.event_flags & 4 else False
-            adv_data['SCAN_RESPONSE'] = True if evt.event_flags & 8 else False
-            adv_data['ADDRESS'] = evt.address
-            if evt.address_type == 0:
-                adv_data['ADDRESS_TYPE'] = 'PUBLIC'
-            elif evt.address_type == 1:
-                adv_data['ADDRESS_TYPE'] = 'RANDOM'
-            else:
-                adv_data['ADDRESS_TYPE'] = 'DECODE_ERROR'
-            if evt == "bt_evt_scanner_extended_advertisement_report":
-                adv_data['ADV_SID'] = evt.adv_sid
-                if evt.tx_power == 127:
-                    adv_data['TX_POWER'] = 'INFORMATION_UNAVAILABLE'
-                else:
-                    adv_data['TX_POWER'] = evt.tx_power
-                adv_data['RSSI'] = evt.rssi
-                adv_data['CHANNEL'] = evt.channel
-                adv_data['PERIODIC_INTERVAL'] = evt.periodic_interval * 1.25 #units of ms
-            bt_to_aws_queue.put(adv_data)
-            #print(evt)
-            #print(adv_data)
-            #print(f"Scan Report\n\tAddress: {evt.address}\n\tLong Name: {complete_local_name}\n\tShort Name: {short_local_name}")
-
-        ####################################
-        # Add further event handlers here. #
-        ####################################
+
+    # This event indicates the device has started and the radio is ready.
+    # Do not call any stack command before receiving this boot event!
+    @handles("bt_evt_system_boot")
+    def on_system_boot(self, evt):
+        self.adv_handle = None
+        self.scanning = False
+        print("BT system boot")
+        #self.gattdb_init()
+        #self.adv_start()
+        self.scan_start()
+
+    # This event indicates that a new connection was opened.
+    @handles("bt_evt_connection_opened")
+    def on_connection_opened(self, evt):
+        print("Connection opened")
+
+    # This event indicates that a connection was closed.
+    @handles("bt_evt_connection_closed")
+    def on_connection_closed(self, evt):
+        print("Connection closed")
+        self.adv_start()
+
+    @handles("bt_evt_scanner_legacy_advertisement_report", "bt_evt_scanner_extended_advertisement_report")
+    def on_scan_report(self, evt):
+        parse_time = self.parse_time
+        if parse_time is not None:
+            started = time.perf_counter()
+        if self.report_filter is not None and not self.report_filter(evt):
+            return
+        timestamp = time.time()
+        if self.sharder is not None:
+            self.sharder.submit(raw_report(evt, self.radio_id), timestamp)
+        elif self.aggregator is not None:
+            self.aggregator.add(evt, timestamp)
+        else:
+            bt_to_aws_queue.put(self.encode_report(evt, timestamp))
+        if parse_time is not None:
+            parse_time.observe(time.perf_counter() - started)
+        #print(evt)
+        #print(f"Scan Report\n\tAddress: {evt.address}\n\tLong Name: {complete_local_name}\n\tShort Name: {short_local_name}")
+
+    ####################################
+    # Add further event handlers here. #
+    ####################################
+
+    def register_metrics(self, registry):
+        """ Add the report processing time and the aggregation counters to the generic metrics. """
+        super().register_metrics(registry)
+        self.parse_time = registry.histogram("report_parse_seconds",
+            "Time to filter, parse and queue one scanner report passing the filter", buckets=PARSE_BUCKETS)
+        if self.aggregator is not None:
+            aggregator = self.aggregator
+            registry.counter("aggregator_reports_total", "Scanner reports added to the aggregator", ("radio",),
+                callback=lambda: {(self.radio_id,): aggregator.reports_in})
+            registry.counter("aggregator_records_total", "Aggregated records queued for upload", ("radio",),
+                callback=lambda: {(self.radio_id,): aggregator.records_out})
+
+    def encode_report(self, evt, timestamp, aggregate=None):
+        """ Encode an advertisement report event for the aws_pipe queue. """
+        return encode_report(evt, evt == EXTENDED_REPORT, timestamp, self.thing_name,
+            self.radio_id, self.encoding, aggregate)
 
     def scan_start(self):
         """ Start scanning. """
-        """ 1M PHY, 10ms scan interval, 10ms scan window, time in units of 0.625ms """
-        #self.lib.bt.scanner.set_timing(1, 16000, 1600)
-        #self.lib.bt.scanner.set_timing(1, 16, 16)
-        """ 1M PHY, active scanning, which will ask make scan request """
-        #self.lib.bt.scanner.set_mode(1,1)
-        self.lib.bt.scanner.set_parameters(1, 16000, 1600)
-        """ Scan on 1M PHY, both limited and general discoverable """
-        self.lib.bt.scanner.start(1,1)
-        
+        """ Active scanning by default, 10s scan interval, 1s scan window """
+        self.lib.bt.scanner.set_parameters(self.scan_mode, self.scan_interval, self.scan_window)
+        if self.accept_list:
+            self.enable_accept_list()
+        """ Scan on the PHY assigned to this radio, the discover mode filters in the controller """
+        self.lib.bt.scanner.start(self.scan_phy, self.discover_mode)
+        self.scanning = True
+
+    def enable_accept_list(self):
+        """ Let the controller report the allowed addresses only, the list is empty after a reset. """
+        try:
+            for address in self.accept_list:
+                # The options don't carry the address type, public and static random entries are added
+                for address_type in (0, 1):
+                    self.lib.bt.sm.add_to_whitelist(address, address_type)
+            # Takes effect when the scanner is started
+            self.lib.bt.gap.enable_whitelisting(1)
+        except bgapi.bglib.CommandFailedError as err:
+            # E.g. more addresses than the controller list holds
+            self.log.warning("Controller accept list not applied: %s, addresses are filtered on the host", err)
+
+    def apply_scan_settings(self, mode=None, interval=None, window=None, phy=None, timeout=5):
+        """ Change the scanner parameters, restarting the scanner if it is running.
+
+        Called from other threads, the commands go through the command pipeline.
+        The previous values are kept if a command fails, and the scanner is
+        restarted with them if it was stopped. If that fails too, scanning is
+        cleared.
+        """
+        previous = (self.scan_mode, self.scan_interval, self.scan_window, self.scan_phy)
+        if mode is not None:
+            self.scan_mode = mode
+        if interval is not None:
+            self.scan_interval = interval
+        if window is not None:
+            self.scan_window = window
+        if phy is not None:
+            self.scan_phy = phy
+        if not self.scanning:
+            # Picked up by scan_start on boot
+            return
+        futures = self.commands.submit_all([
+            (self.lib.bt.scanner.stop, ()),
+            (self.lib.bt.scanner.set_parameters, (self.scan_mode, self.scan_interval, self.scan_window)),
+            (self.lib.bt.scanner.start, (self.scan_phy, self.discover_mode)),
+        ])
+        try:
+            self.commands.gather(futures, timeout)
+        except Exception:
+            self.scan_mode, self.scan_interval, self.scan_window, self.scan_phy = previous
+            self.restore_scanner(futures, timeout)
+            raise
+
+    def restore_scanner(self, futures, timeout):
+        """ Restart the scanner with the current settings if a failed stop, set_parameters, start left it stopped. """
+        # The commands are independent, the ones still queued after a timeout are dropped
+        for future in futures:
+            future.cancel()
+        concurrent.futures.wait(futures, timeout)
+        stopped, _, started = (future.done() and not future.cancelled() and future.exception() is None
+                               for future in futures)
+        if not stopped or started:
+            return
+        try:
+            self.commands.gather(self.commands.submit_all([
+                (self.lib.bt.scanner.set_parameters, (self.scan_mode, self.scan_interval, self.scan_window)),
+                (self.lib.bt.scanner.start, (self.scan_phy, self.discover_mode)),
+            ]), timeout)
+        except Exception as err:
+            self.scanning = False
+            self.log.error("Scanner left stopped, restarting it with the previous settings failed: %s", err)
+
     def adv_start(self):
         """ Start advertising. """
         if self.adv_handle is None:
@@ -172,14 +208,119 @@ class App(BluetoothApp):
             self.lib.bt.advertiser.CONNECTION_MODE_CONNECTABLE_SCANNABLE)
 
 # Script entry point.
+def run_apps(apps):
+    """ Run one App per radio in its own thread until all of them terminate. """
+    for app in apps:
+        app.start()
+    try:
+        for app in apps:
+            # join without timeout can't be interrupted by KeyboardInterrupt on all hosts
+            while app.is_alive():
+                app.join(1)
+    except KeyboardInterrupt:
+        print("User interrupt")
+        for app in apps:
+            app.stop()
+        for app in apps:
+            app.join()
+
 if __name__ =="__main__":
-    ap = aws_pipe(bt_to_aws_queue)
-    ap.start_pipe()
-    parser = ArgumentParser(description=__doc__)
+    # Multi mode accepts one or more connections, each one is driven by its own App.
+    parser = ArgumentParser(description=__doc__, single_mode=False)
+    add_publish_arguments(parser)
+    add_queue_arguments(parser)
+    add_filter_arguments(parser)
+    add_metrics_arguments(parser)
+    parser.add_argument(
+        "--aggregate_window",
+        type=float,
+        help="Seconds to collapse identical reports of a device into one record, 0 disables aggregation",
+        default=0)
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="Run the scan, process and publish stages on an asyncio event loop")
+    parser.add_argument(
+        "--scan_phy",
+        nargs="+",
+        choices=SCAN_PHYS.keys(),
+        help="Scanning PHY per radio in connection order, the last one applies to the remaining radios",
+        default=["1m"])
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes parsing, aggregating and encoding reports, 0 does it in the scanner thread",
+        default=0)
+    parser.add_argument(
+        "--shadow",
+        action="store_true",
+        help="Apply scan and publish settings from the desired state of the device shadow")
     args = parser.parse_args()
-    connector = get_connector(args)
-    # Instantiate the application.
-    app = App(connector, ap.get_thing_name())
-    # Running the application blocks execution until it terminates.
-    app.run()
-    ap.disconnect()
+    if args.workers and args.asyncio:
+        parser.error("--workers can't be combined with --asyncio")
+    if args.spool and args.asyncio:
+        parser.error("--spool can't be combined with --asyncio")
+    bt_to_aws_queue = queue_from_args(args)
+    scan_filter = filter_from_args(args)
+    ap = aws_pipe(bt_to_aws_queue, **pipe_kwargs_from_args(args))
+    sharder = None
+    aggregate_window = args.aggregate_window
+    if args.workers > 0:
+        # Aggregation moves to the workers together with the rest of the per report work
+        sharder = ShardedPipeline(args.workers, bt_to_aws_queue, ap.get_thing_name(),
+            encoding=args.encoding, aggregate_window=aggregate_window)
+        aggregate_window = 0
+    connectors = get_connector(args)
+    # Instantiate one application per radio, all of them feed the same queue.
+    apps = []
+    for radio_id, connector in enumerate(connectors):
+        scan_phy = args.scan_phy[min(radio_id, len(args.scan_phy) - 1)]
+        apps.append(App(connector, ap.get_thing_name(), encoding=args.encoding,
+            aggregate_window=aggregate_window, radio_id=radio_id, scan_phy=SCAN_PHYS[scan_phy],
+            sharder=sharder, scan_filter=scan_filter))
+    ap.aggregators = [app.aggregator for app in apps if app.aggregator is not None]
+    if sharder is not None:
+        # flush(force=True) on disconnect waits for the workers to return their reports
+        ap.aggregators.append(sharder)
+    if args.shadow:
+        ap.start_shadow(ScanTuner(apps, ap).apply)
+    # None unless --metrics_port or --metrics_period is given, nothing is instrumented then
+    registry = metrics_from_args(args)
+    metrics_server = None
+    pipeline = None
+    if args.asyncio:
+        pipeline = AsyncPipeline(apps, ap, queue_size=args.queue_size,
+            report_filter=scan_filter if scan_filter.active else None)
+    if registry is not None:
+        bt_to_aws_queue.register_metrics(registry)
+        scan_filter.register_metrics(registry)
+        ap.register_metrics(registry)
+        for app in apps:
+            app.register_metrics(registry)
+        if sharder is not None:
+            sharder.register_metrics(registry)
+        if pipeline is not None:
+            pipeline.register_metrics(registry)
+        metrics_server = server_from_args(registry, args)
+        if args.metrics_period > 0:
+            ap.start_metrics(registry, args.metrics_period)
+    try:
+        if pipeline is not None:
+            try:
+                asyncio.run(pipeline.run())
+            except KeyboardInterrupt:
+                pass
+        elif len(apps) == 1:
+            ap.start_pipe()
+            # Running the application blocks execution until it terminates.
+            apps[0].run()
+        else:
+            ap.start_pipe()
+            run_apps(apps)
+    finally:
+        # GenericApp.run ends with sys.exit, the queued reports are flushed before the process exits
+        ap.disconnect()
+        if sharder is not None:
+            sharder.close()
+        if metrics_server is not None:
+            metrics_server.close()
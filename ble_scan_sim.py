@@ -1,40 +1,151 @@
+"""
+Feed simulated BLE advertisements into the report pipeline.
+
+The scenario is the name of one of the built-in sim_scenarios.SCENARIOS or
+a JSON file with Scenario arguments. Reports take the same path as in
+ble_scan: encoded in this process with the selected encoding (dicts for
+json, report_codec records for binary), optionally aggregated, or, with
+--workers, as RawReports through a ShardedPipeline. --no_aws replaces the
+MQTT publisher with a local drain that prints the throughput.
+"""
+
 import argparse
-import queue
 import time
-import random
 
-from aws_iot import aws_pipe
+try:
+    from aws_iot import aws_pipe, add_publish_arguments, pipe_kwargs_from_args
+except ImportError:
+    # awscrt or awsiot is not installed, only --no_aws works
+    aws_pipe = None
+from aggregator import ReportAggregator
+from periodic_timer import PeriodicTimer
+from reports import encode_report, serialize_report
+from report_queue import ReportQueue, add_queue_arguments, queue_from_args
+from sharded_pipeline import ShardedPipeline
+from sim_scenarios import AdvertiserSim, SCENARIOS, load_scenario
+
+bt_to_aws_queue = ReportQueue()
+
+THING_NAME = 'scanner_sim_1'
+
+class LocalDrain:
+    """ Stand-in for aws_pipe that empties the queue and counts what would have been published. """
+    def __init__(self, bt_to_aws_queue, flush_period=1, aggregators=()):
+        self.bt_to_aws_queue = bt_to_aws_queue
+        self.flush_period = flush_period
+        self.aggregators = list(aggregators)
+        self.reports = 0
+        self.payload_bytes = 0
+        self.t = None
+
+    def get_thing_name(self):
+        return THING_NAME
+
+    def flush(self, evt_queue, force=False):
+        for aggregator in self.aggregators:
+            aggregator.flush(force)
+        reports = 0
+        while not evt_queue.empty():
+            self.payload_bytes += len(serialize_report(evt_queue.get(block=False)))
+            reports += 1
+        self.reports += reports
+        if reports:
+            print(f"Drained {reports} reports, total reports={self.reports} bytes={self.payload_bytes}")
 
-bt_to_aws_queue = queue.Queue()
+    def start_pipe(self):
+        self.t = PeriodicTimer(self.flush_period, self.flush, [self.bt_to_aws_queue])
+        self.t.start()
 
-def sim_one_advertiser():
+    def disconnect(self):
+        if self.t is not None:
+            self.t.stop()
+        self.flush(self.bt_to_aws_queue, force=True)
+
+def sim_scenario(sim, sink, duration=None, speed=1.0):
+    """ Run a simulation until duration or a keyboard interrupt and print the report rate. """
+    wall_start = time.monotonic()
     try:
-        while True:
-            adv_data = {}
-            adv_data['scanner_thing_name'] = 'scanner_sim_1'
-            adv_data['timestamp'] = time.time()
-            adv_data['DATETIME'] = time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime(adv_data['timestamp']))
-            adv_data['COMPLETE_LOCAL_NAME'] = 'one_advertiser_name'
-            adv_data['RSSI'] = -60 + random.randint(-100,100)*0.1
-            bt_to_aws_queue.put(adv_data)
-            print("Added event")
-            time.sleep(1)
+        reports = sim.run(sink, duration, speed)
     except KeyboardInterrupt:
         print('\r\nInterrupted, exitting')
+        reports = sim.reports
+    elapsed = time.monotonic() - wall_start
+    print(f"Simulated {reports} reports in {elapsed:.1f}s ({reports / max(elapsed, 1e-9):.0f} reports/s), "
+          f"{sim.arrivals} devices seen, {sim.departures} departed")
 
-def main():
-    ap = aws_pipe(bt_to_aws_queue)
-    ap.start_pipe()
+def make_sink(out_queue, encoding, aggregator=None, sharder=None):
+    """ Return sink(raw, timestamp) feeding the same stages as App.on_scan_report. """
+    if sharder is not None:
+        return sharder.submit
+    if aggregator is not None:
+        return aggregator.add
+    def sink(raw, timestamp):
+        out_queue.put(encode_report(raw, raw.extended, timestamp, THING_NAME, raw.radio, encoding))
+    return sink
 
+def main():
+    global bt_to_aws_queue
     parser = argparse.ArgumentParser(
                     prog = 'ble_scan_sim',
                     description = 'Simulated receiving BLE advertisements')
-    parser.add_argument('scenario')
+    parser.add_argument('scenario', help=f"One of {', '.join(SCENARIOS)} or a JSON file of Scenario arguments")
+    if aws_pipe is not None:
+        add_publish_arguments(parser)
+    else:
+        parser.add_argument("--flush_period", type=float, default=1)
+        parser.add_argument("--encoding", choices=("json", "binary"), default="json")
+    add_queue_arguments(parser)
+    parser.add_argument('--seed', type=int, help="Seed of the simulation, equal seeds give equal reports", default=0)
+    parser.add_argument('--devices', type=int, help="Override the number of devices of the scenario")
+    parser.add_argument('--churn', type=float, help="Override the fraction of devices replaced per second")
+    parser.add_argument('--radios', type=int, help="Override the number of simulated radios")
+    parser.add_argument('--duration', type=float, help="Seconds of simulated time, run until interrupted by default")
+    parser.add_argument(
+        '--speed',
+        type=float,
+        help="Simulated seconds per real second, 0 generates reports as fast as possible",
+        default=1.0)
+    parser.add_argument(
+        "--aggregate_window",
+        type=float,
+        help="Seconds to collapse identical reports of a device into one record, 0 disables aggregation",
+        default=0)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes parsing, aggregating and encoding reports, 0 does it in the simulator thread",
+        default=0)
+    parser.add_argument('--no_aws', action='store_true', help="Drain the queue locally instead of publishing")
     args = parser.parse_args()
-    if args.scenario == "one_advertiser":
-        sim_one_advertiser()
+    if aws_pipe is None and not args.no_aws:
+        parser.error("aws_iot can't be imported, use --no_aws")
+    scenario = load_scenario(args.scenario, devices=args.devices, churn=args.churn, radios=args.radios)
+    bt_to_aws_queue = queue_from_args(args)
+
+    if args.no_aws:
+        ap = LocalDrain(bt_to_aws_queue, args.flush_period)
+    else:
+        ap = aws_pipe(bt_to_aws_queue, **pipe_kwargs_from_args(args))
+    aggregator = None
+    sharder = None
+    if args.workers > 0:
+        sharder = ShardedPipeline(args.workers, bt_to_aws_queue, THING_NAME,
+            encoding=args.encoding, aggregate_window=args.aggregate_window)
+        ap.aggregators.append(sharder)
+    elif args.aggregate_window > 0:
+        aggregator = ReportAggregator(bt_to_aws_queue,
+            lambda raw, timestamp, aggregate: encode_report(raw, raw.extended, timestamp, THING_NAME,
+                raw.radio, args.encoding, aggregate),
+            args.aggregate_window)
+        ap.aggregators.append(aggregator)
+    print(f"Simulating {scenario.devices} devices, about {scenario.mean_rate:.0f} reports/s")
+    ap.start_pipe()
+    sim_scenario(AdvertiserSim(scenario, args.seed), make_sink(bt_to_aws_queue, args.encoding, aggregator, sharder),
+        args.duration, args.speed)
 
     ap.disconnect()
+    if sharder is not None:
+        sharder.close()
 
 if __name__ =="__main__":
-    main()
\ No newline at end of file
+    main()
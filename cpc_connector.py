@@ -20,81 +20,358 @@
 #    misrepresented as being the original software.
 # 3. This notice may not be removed or altered from any source distribution.
 
+import collections
+import contextlib
+import logging
+import threading
+import time
 from bgapi.connector import Connector, ConnectorException
 import libcpc_wrapper as lcw
 
+# Receive buffer size, a multiple of the largest CPC frame
+READ_BUFF_SIZE = 4 * lcw.SL_CPC_READ_MINIMUM_SIZE
+
+# Endpoint events after which the endpoint can't be used any more
+ERROR_EVENTS = (
+    lcw.Event.ENDPOINT_CLOSED,
+    lcw.Event.ENDPOINT_ERROR_DESTINATION_UNREACHABLE,
+    lcw.Event.ENDPOINT_ERROR_SECURITY_INCIDENT,
+    lcw.Event.ENDPOINT_ERROR_FAULT)
+
+# Name of the event delivered to the reset listeners of a connector after recovery
+RESET_EVENT = "cpc_evt_endpoint_reset"
+
+class ResetEvent:
+    """ Event compatible object describing a completed recovery """
+    _str = RESET_EVENT
+
+    def __init__(self, downtime, attempts):
+        self.downtime = downtime
+        self.attempts = attempts
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return self._str == other
+        return self is other
+
+    __hash__ = object.__hash__
+
+    def __str__(self):
+        return "{}(downtime={:.3f}, attempts={})".format(self._str, self.downtime, self.attempts)
+
+class ResetSupervisor(threading.Thread):
+    """ Recover a SerialConnectorCPC after a reset of the secondary.
+
+    A reset is requested by the SIGUSR1 handler of libcpc or by a failed
+    read. The supervisor quiesces reads and writes of the connector,
+    restarts the library and reopens the endpoint with exponential backoff,
+    then lets the I/O resume and notifies the reset listeners.
+    """
+    def __init__(self, connector, min_backoff=0.1, max_backoff=10):
+        super().__init__(name="cpc-reset-supervisor", daemon=True)
+        self.connector = connector
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.log = logging.getLogger(type(self).__name__)
+        self._requested = threading.Event()
+        self._stopping = threading.Event()
+        # Recovery metrics
+        self.resets = 0
+        self.failed_attempts = 0
+        self.total_downtime = 0.0
+        self.last_downtime = None
+        self.downtimes = collections.deque(maxlen=100)
+
+    def request_reset(self):
+        """ Schedule a recovery, safe to call from a signal handler """
+        self._requested.set()
+
+    @property
+    def reset_pending(self):
+        return self._requested.is_set()
+
+    def stop(self):
+        self._stopping.set()
+        self._requested.set()
+
+    def run(self):
+        while True:
+            self._requested.wait()
+            if self._stopping.is_set():
+                return
+            started = time.monotonic()
+            self.log.warning("CPC endpoint %d reset", self.connector.endpoint_id)
+            attempts = self.recover()
+            if attempts is None:
+                return
+            downtime = time.monotonic() - started
+            self.resets += 1
+            self.last_downtime = downtime
+            self.total_downtime += downtime
+            self.downtimes.append(downtime)
+            self.log.info("CPC endpoint %d recovered in %.3f s after %d attempts",
+                self.connector.endpoint_id, downtime, attempts)
+            for listener in self.connector.reset_listeners:
+                listener(ResetEvent(downtime, attempts))
+
+    def recover(self):
+        """ Reopen the endpoint until it succeeds, return the number of attempts or None if stopped """
+        backoff = self.min_backoff
+        attempts = 0
+        with self.connector.quiesced():
+            while not self._stopping.is_set():
+                if not self.connector.wait_idle():
+                    # Restarting under a running read would leave its buffer positions inconsistent
+                    self.log.warning("%d CPC operations still in progress, retry in %.1f s",
+                        self.connector.active_io, backoff)
+                else:
+                    attempts += 1
+                    # Failed reads of the old endpoint may have requested the reset again meanwhile
+                    self._requested.clear()
+                    try:
+                        self.connector.reopen()
+                        return attempts
+                    except Exception as err:
+                        self.failed_attempts += 1
+                        self.log.warning("CPC reopen attempt %d failed: %s, retry in %.1f s", attempts, err, backoff)
+                self._stopping.wait(backoff)
+                backoff = min(2 * backoff, self.max_backoff)
+        return None
+
 class SerialConnectorCPC(Connector):
     """ CPC serial connector """
-    def __init__(self, lib_path, cpc_instance, tracing=False, endpoint_id=None):
+    def __init__(self, lib_path, cpc_instance, tracing=False, endpoint_id=None, tx_window_size=1):
         """ Init """
         self.endpoint = None
+        self.endpoint_event = None
         self.lib_path = lib_path
         self.cpc_instance = cpc_instance
         try:
-            self.cpc = lcw.CPC(self.lib_path, self.cpc_instance, tracing, self.cpc_reset)
+            # The signal handler only wakes up the supervisor, the recovery runs in its thread
+            self.supervisor = ResetSupervisor(self)
+            self.cpc = lcw.CPC(self.lib_path, self.cpc_instance, tracing, self.request_reset)
         except Exception as err:
             raise ConnectorException(err) from err
-        self.read_buff = bytearray()
+        # Called with a ResetEvent after each recovery
+        self.reset_listeners = []
+        # Reads and writes in progress, reset waits for them to finish
+        self.io_cond = threading.Condition()
+        self.active_io = 0
+        self.resetting = False
+        self.read_timeout = None
+        self.write_timeout = None
+        # Frames are read straight into read_buff, unread data is between read_pos and write_pos
+        self.read_buff = bytearray(READ_BUFF_SIZE)
+        self.read_view = memoryview(self.read_buff)
+        self.read_pos = 0
+        self.write_pos = 0
+        # Set by a read timeout of 0, libcpc would treat it as no timeout at all
+        self.nonblock = False
         if endpoint_id is not None:
             self.endpoint_id = endpoint_id
         else:
             self.endpoint_id = lcw.Endpoint.Id.BLUETOOTH.value # Bluetooth (BGAPI) endpoint
-        # Only a window of 1 is supported at the moment, see CPC library documentation
-        self.tx_window_size = 1
+        # Number of frames sent before waiting for an acknowledgement. Library versions that
+        # only support a window of 1 reject larger values, see open_endpoint.
+        self.tx_window_size = max(1, tx_window_size)
+        self.log = logging.getLogger(type(self).__name__)
 
     def open(self):
         """ Opening CPC endpoint """
         try:
-            self.endpoint = self.cpc.open_endpoint(self.endpoint_id, self.tx_window_size)
+            self.endpoint = self.open_endpoint()
         except Exception as err:
             raise ConnectorException(err) from err
+        self.endpoint_event = self.open_endpoint_event()
+        if not self.supervisor.is_alive():
+            # Threads can't be restarted, and BGLib closes the connector before the first open,
+            # which stops the supervisor before it has been started
+            self.supervisor = ResetSupervisor(self)
+            self.supervisor.start()
+
+    def open_endpoint(self):
+        """ Open the endpoint with the configured TX window, or a window of 1 if that fails """
+        if self.tx_window_size > 1:
+            try:
+                return self.cpc.open_endpoint(self.endpoint_id, self.tx_window_size)
+            except Exception as err:
+                self.log.warning("TX window %d not supported by libcpc %s (%s), using 1",
+                    self.tx_window_size, self.cpc.get_library_version(), err)
+                self.tx_window_size = 1
+        return self.cpc.open_endpoint(self.endpoint_id, self.tx_window_size)
+
+    def open_endpoint_event(self):
+        """ Open a nonblocking handle for the state change events of the endpoint """
+        try:
+            endpoint_event = self.cpc.open_endpoint_event(self.endpoint_id)
+            endpoint_event.blocking = False
+        except Exception as err:
+            # Older libraries don't support endpoint events, errors are still detected by the reads
+            self.log.warning("CPC endpoint events not available: %s", err)
+            return None
+        return endpoint_event
 
     def close(self):
         """ Closing CPC endpoint """
+        self.supervisor.stop()
+        if self.endpoint_event is not None:
+            try:
+                self.endpoint_event.close()
+            except Exception as err:
+                self.log.warning("Failed to close CPC endpoint events: %s", err)
+            self.endpoint_event = None
         if self.endpoint is not None:
-            del self.read_buff[:]
+            self.read_pos = self.write_pos = 0
             try:
                 self.endpoint.close()
             except Exception as err:
                 raise ConnectorException(err) from err
 
+    def begin_io(self):
+        """ Mark a read or write in progress, waiting for a reset to complete first """
+        with self.io_cond:
+            while self.resetting:
+                self.io_cond.wait()
+            self.active_io += 1
+
+    def end_io(self):
+        with self.io_cond:
+            self.active_io -= 1
+            if self.resetting:
+                self.io_cond.notify_all()
+
+    @contextlib.contextmanager
+    def io(self):
+        self.begin_io()
+        try:
+            yield
+        finally:
+            self.end_io()
+
+    @contextlib.contextmanager
+    def quiesced(self):
+        """ Hold off new reads and writes, see wait_idle for the ones in progress """
+        with self.io_cond:
+            self.resetting = True
+        try:
+            yield
+        finally:
+            with self.io_cond:
+                self.resetting = False
+                self.io_cond.notify_all()
+
+    def wait_idle(self, timeout=5):
+        """ Wait for the reads and writes in progress, return False if there are still some after timeout """
+        with self.io_cond:
+            # Blocked reads return after the read timeout or with an error
+            return self.io_cond.wait_for(lambda: self.active_io == 0, timeout)
+
     def write(self, data):
         """ Write data to the endpoint """
-        try:
-            self.endpoint.write(data)
-        except Exception as err:
-            raise ConnectorException(err) from err
+        with self.io():
+            try:
+                self.endpoint.write(data)
+            except Exception as err:
+                raise ConnectorException(err) from err
 
     def read(self, size=1):
         """ Read size number of data from endpoint """
-        if len(self.read_buff) < size:
-            try:
-                data = self.endpoint.read()
-                self.read_buff.extend(data)
-            except Exception:
-                # Read timeout, return with empty data
-                return bytearray(0)
+        # The buffer positions are only changed between begin_io and end_io, reopen resets them while quiesced
+        self.begin_io()
+        try:
+            if self.write_pos - self.read_pos < size:
+                if READ_BUFF_SIZE - self.write_pos < lcw.SL_CPC_READ_MINIMUM_SIZE:
+                    # Move the unread tail, typically a part of one packet, to the front
+                    pending = self.write_pos - self.read_pos
+                    self.read_view[:pending] = self.read_view[self.read_pos:self.write_pos]
+                    self.read_pos = 0
+                    self.write_pos = pending
+                try:
+                    self.write_pos += self.endpoint.readinto(self.read_view[self.write_pos:], self.nonblock)
+                except lcw.CPCTimeout:
+                    # No data within the read timeout, a good moment to look for state changes
+                    try:
+                        self.check_endpoint_events()
+                    except ConnectorException as err:
+                        self.read_failed(err)
+                    return bytes()
+                except Exception as err:
+                    self.read_failed(err)
+                    return bytes()
 
-        ret = self.read_buff[0:size]
-        del self.read_buff[0:size]
+            end = min(self.read_pos + size, self.write_pos)
+            # The BGAPI parser keeps references to the returned data, so it is copied out once
+            ret = bytes(self.read_view[self.read_pos:end])
+            self.read_pos = end
+            if self.read_pos == self.write_pos:
+                self.read_pos = self.write_pos = 0
+        finally:
+            self.end_io()
 
         return ret
 
+    def request_reset(self):
+        """ Reset callback of libcpc """
+        self.supervisor.request_reset()
+
+    def read_failed(self, err):
+        """ Hand a broken endpoint over to the reset supervisor """
+        if not self.supervisor.reset_pending and not self.resetting:
+            self.log.warning("CPC read failed: %s, endpoint state %s", err, self.endpoint_state())
+            self.supervisor.request_reset()
+
+    def check_endpoint_events(self):
+        """ Consume pending endpoint events, raise ConnectorException on an error state """
+        if self.endpoint_event is None:
+            return
+        while True:
+            try:
+                event = self.endpoint_event.read(nonblock=True)
+            except lcw.CPCTimeout:
+                return
+            except Exception as err:
+                raise ConnectorException(err) from err
+            if event in ERROR_EVENTS:
+                raise ConnectorException("CPC endpoint {}: {}".format(self.endpoint_id, event.name))
+            self.log.debug("CPC endpoint %d: %s", self.endpoint_id, event.name)
+
+    def endpoint_state(self):
+        """ Return the name of the endpoint state for error messages """
+        try:
+            return self.cpc.get_endpoint_state(self.endpoint_id).name
+        except Exception:
+            return "unknown"
+
     def set_read_timeout(self, timeout):
-        """ Set read timeout """
-        time = lcw.CPCTimeval(timeout)
+        """ Set read timeout, 0 for nonblocking reads and None to block until data arrives """
+        self.read_timeout = timeout
+        self.nonblock = timeout == 0
+        if self.nonblock:
+            return
+        time = lcw.CPCTimeval(timeout or 0)
         self.endpoint.set_option(lcw.Option.CPC_OPTION_RX_TIMEOUT, time)
 
     def set_write_timeout(self, timeout):
         """ Set write timeout """
+        self.write_timeout = timeout
         time = lcw.CPCTimeval(timeout)
         self.endpoint.set_option(lcw.Option.CPC_OPTION_TX_TIMEOUT, time)
 
-    def cpc_reset(self):
-        """ Restart the CPC library """
+    def reopen(self):
+        """ Restart the CPC library and reopen the endpoint, called by the reset supervisor """
+        if self.endpoint_event is not None:
+            try:
+                self.endpoint_event.close()
+            except Exception:
+                # Already invalidated by the reset
+                pass
+            self.endpoint_event = None
         self.cpc.restart()
-        del self.read_buff[:]
-        try:
-            self.endpoint = self.cpc.open_endpoint(self.endpoint_id, self.tx_window_size)
-        except Exception as err:
-            raise ConnectorException(err) from err
+        self.read_pos = self.write_pos = 0
+        self.endpoint = self.open_endpoint()
+        self.endpoint_event = self.open_endpoint_event()
+        # The options of the old endpoint are lost
+        if self.read_timeout is not None:
+            self.set_read_timeout(self.read_timeout)
+        if self.write_timeout is not None:
+            self.set_write_timeout(self.write_timeout)
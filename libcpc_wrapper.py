@@ -1,7 +1,34 @@
 from ctypes import *
 from enum import Enum
+import errno
+import os
 import signal
 
+# Smallest buffer accepted by cpc_read_endpoint, one full CPC frame
+SL_CPC_READ_MINIMUM_SIZE = 4087
+
+# Error codes of reads that returned no data because of the timeout or the nonblocking flag
+TIMEOUT_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ETIMEDOUT)
+
+class CPCError(Exception):
+    """ Failed libcpc call, errno holds the error code returned by the library """
+    def __init__(self, message, error=0):
+        if error:
+            message = "{}: {}".format(message, os.strerror(error))
+        super().__init__(message)
+        self.errno = error
+#end class
+
+class CPCTimeout(CPCError):
+    """ Read returned without data, not an error of the endpoint """
+#end class
+
+def read_error(message, ret):
+    """ Exception for the negative return value of a libcpc read function """
+    error = -ret if ret != -1 else get_errno()
+    if error in TIMEOUT_ERRNOS:
+        return CPCTimeout(message, error)
+    return CPCError(message, error)
 
 
 class State(Enum):
@@ -66,6 +93,8 @@ class Endpoint(Structure):
 
     def __init__(self, cpc_handle):
         self.cpc_handle = cpc_handle
+        # Reused by read() instead of allocating a buffer per frame
+        self.read_buffer = create_string_buffer(SL_CPC_READ_MINIMUM_SIZE)
 
     # int cpc_close_endpoint(cpc_endpoint_t *endpoint)
     def close(self):
@@ -76,21 +105,34 @@ class Endpoint(Structure):
 
     # ssize_t cpc_read_endpoint(cpc_endpoint_t endpoint, void *buffer, size_t count, cpc_endpoint_read_flags_t flags)
     def read(self, nonblock=False):
-        count = 4087
-        read_buffer = bytearray(count)
+        ret = self._read(self.read_buffer, SL_CPC_READ_MINIMUM_SIZE, nonblock)
+        return self.read_buffer.raw[:ret]
+    #end def
+
+    def readinto(self, buffer, nonblock=False):
+        """
+        Read one frame directly into a writable buffer, e.g. a memoryview slice
+        of a bytearray, and return the number of bytes read. The buffer must
+        hold at least SL_CPC_READ_MINIMUM_SIZE bytes.
+        """
+        count = len(buffer)
+        if count < SL_CPC_READ_MINIMUM_SIZE:
+            raise ValueError("Read buffer smaller than {} bytes".format(SL_CPC_READ_MINIMUM_SIZE))
+        return self._read((c_char * count).from_buffer(buffer), count, nonblock)
+    #end def
 
+    def _read(self, c_buffer, count, nonblock):
         flags = 0
         if nonblock:
             flags = (1 << 0)
 
-        byte_array = bytes(read_buffer)
         byte_count = c_int(count)
         read_flag = c_ubyte(flags)
-        ret = self.cpc_handle.lib_cpc.cpc_read_endpoint(self, byte_array, byte_count, read_flag)
+        ret = self.cpc_handle.lib_cpc.cpc_read_endpoint(self, c_buffer, byte_count, read_flag)
         if ret < 0:
-            raise Exception("Failed to read endpoint")
+            raise read_error("Failed to read endpoint", ret)
 
-        return byte_array[:ret]
+        return ret
     #end def
 
     # ssize_t cpc_write_endpoint(cpc_endpoint_t endpoint, const void *data, size_t data_length, cpc_endpoint_write_flags_t flags)
@@ -254,7 +296,7 @@ class EndpointEvent(Structure):
         ev = c_uint()
         ret = self.cpc_handle.lib_cpc.cpc_read_endpoint_event(self, byref(ev), flags)
         if ret < 0:
-            raise Exception("Failed to read endpoint event")
+            raise read_error("Failed to read endpoint event", ret)
 
         return Event(ev.value)
     #end def
@@ -319,7 +361,7 @@ class EndpointEvent(Structure):
 
     @read_timeout.setter
     def read_timeout(self, timeout):
-        self.get_option(EndpointEventOption.CPC_ENDPOINT_EVENT_OPTION_READ_TIMEOUT, timeout)
+        self.set_option(EndpointEventOption.CPC_ENDPOINT_EVENT_OPTION_READ_TIMEOUT, timeout)
     #end def
 #end class
 
@@ -355,6 +397,7 @@ class CPC(Structure):
     #end def
 
     def reset_cb(self, signum, frame):
+        # Runs in the main thread between two bytecodes, the callback must not block
         self.reset_callback()
     #end def
 
@@ -0,0 +1,245 @@
+"""
+In-process metrics of the scanner to publisher pipeline.
+
+A Registry holds counters, gauges and histograms. Most values already exist
+as plain attributes, e.g. ReportQueue.dropped or ResetSupervisor.resets,
+and are read by callbacks when the metrics are collected, so they cost
+nothing on the report path. The few instruments updated in hot paths are
+only created by the register_metrics methods of the components, which are
+not called unless metrics are enabled, so that the disabled case costs an
+attribute test.
+
+The registry is exposed in the Prometheus text format by MetricsServer and
+can be published periodically by aws_pipe.start_metrics.
+"""
+
+import bisect
+import http.server
+import threading
+
+PREFIX = "bt_scan_"
+# Seconds, from a fraction of a millisecond up to the MQTT operation timeouts
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Seconds spent on a single report, a few microseconds when the host keeps up
+PARSE_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = (f'{name}="{escape(value)}"' for name, value in zip(labelnames, values))
+    return "{" + ",".join(pairs) + "}"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+    """ Base of the metric types, a value per tuple of label values.
+
+    Callbacks added with add_callback return a value, or a dict of label
+    value tuples to values if the metric has labels. They are called on
+    every collection and their values are added to the set ones.
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        # A metric without labels has a sample from the start, e.g. 0 failures
+        self._values = {} if self.labelnames else {(): 0}
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+        return self
+
+    def values(self):
+        """ Return a dict of label value tuples to the current values. """
+        with self._lock:
+            values = dict(self._values)
+        for callback in self._callbacks:
+            value = callback()
+            if value is None:
+                continue
+            if not isinstance(value, dict):
+                value = {(): value}
+            for labels, sample in value.items():
+                labels = tuple(str(label) for label in labels)
+                values[labels] = values.get(labels, 0) + sample
+        return values
+
+    def samples(self):
+        """ Yield (name, labels string, value) of the samples of the metric. """
+        for labels, value in sorted(self.values().items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+class Counter(Metric):
+    """ Monotonically increasing value. """
+    type = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """ Value that goes up and down. """
+    type = "gauge"
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(Metric):
+    """ Distribution of observed values in cumulative buckets, e.g. latencies in seconds. """
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        """ Return the per bucket counts, the sum and the count of the observed values. """
+        with self._lock:
+            return list(self._counts), self._sum, self._count
+
+    def samples(self):
+        counts, total, count = self.snapshot()
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            yield self.name + "_bucket", format_labels(("le",), (format_value(float(bound)),)), cumulative
+        yield self.name + "_sum", "", total
+        yield self.name + "_count", "", count
+
+class Registry:
+    """ Named metrics of the process. Getting a registered name again returns the same metric. """
+    def __init__(self, prefix=PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name, help, **kwargs):
+        name = self.prefix + name
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+            return metric
+
+    def counter(self, name, help, labelnames=(), callback=None):
+        metric = self._get(Counter, name, help, labelnames=labelnames)
+        return metric.add_callback(callback) if callback is not None else metric
+
+    def gauge(self, name, help, labelnames=(), callback=None):
+        metric = self._get(Gauge, name, help, labelnames=labelnames)
+        return metric.add_callback(callback) if callback is not None else metric
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def exposition(self):
+        """ Return the metrics in the Prometheus text format. """
+        lines = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        """ Return the samples as a dict of sample names with labels to values, e.g. to publish as JSON. """
+        return {name + labels: value for metric in self.metrics() for name, labels, value in metric.samples()}
+
+class MetricsServer:
+    """ HTTP server answering GET /metrics with the registry in the Prometheus text format. """
+    def __init__(self, registry, port, host="127.0.0.1"):
+        self.registry = registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = registry.exposition().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", CONTENT_TYPE)
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                # Scrapes are too frequent to print
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def add_metrics_arguments(parser):
+    """ Add the metrics options to an argument parser. """
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        help="Serve Prometheus metrics on this local port, 0 disables the endpoint",
+        default=0)
+    parser.add_argument(
+        "--metrics_host",
+        help="Address the metrics endpoint listens on",
+        default="127.0.0.1")
+    parser.add_argument(
+        "--metrics_period",
+        type=float,
+        help="Seconds between two publishes of the metrics over MQTT, 0 disables them",
+        default=0)
+
+def metrics_from_args(args):
+    """ Return a Registry if the options added by add_metrics_arguments enable metrics, else None. """
+    if args.metrics_port or args.metrics_period > 0:
+        return Registry()
+    return None
+
+def server_from_args(registry, args):
+    """ Return a started MetricsServer if the options ask for one, else None. """
+    if registry is None or not args.metrics_port:
+        return None
+    server = MetricsServer(registry, args.metrics_port, args.metrics_host)
+    server.start()
+    print(f"Serving metrics on http://{args.metrics_host}:{server.port}/metrics")
+    return server
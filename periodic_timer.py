@@ -1,8 +1,14 @@
 import threading
 import time
+import traceback
 
 class PeriodicTimer:
-    """ Timer to call a target function periodically in the context of a separate thread. """
+    """ Timer to call a target function periodically in the context of a separate thread.
+
+    Calls are scheduled on monotonic clock deadlines, so the execution time of
+    the target does not accumulate as drift. trigger() requests an early call,
+    after which the next deadline is one period later.
+    """
     def __init__(self, period, target=None, args=(), kwargs=None):
         self._period = float(period)
         self._target = target
@@ -10,34 +16,79 @@ class PeriodicTimer:
         if kwargs is None:
             kwargs = {}
         self._kwargs = kwargs
-        self._lock = threading.Lock()
-        self._thread = threading.Thread(target=self._run, daemon=True)
-        self._started = False
+        self._cond = threading.Condition()
+        self._triggered = False
+        self._rescheduled = False
+        self._stopping = False
+        self._thread = None
 
     def start(self):
-        """ Start the timer. Must be called from the same thread as the stop method. """
-        if self._started:
-            # Timer has already been started.
-            return
-        if not self._thread.is_alive():
+        """ Start the timer. """
+        with self._cond:
+            if self._thread is not None:
+                # Timer has already been started.
+                return
+            self._stopping = False
+            self._triggered = False
+            self._thread = threading.Thread(target=self._run, daemon=True)
             self._thread.start()
-        else:
-            self._lock.release()
-        self._started = True
 
-    def stop(self):
-        """ Stop the timer. """
-        if not self._started:
-            # Timer is not running.
-            return
-        self._lock.acquire()
-        self._started = False
+    def stop(self, timeout=None):
+        """ Stop the timer and wait until a call in progress has returned. """
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                # Timer is not running.
+                return
+            self._stopping = True
+            self._cond.notify()
+        if thread is not threading.current_thread():
+            thread.join(timeout)
+        with self._cond:
+            self._thread = None
+
+    def set_period(self, period):
+        """ Change the period, the next call is due one new period after the previous one. """
+        with self._cond:
+            self._period = float(period)
+            self._rescheduled = True
+            self._cond.notify()
+
+    def trigger(self):
+        """ Call the target as soon as possible instead of waiting for the deadline. """
+        with self._cond:
+            self._triggered = True
+            self._cond.notify()
 
     def _run(self):
         """ The main loop of the timer thread. """
+        last_call = time.monotonic()
+        deadline = last_call + self._period
         while True:
-            self._lock.acquire()
-            self._lock.release()
+            with self._cond:
+                while not self._stopping and not self._triggered:
+                    if self._rescheduled:
+                        self._rescheduled = False
+                        deadline = last_call + self._period
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopping:
+                    return
+                triggered = self._triggered
+                self._triggered = False
             if self._target:
-                self._target(*self._args, **self._kwargs)
-            time.sleep(self._period)
+                try:
+                    self._target(*self._args, **self._kwargs)
+                except Exception:
+                    traceback.print_exc()
+            now = time.monotonic()
+            last_call = now
+            if triggered:
+                deadline = now + self._period
+            else:
+                deadline += self._period
+                if deadline <= now:
+                    # Missed deadlines are skipped instead of called back to back
+                    deadline = now + self._period
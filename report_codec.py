@@ -0,0 +1,202 @@
+"""
+Compact binary wire format for advertisement reports.
+
+A payload is a batch header followed by fixed layout records, each holding
+the raw advertising data of one report. The module has no dependencies
+outside the standard library (zstandard is optional) so it can be used as
+the decoder on the cloud side as well.
+
+Batch layout (little endian):
+    magic           4 bytes  b'BTR2'
+    name_len        uint8    length of the scanner thing name
+    name            name_len bytes, UTF-8
+
+Record layout (little endian):
+    timestamp       float64  seconds since the epoch
+    flags           uint8    bits 0-3: event_flags, bit 6: aggregate, bit 7: extended PDU
+    address         6 bytes  most significant byte first
+    address_type    uint8
+    rssi            int8
+    tx_power        int8     127 if unavailable
+    channel         uint8
+    adv_sid         uint8    255 for legacy PDUs
+    radio           uint8    index of the receiving radio
+    periodic_interval uint16 units of 1.25 ms
+    data_len        uint16
+    aggregate       only present if the aggregate flag is set:
+        first_seen  float64  timestamp of the first report, timestamp holds the last one
+        count       uint32   number of identical reports
+        rssi_min    int8
+        rssi_max    int8
+        rssi_mean   float32
+    data            data_len bytes of raw advertising data
+"""
+
+import argparse
+import gzip
+import json
+import struct
+import sys
+import time
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from adv_data import parse_adv_data
+
+BATCH_MAGIC = b'BTR2'
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+FLAG_EXTENDED = 0x80
+FLAG_AGGREGATE = 0x40
+EVENT_FLAGS_MASK = 0x0F
+TX_POWER_UNAVAILABLE = 127
+ADV_SID_NONE = 0xFF
+ADDRESS_TYPES = {0: 'PUBLIC', 1: 'RANDOM'}
+
+RECORD = struct.Struct('<dB6sBbbBBBHH')
+# Offset of the address within a record
+ADDRESS_OFFSET = 9
+AGGREGATE = struct.Struct('<dIbbf')
+
+def encode_report(timestamp, extended, event_flags, address, address_type, rssi,
+                  channel, data, tx_power=TX_POWER_UNAVAILABLE, adv_sid=ADV_SID_NONE,
+                  periodic_interval=0, aggregate=None, radio=0):
+    """ Encode a single advertisement report to a binary record.
+
+    The address is the 'xx:xx:xx:xx:xx:xx' string provided by BGAPI.
+    aggregate is an optional aggregator.AggregateStats instance.
+    """
+    flags = event_flags & EVENT_FLAGS_MASK
+    if extended:
+        flags |= FLAG_EXTENDED
+    aggregate_bytes = b''
+    if aggregate is not None:
+        flags |= FLAG_AGGREGATE
+        aggregate_bytes = AGGREGATE.pack(
+            aggregate.first_seen,
+            aggregate.count,
+            aggregate.rssi_min,
+            aggregate.rssi_max,
+            aggregate.rssi_mean)
+    return RECORD.pack(
+        timestamp,
+        flags,
+        bytes.fromhex(address.replace(':', '')),
+        address_type,
+        rssi,
+        tx_power,
+        channel,
+        adv_sid,
+        radio,
+        periodic_interval,
+        len(data)) + aggregate_bytes + data
+
+def record_address(record):
+    """ Return the raw address bytes of an encoded record. """
+    return bytes(record[ADDRESS_OFFSET:ADDRESS_OFFSET + 6])
+
+def encode_batch_header(thing_name):
+    """ Return the header that precedes the records of a batch. """
+    name = thing_name.encode('utf-8')
+    return BATCH_MAGIC + bytes([len(name)]) + name
+
+def decompress(payload):
+    """ Undo gzip or zstd compression detected from the payload magic. """
+    if payload[:2] == GZIP_MAGIC:
+        return gzip.decompress(payload)
+    if payload[:4] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError("zstd compressed payload requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(payload, max_output_size=1 << 24)
+    return payload
+
+def iter_records(payload):
+    """ Yield (thing_name, record tuple, aggregate tuple or None, raw data) from an uncompressed binary batch. """
+    if payload[:4] != BATCH_MAGIC:
+        raise ValueError("Not a binary report batch")
+    name_len = payload[4]
+    thing_name = bytes(payload[5:5 + name_len]).decode('utf-8')
+    view = memoryview(payload)
+    offset = 5 + name_len
+    while offset < len(payload):
+        if offset + RECORD.size > len(payload):
+            raise ValueError("Truncated record header")
+        record = RECORD.unpack_from(view, offset)
+        offset += RECORD.size
+        aggregate = None
+        if record[1] & FLAG_AGGREGATE:
+            if offset + AGGREGATE.size > len(payload):
+                raise ValueError("Truncated aggregate")
+            aggregate = AGGREGATE.unpack_from(view, offset)
+            offset += AGGREGATE.size
+        data_len = record[-1]
+        if offset + data_len > len(payload):
+            raise ValueError("Truncated record data")
+        yield thing_name, record, aggregate, bytes(view[offset:offset + data_len])
+        offset += data_len
+
+def record_to_dict(thing_name, record, aggregate, data):
+    """ Convert a decoded record to the dict layout of the JSON encoding. """
+    (timestamp, flags, address, address_type, rssi, tx_power, channel,
+     adv_sid, radio, periodic_interval, _) = record
+    adv_data = parse_adv_data(data)
+    adv_data['scanner_thing_name'] = thing_name
+    adv_data['RADIO'] = radio
+    adv_data['timestamp'] = timestamp
+    adv_data['DATETIME'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+    extended = bool(flags & FLAG_EXTENDED)
+    adv_data['PDU'] = 'EXTENDED' if extended else 'LEGACY'
+    adv_data['CONNECTABLE'] = bool(flags & 1)
+    adv_data['SCANNABLE'] = bool(flags & 2)
+    adv_data['DIRECTED'] = bool(flags & 4)
+    adv_data['SCAN_RESPONSE'] = bool(flags & 8)
+    adv_data['ADDRESS'] = ':'.join(f'{b:02x}' for b in address)
+    adv_data['ADDRESS_TYPE'] = ADDRESS_TYPES.get(address_type, 'DECODE_ERROR')
+    adv_data['RSSI'] = rssi
+    adv_data['CHANNEL'] = channel
+    if extended:
+        adv_data['ADV_SID'] = adv_sid
+        if tx_power == TX_POWER_UNAVAILABLE:
+            adv_data['TX_POWER'] = 'INFORMATION_UNAVAILABLE'
+        else:
+            adv_data['TX_POWER'] = tx_power
+        adv_data['PERIODIC_INTERVAL'] = periodic_interval * 1.25 #units of ms
+    if aggregate is not None:
+        add_aggregate_fields(adv_data, *aggregate)
+    return adv_data
+
+def add_aggregate_fields(adv_data, first_seen, count, rssi_min, rssi_max, rssi_mean):
+    """ Add the aggregator summary to a report dict. """
+    adv_data['FIRST_SEEN'] = first_seen
+    adv_data['LAST_SEEN'] = adv_data['timestamp']
+    adv_data['COUNT'] = count
+    adv_data['RSSI_MIN'] = rssi_min
+    adv_data['RSSI_MAX'] = rssi_max
+    adv_data['RSSI_MEAN'] = round(rssi_mean, 2)
+
+def decode_payload(payload):
+    """ Decode an MQTT payload published by aws_pipe to a list of report dicts.
+
+    Both the JSON and the binary encodings are accepted, compressed or not.
+    """
+    payload = decompress(payload)
+    if payload[:4] == BATCH_MAGIC:
+        return [record_to_dict(*rec) for rec in iter_records(payload)]
+    reports = json.loads(payload)
+    if isinstance(reports, dict):
+        # Single report published before batching was introduced
+        reports = [reports]
+    return reports
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog = 'report_codec',
+                    description = 'Decode aws_pipe payloads to JSON lines')
+    parser.add_argument('files', nargs='+', help="Files holding one raw MQTT payload each")
+    args = parser.parse_args()
+    for path in args.files:
+        with open(path, 'rb') as f:
+            for report in decode_payload(f.read()):
+                sys.stdout.write(json.dumps(report) + '\n')
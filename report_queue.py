@@ -0,0 +1,183 @@
+"""
+Bounded queue between the scanner and the uploader.
+"""
+
+import collections
+import queue
+import re
+import threading
+import time
+
+from report_codec import record_address
+
+POLICIES = ("drop_oldest", "drop_newest", "sample", "block")
+
+# Address of a report dict serialized by a ShardedPipeline worker
+_JSON_ADDRESS = re.compile(rb'"ADDRESS":"([^"]*)"')
+
+def device_key(report):
+    """ Return the device address of a report dict, serialized dict or binary record. """
+    if isinstance(report, (bytes, bytearray)):
+        if report[:1] == b'{':
+            match = _JSON_ADDRESS.search(report)
+            return match.group(1) if match else None
+        return record_address(report)
+    return report.get('ADDRESS')
+
+class ReportQueue:
+    """ Bounded FIFO with a selectable overflow policy.
+
+    Implements the put/get/qsize/empty subset of queue.Queue used by the
+    scanner and aws_pipe. Policies:
+      drop_oldest: discard the oldest report to make room for the new one.
+      drop_newest: discard the new report.
+      sample:      above half capacity keep 1 in sample_n reports per device,
+                   then drop the newest when full.
+      block:       wait for room like queue.Queue. Never use this with the
+                   scanner thread, it stalls the BGAPI event loop.
+    """
+    def __init__(self, maxsize=100000, policy="drop_oldest", sample_n=10, key=device_key):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy '{policy}', expected one of {POLICIES}")
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sample_n = max(1, sample_n)
+        self.key = key
+        self._queue = collections.deque()
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._sample_counters = collections.Counter()
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water = 0
+        # Called with the mutex held when the size reaches flush_threshold
+        self.flush_threshold = None
+        self.on_threshold = None
+
+    def qsize(self):
+        return len(self._queue)
+
+    def empty(self):
+        return not self._queue
+
+    def put(self, item, block=True, timeout=None):
+        """ Add an item, applying the overflow policy if the queue is full. """
+        with self._not_full:
+            if self.policy == "block":
+                if not self._wait_not_full(block, timeout):
+                    self.dropped += 1
+                    raise queue.Full
+            elif self.policy == "sample" and len(self._queue) >= self.maxsize // 2:
+                key = self.key(item)
+                self._sample_counters[key] += 1
+                if (self._sample_counters[key] - 1) % self.sample_n or len(self._queue) >= self.maxsize:
+                    self.dropped += 1
+                    return
+            elif len(self._queue) >= self.maxsize:
+                self.dropped += 1
+                if self.policy != "drop_oldest":
+                    return
+                self._queue.popleft()
+            self._queue.append(item)
+            self.enqueued += 1
+            if len(self._queue) > self.high_water:
+                self.high_water = len(self._queue)
+            if len(self._queue) == self.flush_threshold and self.on_threshold is not None:
+                self.on_threshold()
+            self._not_empty.notify()
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def _wait_not_full(self, block, timeout):
+        if len(self._queue) < self.maxsize:
+            return True
+        if not block:
+            return False
+        if timeout is None:
+            while len(self._queue) >= self.maxsize:
+                self._not_full.wait()
+            return True
+        deadline = time.monotonic() + timeout
+        while len(self._queue) >= self.maxsize:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._not_full.wait(remaining)
+        return True
+
+    def get(self, block=True, timeout=None):
+        """ Remove and return the oldest item, raise queue.Empty if there is none. """
+        with self._not_empty:
+            if not block:
+                if not self._queue:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self._queue:
+                    self._not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._queue:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+            item = self._queue.popleft()
+            if not self._queue:
+                # Sampling restarts once the backlog has been drained
+                self._sample_counters.clear()
+            self._not_full.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def set_threshold_callback(self, threshold, callback):
+        """ Call callback whenever the queue size reaches threshold. It must not block. """
+        with self._mutex:
+            self.flush_threshold = threshold
+            self.on_threshold = callback
+
+    def stats(self):
+        """ Return the counters as a dict. """
+        return {
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'high_water': self.high_water,
+            'size': len(self._queue),
+        }
+
+    def register_metrics(self, registry):
+        """ Expose the counters and the size in a metrics.Registry. """
+        registry.gauge("queue_size", "Reports waiting for upload", callback=self.qsize)
+        registry.gauge("queue_high_water", "Highest number of reports waiting for upload",
+            callback=lambda: self.high_water)
+        registry.counter("queue_enqueued_total", "Reports added to the upload queue",
+            callback=lambda: self.enqueued)
+        registry.counter("queue_dropped_total", "Reports dropped by the queue overflow policy",
+            callback=lambda: self.dropped)
+
+def add_queue_arguments(parser):
+    """ Add the ReportQueue options to an argument parser. """
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        help="Maximum number of reports waiting for upload",
+        default=100000)
+    parser.add_argument(
+        "--queue_policy",
+        choices=POLICIES,
+        help="What to do with reports when the queue is full",
+        default="drop_oldest")
+    parser.add_argument(
+        "--sample_n",
+        type=int,
+        help="Keep 1 in N reports per device with the sample policy",
+        default=10)
+
+def queue_from_args(args):
+    """ Return a ReportQueue configured by options added by add_queue_arguments. """
+    return ReportQueue(args.queue_size, args.queue_policy, args.sample_n)
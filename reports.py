@@ -0,0 +1,88 @@
+"""
+Conversion of advertisement reports to the records queued for upload.
+
+The functions accept BGAPI scanner report events as well as RawReport tuples,
+which carry the same attributes but can be passed between processes.
+"""
+
+import collections
+import json
+import time
+
+from adv_data import parse_adv_data
+from report_codec import encode_report as encode_binary_report, add_aggregate_fields, \
+    ADV_SID_NONE, TX_POWER_UNAVAILABLE
+
+EXTENDED_REPORT = "bt_evt_scanner_extended_advertisement_report"
+
+RawReport = collections.namedtuple('RawReport', [
+    'radio', 'extended', 'event_flags', 'address', 'address_type', 'rssi', 'channel', 'data',
+    'tx_power', 'adv_sid', 'periodic_interval'])
+
+def raw_report(evt, radio_id=0):
+    """ Copy the fields of a scanner report event to a RawReport. """
+    if evt == EXTENDED_REPORT:
+        return RawReport(radio_id, True, evt.event_flags, evt.address, evt.address_type, evt.rssi,
+            evt.channel, bytes(evt.data), evt.tx_power, evt.adv_sid, evt.periodic_interval)
+    return RawReport(radio_id, False, evt.event_flags, evt.address, evt.address_type, evt.rssi,
+        evt.channel, bytes(evt.data), TX_POWER_UNAVAILABLE, None, 0)
+
+def report_to_dict(evt, extended, timestamp, thing_name, radio_id):
+    """ Convert an advertisement report to a JSON serializable dict. """
+    adv_data = parse_adv_data(evt.data)
+    # scanner_thing_name is fixed based on MQTT CLIENT_ID which must be the same as the Thing name
+    # found in aws_cert_path.py and imported by aws_iot.py
+    adv_data['scanner_thing_name'] = thing_name
+    adv_data['RADIO'] = radio_id
+    adv_data['timestamp'] = timestamp
+    adv_data['DATETIME'] = time.strftime('%Y-%m-%d %H:%M:%S',time.gmtime(adv_data['timestamp']))
+    adv_data['PDU'] = 'EXTENDED' if extended else 'LEGACY'
+    adv_data['CONNECTABLE'] = True if evt.event_flags & 1 else False
+    adv_data['SCANNABLE'] = True if evt.event_flags & 2 else False
+    adv_data['DIRECTED'] = True if evt.event_flags & 4 else False
+    adv_data['SCAN_RESPONSE'] = True if evt.event_flags & 8 else False
+    adv_data['ADDRESS'] = evt.address
+    if evt.address_type == 0:
+        adv_data['ADDRESS_TYPE'] = 'PUBLIC'
+    elif evt.address_type == 1:
+        adv_data['ADDRESS_TYPE'] = 'RANDOM'
+    else:
+        adv_data['ADDRESS_TYPE'] = 'DECODE_ERROR'
+    if extended:
+        adv_data['ADV_SID'] = evt.adv_sid
+        if evt.tx_power == 127:
+            adv_data['TX_POWER'] = 'INFORMATION_UNAVAILABLE'
+        else:
+            adv_data['TX_POWER'] = evt.tx_power
+        adv_data['RSSI'] = evt.rssi
+        adv_data['CHANNEL'] = evt.channel
+        adv_data['PERIODIC_INTERVAL'] = evt.periodic_interval * 1.25 #units of ms
+    return adv_data
+
+def report_to_record(evt, extended, timestamp, radio_id, aggregate=None):
+    """ Encode an advertisement report to a compact binary record. """
+    if extended:
+        return encode_binary_report(
+            timestamp, True, evt.event_flags, evt.address, evt.address_type,
+            evt.rssi, evt.channel, evt.data, tx_power=evt.tx_power,
+            adv_sid=evt.adv_sid, periodic_interval=evt.periodic_interval,
+            aggregate=aggregate, radio=radio_id)
+    return encode_binary_report(
+        timestamp, False, evt.event_flags, evt.address, evt.address_type,
+        evt.rssi, evt.channel, evt.data, adv_sid=ADV_SID_NONE, aggregate=aggregate, radio=radio_id)
+
+def encode_report(evt, extended, timestamp, thing_name, radio_id, encoding, aggregate=None):
+    """ Return the dict (json) or record (binary) of a report, with aggregator statistics if given. """
+    if encoding == "binary":
+        return report_to_record(evt, extended, timestamp, radio_id, aggregate)
+    adv_data = report_to_dict(evt, extended, timestamp, thing_name, radio_id)
+    if aggregate is not None:
+        add_aggregate_fields(adv_data, aggregate.first_seen, aggregate.count,
+            aggregate.rssi_min, aggregate.rssi_max, aggregate.rssi_mean)
+    return adv_data
+
+def serialize_report(report):
+    """ Return the bytes aws_pipe puts into a batch for a report dict or record. """
+    if isinstance(report, (bytes, bytearray)):
+        return report
+    return json.dumps(report, separators=(',', ':')).encode('utf-8')
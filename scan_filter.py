@@ -0,0 +1,157 @@
+"""
+Filtering of advertisement reports as close to the radio as possible.
+
+The controller filters by the discover mode of scanner.start and, if
+addresses are given, by its accept list, filled by ble_scan.App with
+sm.add_to_whitelist and enabled with gap.enable_whitelisting. All criteria,
+the addresses included in case the accept list can't be applied, are
+checked on the raw scanner report event, before the report is copied,
+parsed to a dict or aggregated.
+"""
+
+import json
+import uuid
+
+from adv_data import AdvData, AD_TYPE_UUID16_INCOMPLETE, AD_TYPE_UUID16_COMPLETE, \
+    AD_TYPE_UUID128_INCOMPLETE, AD_TYPE_UUID128_COMPLETE, AD_TYPE_SERVICE_DATA_16, \
+    AD_TYPE_SERVICE_DATA_128, AD_TYPE_MANUFACTURER_SPECIFIC_DATA
+
+# Values of the discover_mode parameter of scanner.start
+DISCOVER_MODES = {'limited': 0, 'generic': 1, 'observation': 2}
+
+UUID16_TYPES = (AD_TYPE_UUID16_INCOMPLETE, AD_TYPE_UUID16_COMPLETE)
+UUID128_TYPES = (AD_TYPE_UUID128_INCOMPLETE, AD_TYPE_UUID128_COMPLETE)
+
+def uuid_to_bytes(value):
+    """ Convert "FEAA" or "6e400001-b5a3-f393-e0a9-e50e24dcca9e" to advertising (little endian) byte order. """
+    value = value.strip()
+    if len(value) <= 4:
+        return int(value, 16).to_bytes(2, 'little')
+    return uuid.UUID(value).bytes[::-1]
+
+def parse_company_id(value):
+    """ Accept company IDs as int, decimal or 0x prefixed hex string. """
+    if isinstance(value, int):
+        return value
+    return int(value, 0)
+
+class ScanFilter:
+    """ Decide whether a scanner report is worth processing.
+
+    A report passes if its RSSI is at least rssi_floor, its address is in
+    addresses (if given) and, if service UUIDs or company IDs are given, its
+    advertising data contains at least one of them. Service UUIDs match the
+    service class UUID lists and the service data.
+    """
+    def __init__(self, addresses=(), service_uuids=(), company_ids=(), rssi_floor=None,
+                 discover_mode="generic"):
+        if discover_mode not in DISCOVER_MODES:
+            raise ValueError(f"Unknown discover mode '{discover_mode}', expected one of {tuple(DISCOVER_MODES)}")
+        # BGAPI reports addresses as lowercase, colon separated strings
+        self.addresses = frozenset(address.lower() for address in addresses)
+        uuids = [uuid_to_bytes(value) for value in service_uuids]
+        self.uuid16 = frozenset(value for value in uuids if len(value) == 2)
+        self.uuid128 = frozenset(value for value in uuids if len(value) == 16)
+        self.company_ids = frozenset(parse_company_id(value) for value in company_ids)
+        self.rssi_floor = rssi_floor
+        self.discover_mode = discover_mode
+        self.match_data = bool(self.uuid16 or self.uuid128 or self.company_ids)
+        self.accepted = 0
+        self.rejected = 0
+
+    @property
+    def discover_mode_value(self):
+        """ Value of the discover_mode parameter of scanner.start. """
+        return DISCOVER_MODES[self.discover_mode]
+
+    @property
+    def active(self):
+        """ True if any report can be rejected on the host. """
+        return bool(self.addresses or self.match_data or self.rssi_floor is not None)
+
+    def __call__(self, evt):
+        """ Return True if the report event passes the filter. """
+        if (self.rssi_floor is not None and evt.rssi < self.rssi_floor) or \
+                (self.addresses and evt.address not in self.addresses) or \
+                (self.match_data and not self.match_adv_data(evt.data)):
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    def register_metrics(self, registry):
+        """ Expose the filter counters in a metrics.Registry. """
+        registry.counter("filter_accepted_total", "Scanner reports passing the host filter",
+            callback=lambda: self.accepted)
+        registry.counter("filter_rejected_total", "Scanner reports rejected by the host filter",
+            callback=lambda: self.rejected)
+
+    def match_adv_data(self, data):
+        """ Check the advertising data for one of the service UUIDs or company IDs. """
+        for ad_type, value in AdvData(data):
+            if ad_type == AD_TYPE_MANUFACTURER_SPECIFIC_DATA:
+                if len(value) >= 2 and int.from_bytes(value[:2], 'little') in self.company_ids:
+                    return True
+            elif ad_type in UUID16_TYPES:
+                if any(bytes(value[j:j + 2]) in self.uuid16 for j in range(0, len(value) - 1, 2)):
+                    return True
+            elif ad_type in UUID128_TYPES:
+                if any(bytes(value[j:j + 16]) in self.uuid128 for j in range(0, len(value) - 15, 16)):
+                    return True
+            elif ad_type == AD_TYPE_SERVICE_DATA_16:
+                if bytes(value[:2]) in self.uuid16:
+                    return True
+            elif ad_type == AD_TYPE_SERVICE_DATA_128:
+                if bytes(value[:16]) in self.uuid128:
+                    return True
+        return False
+
+    @classmethod
+    def from_dict(cls, config):
+        """ Create a filter from a dict with the keyword arguments of the constructor. """
+        return cls(**config)
+
+def add_filter_arguments(parser):
+    """ Add the ScanFilter options to an argument parser. """
+    parser.add_argument(
+        "--filter_config",
+        help="JSON file with the addresses, service_uuids, company_ids, rssi_floor and discover_mode"
+             " filter settings, the options below extend or override it")
+    parser.add_argument(
+        "--allow_address",
+        nargs="+",
+        help="Only report these device addresses",
+        default=[])
+    parser.add_argument(
+        "--service_uuid",
+        nargs="+",
+        help="Only report devices advertising one of these 16 or 128-bit service UUIDs, or a --company_id",
+        default=[])
+    parser.add_argument(
+        "--company_id",
+        nargs="+",
+        help="Only report devices with manufacturer data of one of these company IDs, or a --service_uuid",
+        default=[])
+    parser.add_argument(
+        "--rssi_floor",
+        type=int,
+        help="Drop reports weaker than this RSSI in dBm")
+    parser.add_argument(
+        "--discover_mode",
+        choices=DISCOVER_MODES.keys(),
+        help="Controller side filter: limited or generic discoverable devices, or all devices with observation")
+
+def filter_from_args(args):
+    """ Return a ScanFilter configured by options added by add_filter_arguments. """
+    config = {}
+    if args.filter_config:
+        with open(args.filter_config) as f:
+            config = json.load(f)
+    config['addresses'] = list(config.get('addresses', ())) + args.allow_address
+    config['service_uuids'] = list(config.get('service_uuids', ())) + args.service_uuid
+    config['company_ids'] = list(config.get('company_ids', ())) + args.company_id
+    if args.rssi_floor is not None:
+        config['rssi_floor'] = args.rssi_floor
+    if args.discover_mode is not None:
+        config['discover_mode'] = args.discover_mode
+    return ScanFilter.from_dict(config)
@@ -0,0 +1,153 @@
+"""
+Runtime tuning of the scanner and the publisher from the device shadow.
+
+The desired state may contain any of these properties:
+  scan_interval_ms, scan_window_ms  scan timing, 2.5ms to 40959ms, window <= interval
+  scan_mode                         "passive" or "active"
+  scan_phy                          "1m", "coded" or "1m_and_coded" for all radios, a list
+                                    of them in radio order, the last one applying to the
+                                    remaining radios, or a dict of radio ids to them
+  flush_period_s                    seconds between publishes
+  batch_size                        reports per MQTT message
+Scanner changes restart the scanner of every radio with the new parameters.
+The reported state always holds the values in effect, so a rejected change
+remains visible as a delta in the shadow. It also holds scanning, false if
+a radio could not be restarted after a failed change.
+"""
+
+import threading
+import traceback
+
+# Values of the scanning_phy parameter of scanner.start
+SCAN_PHYS = {'1m': 1, 'coded': 4, '1m_and_coded': 5}
+# Values of the mode parameter of scanner.set_parameters
+SCAN_MODES = {'passive': 0, 'active': 1}
+# Scan interval and window are set in units of 0.625ms
+SCAN_TIME_UNIT_MS = 0.625
+SCAN_TIME_MIN = 4
+SCAN_TIME_MAX = 65535
+
+SCANNER_PROPERTIES = ('scan_interval_ms', 'scan_window_ms', 'scan_mode', 'scan_phy')
+PUBLISH_PROPERTIES = ('flush_period_s', 'batch_size')
+
+def ms_to_scan_time(value):
+    """ Convert milliseconds to scan time units, raise ValueError if out of range. """
+    units = round(float(value) / SCAN_TIME_UNIT_MS)
+    if not SCAN_TIME_MIN <= units <= SCAN_TIME_MAX:
+        raise ValueError(f"{value}ms is outside of {SCAN_TIME_MIN * SCAN_TIME_UNIT_MS}"
+                         f"..{SCAN_TIME_MAX * SCAN_TIME_UNIT_MS}ms")
+    return units
+
+def scan_time_to_ms(units):
+    return units * SCAN_TIME_UNIT_MS
+
+def lookup_name(names, value):
+    """ Return the name of value in a names dict. """
+    for name, known in names.items():
+        if known == value:
+            return name
+    return value
+
+class ScanTuner:
+    """ Apply desired shadow properties to the Apps and the aws_pipe. """
+    def __init__(self, apps, publisher, command_timeout=5):
+        self.apps = apps
+        self.publisher = publisher
+        self.command_timeout = command_timeout
+        # Deltas arrive on one thread, but the lock keeps apply usable from anywhere
+        self.lock = threading.Lock()
+
+    def current(self):
+        """ Return the settings in effect as shadow properties. """
+        # All radios share the timing and mode, the PHY may differ per radio
+        app = self.apps[0]
+        phys = [lookup_name(SCAN_PHYS, app.scan_phy) for app in self.apps]
+        return {
+            'scan_interval_ms': scan_time_to_ms(app.scan_interval),
+            'scan_window_ms': scan_time_to_ms(app.scan_window),
+            'scan_mode': lookup_name(SCAN_MODES, app.scan_mode),
+            'scan_phy': phys[0] if len(set(phys)) == 1 else phys,
+            'flush_period_s': self.publisher.flush_period,
+            'batch_size': self.publisher.batch_size,
+            # False if a radio is not scanning, e.g. after a failed settings change
+            'scanning': all(app.scanning for app in self.apps),
+        }
+
+    def parse(self, desired):
+        """ Return the scanner and publisher keyword arguments of the valid desired properties. """
+        app = self.apps[0]
+        scan = {}
+        publish = {}
+        for key, value in desired.items():
+            if value is None:
+                # Property deleted from the desired state, keep the current value
+                continue
+            try:
+                if key == 'scan_interval_ms':
+                    scan['interval'] = ms_to_scan_time(value)
+                elif key == 'scan_window_ms':
+                    scan['window'] = ms_to_scan_time(value)
+                elif key == 'scan_mode':
+                    scan['mode'] = SCAN_MODES[value]
+                elif key == 'scan_phy':
+                    scan['phy'] = self.parse_phys(value)
+                elif key == 'flush_period_s':
+                    if float(value) <= 0:
+                        raise ValueError("must be positive")
+                    publish['flush_period'] = float(value)
+                elif key == 'batch_size':
+                    if int(value) < 1:
+                        raise ValueError("must be at least 1")
+                    publish['batch_size'] = int(value)
+                else:
+                    print(f"Ignoring unknown shadow property '{key}'")
+            except (KeyError, TypeError, ValueError) as err:
+                print(f"Ignoring invalid shadow property {key}={value!r}: {err}")
+        if scan.get('window', app.scan_window) > scan.get('interval', app.scan_interval):
+            print("Ignoring scan timing, the scan window is longer than the scan interval")
+            scan.pop('interval', None)
+            scan.pop('window', None)
+        return scan, publish
+
+    def parse_phys(self, value):
+        """ Return a dict of radio ids to scan_phy values of a scan_phy property. """
+        if isinstance(value, str):
+            return {app.radio_id: SCAN_PHYS[value] for app in self.apps}
+        if isinstance(value, list):
+            if not value:
+                raise ValueError("no PHY given")
+            # Same shape as reported by current() and as the --scan_phy option
+            return {app.radio_id: SCAN_PHYS[value[min(index, len(value) - 1)]]
+                    for index, app in enumerate(self.apps)}
+        if isinstance(value, dict):
+            # JSON object keys are strings
+            phys = {int(radio_id): SCAN_PHYS[name] for radio_id, name in value.items()}
+            unknown = phys.keys() - {app.radio_id for app in self.apps}
+            if unknown:
+                raise ValueError(f"unknown radios {sorted(unknown)}")
+            return phys
+        raise TypeError(f"expected a PHY name, list or object, not {type(value).__name__}")
+
+    def apply(self, desired):
+        """ Apply desired properties and return the reported state. """
+        with self.lock:
+            scan, publish = self.parse(desired)
+            if scan:
+                print(f"Applying scanner settings {scan}")
+                phys = scan.pop('phy', {})
+                for app in self.apps:
+                    settings = dict(scan)
+                    if app.radio_id in phys:
+                        settings['phy'] = phys[app.radio_id]
+                    if not settings:
+                        continue
+                    try:
+                        app.apply_scan_settings(timeout=self.command_timeout, **settings)
+                    except Exception:
+                        print(f"Failed to apply scanner settings to radio {app.radio_id}")
+                        traceback.print_exc()
+            if 'flush_period' in publish:
+                self.publisher.set_flush_period(publish['flush_period'])
+            if 'batch_size' in publish:
+                self.publisher.set_batch_size(publish['batch_size'])
+            return self.current()
@@ -0,0 +1,232 @@
+"""
+Multi-process decoding, aggregation and serialization of advertisement reports.
+
+The scanner thread only copies each report to a RawReport tuple and appends
+it to the buffer of a shard selected by the device address. Full buffers are
+queued for the sender thread of the shard, which writes them to a pipe read
+by the worker process owning the shard, which parses, aggregates and
+serializes the reports. The scanner thread never blocks on the pipe: if a
+worker falls behind, chunks beyond max_pending are dropped and counted, and
+a worker that died is restarted by the sender thread. The serialized reports come back
+through a result queue and are put to the aws_pipe queue by a collector
+thread. Reports of one device always go to the same worker, so their order
+is preserved.
+"""
+
+import collections
+import multiprocessing
+import threading
+import time
+import zlib
+
+from aggregator import ReportAggregator
+from reports import encode_report, serialize_report
+
+# Seconds before a dead worker is replaced, so that a worker failing on start doesn't spin
+RESTART_DELAY = 0.5
+# Messages to the workers besides lists of (timestamp, RawReport) tuples
+MSG_FLUSH = 'flush'
+MSG_STOP = 'stop'
+
+class _RecordList(list):
+    """ List usable as the out_queue of a ReportAggregator. """
+    put = list.append
+
+def _worker(conn, results, shard, thing_name, encoding, aggregate_window):
+    """ Main loop of a worker process. """
+    out = _RecordList()
+    def encode(raw, timestamp, aggregate=None):
+        return serialize_report(encode_report(
+            raw, raw.extended, timestamp, thing_name, raw.radio, encoding, aggregate))
+    aggregator = None
+    if aggregate_window > 0:
+        aggregator = ReportAggregator(out, encode, aggregate_window)
+    while True:
+        msg = None
+        if conn.poll(min(aggregate_window, 1.0) if aggregator is not None else None):
+            msg = conn.recv()
+        if msg == MSG_STOP or msg == MSG_FLUSH:
+            if aggregator is not None:
+                aggregator.flush(force=True)
+        elif msg is not None:
+            for timestamp, raw in msg:
+                if aggregator is not None:
+                    aggregator.add(raw, timestamp)
+                else:
+                    out.append(encode(raw, timestamp))
+        if aggregator is not None:
+            aggregator.flush()
+        if out:
+            results.put(list(out))
+            del out[:]
+        if msg == MSG_STOP or msg == MSG_FLUSH:
+            # Acknowledge that everything received so far has been returned
+            results.put(shard)
+        if msg == MSG_STOP:
+            return
+
+class _Shard:
+    """ Worker process of a shard, its report buffer and the thread sending chunks to it. """
+    def __init__(self, index, ctx, worker_args, max_pending):
+        self.index = index
+        self.ctx = ctx
+        self.worker_args = worker_args
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.buffer = []
+        # Chunks and control messages waiting for the sender thread
+        self.pending = collections.deque()
+        self.pending_chunks = 0
+        self.dropped = 0
+        self.restarts = 0
+        self.conn = None
+        self.process = None
+        self.start_worker()
+        self.sender = threading.Thread(target=self._send_loop, name=f"shard-{index}-sender", daemon=True)
+        self.sender.start()
+
+    def start_worker(self):
+        recv_conn, self.conn = self.ctx.Pipe(duplex=False)
+        self.process = self.ctx.Process(target=_worker, args=(recv_conn,) + self.worker_args, daemon=True)
+        self.process.start()
+        # Only the worker keeps the receiving end, so a send to a dead worker fails instead of blocking
+        recv_conn.close()
+
+    def queue_chunk(self):
+        """ Move the buffer to the sender, dropping it if the worker is too far behind. Lock held. """
+        if not self.buffer:
+            return
+        if self.pending_chunks >= self.max_pending:
+            self.dropped += len(self.buffer)
+        else:
+            self.pending.append(self.buffer)
+            self.pending_chunks += 1
+            self.cond.notify()
+        self.buffer = []
+
+    def queue_message(self, msg):
+        """ Queue a control message, never dropped. Lock held. """
+        self.pending.append(msg)
+        self.cond.notify()
+
+    def _send_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                item = self.pending.popleft()
+                if isinstance(item, list):
+                    self.pending_chunks -= 1
+            try:
+                self.conn.send(item)
+            except (BrokenPipeError, EOFError, OSError) as err:
+                self.process.join(RESTART_DELAY)
+                print(f"Shard {self.index} worker died (exit code {self.process.exitcode}): {err}, restarting")
+                with self.cond:
+                    if isinstance(item, list):
+                        self.dropped += len(item)
+                    else:
+                        # The new worker acknowledges the flush or stop waited for
+                        self.pending.appendleft(item)
+                self.conn.close()
+                self.restarts += 1
+                self.start_worker()
+                continue
+            if item == MSG_STOP:
+                return
+
+class ShardedPipeline:
+    """ Process pool doing the per report work of the scanner. """
+    def __init__(self, workers, out_queue, thing_name, encoding="json", aggregate_window=0,
+                 chunk_size=256, flush_timeout=5, max_pending=64):
+        self.out_queue = out_queue
+        self.chunk_size = chunk_size
+        self.flush_timeout = flush_timeout
+        # spawn instead of fork, the parent already runs the BGAPI and MQTT threads
+        ctx = multiprocessing.get_context('spawn')
+        self._results = ctx.Queue()
+        # max_pending chunks per shard wait for a slow worker, later ones are dropped
+        self._shards = [_Shard(shard, ctx, (self._results, shard, thing_name, encoding, aggregate_window),
+                               max_pending)
+                        for shard in range(workers)]
+        self._acks = threading.Semaphore(0)
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    @property
+    def dropped(self):
+        """ Reports dropped because a worker fell behind or died. """
+        return sum(shard.dropped for shard in self._shards)
+
+    @property
+    def restarts(self):
+        """ Number of worker processes restarted after they died. """
+        return sum(shard.restarts for shard in self._shards)
+
+    def register_metrics(self, registry):
+        """ Expose the drop and restart counters in a metrics.Registry. """
+        registry.counter("shard_dropped_total", "Reports dropped because a worker fell behind or died",
+            callback=lambda: self.dropped)
+        registry.counter("shard_restarts_total", "Worker processes restarted after they died",
+            callback=lambda: self.restarts)
+
+    def shard_of(self, address):
+        """ Stable shard index of a device address. """
+        return zlib.crc32(address.encode()) % len(self._shards)
+
+    def submit(self, raw, timestamp):
+        """ Queue a RawReport for its shard, called from the scanner threads. Never blocks on a worker. """
+        shard = self._shards[self.shard_of(raw.address)]
+        with shard.lock:
+            shard.buffer.append((timestamp, raw))
+            if len(shard.buffer) >= self.chunk_size:
+                shard.queue_chunk()
+
+    def flush(self, force=False):
+        """ Send partially filled buffers to the workers.
+
+        force also closes the aggregation windows and waits until the workers
+        have returned everything, like ReportAggregator.flush.
+        """
+        for shard in self._shards:
+            with shard.lock:
+                shard.queue_chunk()
+                if force:
+                    shard.queue_message(MSG_FLUSH)
+        if force:
+            deadline = time.monotonic() + self.flush_timeout
+            for _ in self._shards:
+                if not self._acks.acquire(timeout=max(0, deadline - time.monotonic())):
+                    print("Sharded pipeline flush timed out")
+                    break
+
+    def _collect(self):
+        """ Move serialized reports from the workers to the aws_pipe queue. """
+        while True:
+            try:
+                result = self._results.get()
+            except (EOFError, OSError):
+                return
+            if result is None:
+                return
+            if isinstance(result, int):
+                self._acks.release()
+                continue
+            for report in result:
+                self.out_queue.put(report)
+
+    def close(self):
+        """ Flush and stop the workers. """
+        for shard in self._shards:
+            with shard.lock:
+                shard.queue_chunk()
+                shard.queue_message(MSG_STOP)
+        for _ in self._shards:
+            if not self._acks.acquire(timeout=self.flush_timeout):
+                break
+        for shard in self._shards:
+            shard.sender.join(self.flush_timeout)
+            shard.process.join(self.flush_timeout)
+        self._results.put(None)
+        self._collector.join()
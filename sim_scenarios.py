@@ -0,0 +1,298 @@
+"""
+Simulated advertisers for load testing the report pipeline without radios.
+
+A Scenario describes a population of devices: how many, their advertising
+intervals, the mix of payloads and PDU types, how their RSSI wanders, how
+many of them come and go, and periodic bursts of faster advertising.
+AdvertiserSim turns a Scenario into a time ordered stream of RawReport
+tuples, the same type the scanner hands to the ShardedPipeline workers, so
+the stream can be fed to the raw report path as well as to encode_report.
+Everything random is drawn from one seeded random.Random, the same seed and
+scenario always produce the same reports in the same order.
+"""
+
+import heapq
+import json
+import random
+import time
+import uuid
+
+from reports import RawReport
+from report_codec import TX_POWER_UNAVAILABLE
+
+PAYLOAD_TYPES = ("ibeacon", "eddystone_uid", "eddystone_url", "name", "manufacturer")
+# Company IDs used for simulated manufacturer data, Apple is used by iBeacon
+COMPANY_APPLE = 0x004C
+COMPANY_IDS = (0x0006, 0x0075, 0x00E0, 0x02FF, 0x0131)
+EDDYSTONE_UUID = b'\xaa\xfe'
+URL_SCHEMES = (b'\x00', b'\x01', b'\x02', b'\x03')
+# Advertising data types
+AD_FLAGS = b'\x02\x01\x06'
+AD_FLAGS_NON_DISCOVERABLE = b'\x02\x01\x04'
+# event_flags of scanner reports
+EVENT_CONNECTABLE = 1
+EVENT_SCANNABLE = 2
+EVENT_SCAN_RESPONSE = 8
+LEGACY_CHANNELS = (37, 38, 39)
+
+def ad_structure(ad_type, value):
+    """ Return one length-type-value structure of advertising data. """
+    return bytes((len(value) + 1, ad_type)) + value
+
+def ibeacon_data(proximity_uuid, major, minor, measured_power=-59):
+    return AD_FLAGS_NON_DISCOVERABLE + ad_structure(0xFF,
+        COMPANY_APPLE.to_bytes(2, 'little') + b'\x02\x15' + proximity_uuid +
+        major.to_bytes(2, 'big') + minor.to_bytes(2, 'big') + measured_power.to_bytes(1, 'big', signed=True))
+
+def eddystone_uid_data(namespace, instance, tx_power=-20):
+    frame = b'\x00' + tx_power.to_bytes(1, 'big', signed=True) + namespace + instance + b'\x00\x00'
+    return AD_FLAGS + ad_structure(0x03, EDDYSTONE_UUID) + ad_structure(0x16, EDDYSTONE_UUID + frame)
+
+def eddystone_url_data(scheme, url, tx_power=-20):
+    frame = b'\x10' + tx_power.to_bytes(1, 'big', signed=True) + scheme + url
+    return AD_FLAGS + ad_structure(0x03, EDDYSTONE_UUID) + ad_structure(0x16, EDDYSTONE_UUID + frame)
+
+def name_data(name, uuid16=0x180F):
+    return AD_FLAGS + ad_structure(0x03, uuid16.to_bytes(2, 'little')) + ad_structure(0x09, name.encode('utf-8'))
+
+def manufacturer_data(company_id, payload, name=None):
+    data = AD_FLAGS + ad_structure(0xFF, company_id.to_bytes(2, 'little') + payload)
+    if name is not None:
+        data += ad_structure(0x09, name.encode('utf-8'))
+    return data
+
+class Scenario:
+    """ Parameters of a simulated device population.
+
+    devices             number of devices present at any time
+    interval_min/max    range of the advertising intervals in seconds, BLE adds 0-10ms of jitter
+    extended_ratio      fraction of devices using extended advertising PDUs
+    payload_mix         relative weights of the PAYLOAD_TYPES
+    rssi_min/max        range of the RSSI in dBm, each device starts at a random value in it
+    rssi_step           maximum RSSI change in dBm between two reports of a device
+    churn               fraction of the devices replaced by new ones per second
+    burst_every         seconds between the starts of two bursts, 0 disables bursts
+    burst_length        seconds a burst lasts
+    burst_factor        advertising intervals are divided by this during a burst
+    scan_responses      probability that a scannable device answers with a scan response
+    radios              number of simulated radios, reports are spread over them
+    """
+    def __init__(self, devices=100, interval_min=0.1, interval_max=1.0, extended_ratio=0.1,
+                 payload_mix=None, rssi_min=-95, rssi_max=-40, rssi_step=2, churn=0.0,
+                 burst_every=0, burst_length=1, burst_factor=10, scan_responses=0.0, radios=1,
+                 name_prefix="sim"):
+        if devices < 1:
+            raise ValueError("A scenario needs at least one device")
+        if not 0 < interval_min <= interval_max:
+            raise ValueError("Advertising intervals must be positive and interval_min <= interval_max")
+        if payload_mix is None:
+            payload_mix = {payload: 1 for payload in PAYLOAD_TYPES}
+        unknown = set(payload_mix) - set(PAYLOAD_TYPES)
+        if unknown:
+            raise ValueError(f"Unknown payload types {sorted(unknown)}, expected some of {PAYLOAD_TYPES}")
+        self.devices = devices
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.extended_ratio = extended_ratio
+        self.payload_mix = payload_mix
+        self.rssi_min = rssi_min
+        self.rssi_max = rssi_max
+        self.rssi_step = rssi_step
+        self.churn = churn
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.burst_factor = burst_factor
+        self.scan_responses = scan_responses
+        self.radios = radios
+        self.name_prefix = name_prefix
+
+    @property
+    def mean_rate(self):
+        """ Approximate reports per second outside of bursts. """
+        return self.devices / ((self.interval_min + self.interval_max) / 2 + 0.005)
+
+    @classmethod
+    def from_dict(cls, config):
+        """ Create a scenario from a dict with the keyword arguments of the constructor. """
+        return cls(**config)
+
+SCENARIOS = {
+    # The original single device of ble_scan_sim
+    "one_advertiser": dict(devices=1, interval_min=1, interval_max=1, extended_ratio=0,
+                           payload_mix={"name": 1}, rssi_min=-70, rssi_max=-50),
+    # Office floor, mostly phones, laptops and a few beacons
+    "office": dict(devices=200, interval_min=0.1, interval_max=1.0, extended_ratio=0.1,
+                   payload_mix={"name": 3, "manufacturer": 5, "ibeacon": 1, "eddystone_uid": 1},
+                   churn=0.001),
+    # Shop floor full of beacons and passing customers, ~10k reports/s
+    "retail": dict(devices=2000, interval_min=0.1, interval_max=0.3, extended_ratio=0.05,
+                   payload_mix={"ibeacon": 4, "eddystone_uid": 2, "eddystone_url": 1, "name": 1,
+                                "manufacturer": 4},
+                   churn=0.01, scan_responses=0.2),
+    # Crowd with rotating random addresses, ~50k reports/s
+    "stadium": dict(devices=10000, interval_min=0.1, interval_max=0.3, extended_ratio=0.2,
+                    payload_mix={"manufacturer": 8, "name": 1, "ibeacon": 1}, churn=0.05,
+                    rssi_min=-100, rssi_max=-60),
+    # Few devices switching to fast advertising every 10 s, e.g. on a button press
+    "burst": dict(devices=500, interval_min=0.5, interval_max=1.0, extended_ratio=0.1,
+                  burst_every=10, burst_length=2, burst_factor=25),
+}
+
+def load_scenario(name_or_path, **overrides):
+    """ Return a built-in scenario or one from a JSON file, with keyword arguments overriding it. """
+    if name_or_path in SCENARIOS:
+        config = dict(SCENARIOS[name_or_path])
+    else:
+        with open(name_or_path) as f:
+            config = json.load(f)
+    config.update((key, value) for key, value in overrides.items() if value is not None)
+    return Scenario.from_dict(config)
+
+class SimDevice:
+    """ State of one simulated advertiser. """
+    __slots__ = ('address', 'address_type', 'extended', 'interval', 'data', 'scan_response',
+                 'event_flags', 'rssi', 'tx_power', 'adv_sid', 'channel', 'radio')
+
+class AdvertiserSim:
+    """ Generate the reports of a Scenario, in virtual time starting at start. """
+    def __init__(self, scenario, seed=0, start=None):
+        self.scenario = scenario
+        self.rng = random.Random(seed)
+        self.start = time.time() if start is None else start
+        self.now = self.start
+        self.payload_types = list(scenario.payload_mix)
+        self.payload_weights = [scenario.payload_mix[payload] for payload in self.payload_types]
+        self.reports = 0
+        self.arrivals = 0
+        self.departures = 0
+        self._count = 0
+        self._heap = []
+        for _ in range(scenario.devices):
+            device = self.new_device()
+            # Spread the first advertisements over one interval
+            self._push(self.start + self.rng.random() * device.interval, device)
+
+    def _push(self, when, device):
+        self._count += 1
+        heapq.heappush(self._heap, (when, self._count, device))
+
+    def random_address(self, public):
+        """ Return a public address with a fixed OUI or a random static address. """
+        rng = self.rng
+        if public:
+            value = (0x000B57 << 24) | rng.getrandbits(24)
+        else:
+            value = rng.getrandbits(48) | (0xC0 << 40)
+        return ':'.join(f"{b:02x}" for b in value.to_bytes(6, 'big'))
+
+    def new_device(self):
+        """ Create a device with a random payload, address and advertising interval. """
+        rng = self.rng
+        scenario = self.scenario
+        self.arrivals += 1
+        device = SimDevice()
+        payload = rng.choices(self.payload_types, self.payload_weights)[0]
+        name = f"{scenario.name_prefix}-{self.arrivals:06d}"
+        device.scan_response = None
+        device.event_flags = 0
+        if payload == "ibeacon":
+            device.data = ibeacon_data(uuid.UUID(int=rng.getrandbits(128)).bytes,
+                rng.getrandbits(16), rng.getrandbits(16), rng.randint(-70, -50))
+        elif payload == "eddystone_uid":
+            device.data = eddystone_uid_data(rng.getrandbits(80).to_bytes(10, 'big'),
+                rng.getrandbits(48).to_bytes(6, 'big'), rng.randint(-30, 0))
+        elif payload == "eddystone_url":
+            device.data = eddystone_url_data(rng.choice(URL_SCHEMES), f"example{self.arrivals}.com".encode())
+        elif payload == "name":
+            device.data = name_data(name, rng.choice((0x180F, 0x180D, 0x1812, 0xFE9F)))
+            device.event_flags = EVENT_CONNECTABLE | EVENT_SCANNABLE
+        else:
+            device.event_flags = EVENT_CONNECTABLE | EVENT_SCANNABLE
+            device.data = manufacturer_data(rng.choice(COMPANY_IDS),
+                rng.getrandbits(8 * 20).to_bytes(20, 'big'))
+        device.extended = rng.random() < scenario.extended_ratio
+        if device.extended:
+            # Extended advertising is not scannable and carries longer payloads
+            device.event_flags &= EVENT_CONNECTABLE
+            if payload == "manufacturer":
+                device.data = manufacturer_data(rng.choice(COMPANY_IDS),
+                    rng.getrandbits(8 * 180).to_bytes(180, 'big'), name)
+            device.tx_power = rng.choice((TX_POWER_UNAVAILABLE, -20, -8, 0, 4, 8))
+            device.adv_sid = rng.randint(0, 15)
+        else:
+            device.tx_power = TX_POWER_UNAVAILABLE
+            device.adv_sid = None
+            if device.event_flags & EVENT_SCANNABLE and rng.random() < scenario.scan_responses:
+                device.scan_response = ad_structure(0x09, name.encode('utf-8'))
+        # Beacons mostly use public addresses, other devices rotate random ones
+        device.address_type = 0 if payload.startswith(("ibeacon", "eddystone")) and rng.random() < 0.5 else 1
+        device.address = self.random_address(device.address_type == 0)
+        device.interval = rng.uniform(scenario.interval_min, scenario.interval_max)
+        device.rssi = rng.uniform(scenario.rssi_min, scenario.rssi_max)
+        device.channel = rng.randrange(3)
+        device.radio = rng.randrange(scenario.radios)
+        return device
+
+    def next_interval(self, device, when):
+        """ Return the time to the next advertisement, including advDelay and bursts. """
+        interval = device.interval
+        scenario = self.scenario
+        if scenario.burst_every and (when - self.start) % scenario.burst_every < scenario.burst_length:
+            interval /= scenario.burst_factor
+        return interval + self.rng.random() * 0.01
+
+    def report(self, device):
+        """ Return the RawReport of one advertisement of device and advance its RSSI walk. """
+        scenario = self.scenario
+        rssi = device.rssi + (self.rng.random() * 2 - 1) * scenario.rssi_step
+        device.rssi = min(max(rssi, scenario.rssi_min), scenario.rssi_max)
+        if device.extended:
+            return RawReport(device.radio, True, device.event_flags, device.address, device.address_type,
+                round(device.rssi), self.rng.randrange(37), device.data, device.tx_power, device.adv_sid, 0)
+        device.channel = (device.channel + 1) % 3
+        return RawReport(device.radio, False, device.event_flags, device.address, device.address_type,
+            round(device.rssi), LEGACY_CHANNELS[device.channel], device.data, TX_POWER_UNAVAILABLE, None, 0)
+
+    def generate(self, until):
+        """ Yield (timestamp, RawReport) for all advertisements up to the time until. """
+        heap = self._heap
+        rng = self.rng
+        churn = self.scenario.churn
+        while heap[0][0] <= until:
+            when, _, device = heap[0]
+            report = self.report(device)
+            self.reports += 1
+            yield when, report
+            if device.scan_response is not None:
+                self.reports += 1
+                yield when, report._replace(event_flags=report.event_flags | EVENT_SCAN_RESPONSE,
+                    data=device.scan_response)
+            if churn and rng.random() < churn * device.interval:
+                # The device leaves and a new one shows up in its place
+                self.departures += 1
+                device = self.new_device()
+            self._count += 1
+            heapq.heapreplace(heap, (when + self.next_interval(device, when), self._count, device))
+        self.now = until
+
+    def run(self, sink, duration=None, speed=1.0, tick=0.01):
+        """ Call sink(raw, timestamp) for every report until duration seconds of virtual time passed.
+
+        speed 1 paces the reports in real time, a higher speed runs the virtual
+        clock faster and 0 generates as fast as possible. Returns the number of
+        reports.
+        """
+        end = None if duration is None else self.start + duration
+        reports = self.reports
+        wall_start = time.monotonic()
+        while end is None or self.now < end:
+            if speed > 0:
+                time.sleep(tick)
+                until = self.start + (time.monotonic() - wall_start) * speed
+            else:
+                until = self.now + tick
+            if end is not None:
+                until = min(until, end)
+            for timestamp, raw in self.generate(until):
+                sink(raw, timestamp)
+        return self.reports - reports
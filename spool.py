@@ -0,0 +1,81 @@
+"""
+Disk backed spool of MQTT payloads waiting for acknowledgement.
+"""
+
+import sqlite3
+import threading
+import time
+
+class Spool:
+    """ Append-only store of payloads kept in an SQLite database in WAL mode.
+
+    Payloads stay in the spool until they are acknowledged, so nothing is
+    lost across outages or restarts. The total payload size is capped at
+    max_bytes by discarding the oldest payloads.
+    """
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # A power loss may lose the last transactions, but never corrupts the database
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "created REAL NOT NULL, "
+            "count INTEGER NOT NULL, "
+            "payload BLOB NOT NULL)")
+        self.size_bytes, self.length = self._db.execute(
+            "SELECT COALESCE(SUM(LENGTH(payload)), 0), COUNT(*) FROM spool").fetchone()
+        self.dropped = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, payload, count=1):
+        """ Store a payload holding count reports. """
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO spool (created, count, payload) VALUES (?, ?, ?)",
+                (time.time(), count, payload))
+            self.size_bytes += len(payload)
+            self.length += 1
+            if self.size_bytes > self.max_bytes:
+                self._trim()
+
+    def _trim(self):
+        """ Discard the oldest payloads until the size cap is met. """
+        last_id = None
+        for row_id, size in self._db.execute("SELECT id, LENGTH(payload) FROM spool ORDER BY id"):
+            if self.size_bytes <= self.max_bytes:
+                break
+            self.size_bytes -= size
+            self.length -= 1
+            self.dropped += 1
+            last_id = row_id
+        if last_id is not None:
+            self._db.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+
+    def read(self, after_id=0, limit=10):
+        """ Return up to limit (id, count, payload) tuples with an id above after_id. """
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, count, payload FROM spool WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit)).fetchall()
+
+    def ack(self, row_id):
+        """ Remove an acknowledged payload. """
+        with self._lock:
+            row = self._db.execute("SELECT LENGTH(payload) FROM spool WHERE id = ?", (row_id,)).fetchone()
+            if row is None:
+                # Already discarded by the size cap
+                return
+            self._db.execute("DELETE FROM spool WHERE id = ?", (row_id,))
+            self.size_bytes -= row[0]
+            self.length -= 1
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -25,9 +25,12 @@ Application utility module
 # 3. This notice may not be removed or altered from any source distribution.
 
 import argparse
+import collections
+import concurrent.futures
 import itertools
 import logging
 import os.path
+import queue
 import socket
 import sys
 import threading
@@ -35,6 +38,8 @@ import traceback
 import bgapi
 from bgapi.connector import ConnectorException
 import serial.tools.list_ports
+from xapi_cache import load_apis
+from bgapi_capture import RecordingConnector, ReplayConnector, capture_path
 if sys.platform.startswith('linux'):
     import cpc_connector
 
@@ -42,19 +47,143 @@ LOG_FORMAT_SINGLE = "%(asctime)s: %(levelname)s - %(message)s"
 LOG_FORMAT = "%(asctime)s: %(name)s %(levelname)s - %(message)s"
 BT_XAPI = os.path.join(os.path.dirname(__file__), "sl_bt.xapi")
 BTMESH_XAPI = os.path.join(os.path.dirname(__file__), "sl_btmesh.xapi")
+# Waiting for an event is interruptible by KeyboardInterrupt on POSIX hosts, but not on Windows.
+# There a timeout is needed to recognize KeyboardInterrupt, stop() wakes up the wait on all hosts.
+EVENT_WAIT_TIMEOUT = 0.1 if sys.platform.startswith('win') else None
+
+def handles(*event_names):
+    """ Decorator to register a GenericApp method as handler of the given events. """
+    def decorator(func):
+        func._handles_events = getattr(func, "_handles_events", ()) + event_names
+        return func
+    return decorator
+
+class CommandPipeline:
+    """ Issue BGAPI commands without blocking the caller on each response.
+
+    Commands are executed in submission order by a single worker thread, so
+    responses are matched to commands the same way as for direct calls. The
+    caller queues a whole sequence of commands at once and collects the
+    responses later, e.g. while it keeps dispatching events.
+    """
+    def __init__(self, name="bgapi-commands"):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+
+    def submit(self, command, *args, **kwargs):
+        """ Queue a command, e.g. lib.bt.scanner.start, and return a Future of its response. """
+        return self._executor.submit(command, *args, **kwargs)
+
+    def submit_all(self, calls):
+        """ Queue (command, args) pairs and return the list of Futures. """
+        return [self.submit(command, *args) for command, args in calls]
+
+    def gather(self, futures, timeout=None):
+        """ Wait for the responses and return them in order.
+
+        The first failed command raises its exception, e.g. CommandFailedError.
+        """
+        done, not_done = concurrent.futures.wait(futures, timeout)
+        if not_done:
+            raise TimeoutError(f"{len(not_done)} BGAPI commands did not complete")
+        return [future.result() for future in futures]
+
+    def close(self):
+        """ Cancel queued commands and wait for the running one. """
+        self._executor.shutdown(wait=True, cancel_futures=True)
 
 class GenericApp(threading.Thread):
-    """ Generic application class. """
+    """ Generic application class.
+
+    Event handlers are looked up in a table built once per class, so dispatching an
+    event costs a single dict lookup. The table holds, in this order:
+      - _event_handler, only if a child class overrides it,
+      - methods registered with the handles decorator, base class handlers first,
+      - event_handler, only if a child class overrides it,
+      - methods named after the event, e.g. bt_evt_system_boot.
+    """
     _id = itertools.count(0)
+    # Queued by stop() to wake up the main loop
+    _WAKEUP = object()
+    # BGAPI classes used by the application per API, e.g. {"bt": ("system", "scanner")}.
+    # None or APIs not listed load all classes, see xapi_cache.TrimmedApi.
+    BGAPI_CLASSES = None
     def __init__(self, connector, apis):
         self.id = next(self._id)
-        self.lib = bgapi.BGLib(connector, apis)
+        # Events are delivered by the BGLib receiver thread to a queue owned by the application,
+        # so that stop() can wake up the main loop without polling.
+        self._events = queue.Queue()
+        # Parsed XAPI definitions are cached on disk and shared by all applications of the process
+        self.lib = bgapi.BGLib(connector, load_apis(apis, classes=self.BGAPI_CLASSES),
+            event_handler=self._events.put)
         self.log = logging.getLogger(f"{type(self).__name__}#{self.id}")
-        self.cpc = ('common.cpc_connector' in sys.modules) and \
-            isinstance(connector, cpc_connector.SerialConnectorCPC)
+        self.connector = connector
+        # Dispatched events by name, only counted once register_metrics has been called
+        self.event_counts = None
+        # A RecordingConnector keeps the recorded connector in wrapped
+        self.cpc = ('cpc_connector' in sys.modules) and \
+            isinstance(getattr(connector, 'wrapped', connector), cpc_connector.SerialConnectorCPC)
+        # Pipelined alternative to calling commands directly, see CommandPipeline
+        self.commands = CommandPipeline(f"{type(self).__name__}#{self.id}-commands")
+        if self.cpc:
+            # Recovery of the connector is reported as an event, handled in the application thread
+            connector.reset_listeners.append(self._events.put)
         self._run = False
         super().__init__()
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._build_dispatch_table()
+
+    @classmethod
+    def _build_dispatch_table(cls):
+        """ Map event names to handler functions. """
+        def override(name):
+            func = getattr(cls, name)
+            return () if func is getattr(GenericApp, name) else (func,)
+        internal = override("_event_handler")
+        public = override("event_handler")
+        registered = {}
+        seen = set()
+        for klass in reversed(cls.__mro__):
+            for name in vars(klass):
+                if name in seen:
+                    continue
+                seen.add(name)
+                func = getattr(cls, name, None)
+                for event_name in getattr(func, "_handles_events", ()):
+                    registered.setdefault(event_name, []).append(func)
+        # Dedicated event callbacks
+        dedicated = {name: getattr(cls, name) for name in dir(cls)
+                     if "_evt_" in name and callable(getattr(cls, name))}
+        cls._catch_all = internal + public
+        cls._dispatch = {}
+        for event_name in registered.keys() | dedicated.keys():
+            handlers = internal + tuple(registered.get(event_name, ())) + public
+            if event_name in dedicated:
+                handlers += (dedicated[event_name],)
+            cls._dispatch[event_name] = handlers
+
+    def dispatch(self, evt):
+        """ Call all handlers of an event. """
+        if self.event_counts is not None:
+            self.event_counts[evt._str] += 1
+        for func in self._dispatch.get(evt._str, self._catch_all):
+            func(self, evt)
+
+    def register_metrics(self, registry):
+        """ Count the dispatched events and expose them, and the CPC recoveries, in a metrics.Registry. """
+        self.event_counts = collections.Counter()
+        registry.counter("events_total", "BGAPI events dispatched by the application", ("app", "event"),
+            callback=lambda: {(self.id, name): count for name, count in dict(self.event_counts).items()})
+        if self.cpc:
+            # The supervisor is replaced when the connector is reopened, look it up on every collection
+            registry.counter("cpc_resets_total", "Recoveries of the CPC endpoint", ("app",),
+                callback=lambda: {(self.id,): self.connector.supervisor.resets})
+            registry.counter("cpc_failed_attempts_total", "Failed attempts to reopen the CPC endpoint", ("app",),
+                callback=lambda: {(self.id,): self.connector.supervisor.failed_attempts})
+            registry.counter("cpc_downtime_seconds_total", "Time the CPC endpoint was down", ("app",),
+                callback=lambda: {(self.id,): self.connector.supervisor.total_downtime})
+
     def event_handler(self, evt):
         """ Public event handler to perform user actions. Meant to be overridden by child classes. """
 
@@ -78,21 +207,9 @@ class GenericApp(threading.Thread):
         # Enter main program loop.
         while self._run:
             try:
-                # The timeout is needed to get the KeyboardInterrupt.
-                # On Windows hosts, timeout is needed in both threaded and non-threaded modes.
-                # On POSIX hosts, timeout is needed only in threaded mode.
-                # The timeout value is a tradeoff between CPU load and KeyboardInterrupt response time.
-                # timeout=None: minimal CPU usage, KeyboardInterrupt not recognized until the next event.
-                # timeout=0: maximal CPU usage, KeyboardInterrupt recognized immediately.
-                # See the documentation of Queue.get method for details.
-                evt = self.lib.get_event(timeout=0.1)
+                evt = self.wait_event()
                 if evt is not None:
-                    self._event_handler(evt)
-                    self.event_handler(evt)
-                    # Call dedicated event callback if available.
-                    event_callback = getattr(self, evt._str, None)
-                    if event_callback is not None:
-                        event_callback(evt)
+                    self.dispatch(evt)
             except bgapi.bglib.CommandFailedError as err:
                 # Get additional info from trace.
                 trace = traceback.extract_tb(sys.exc_info()[-1])[-3]
@@ -106,16 +223,36 @@ class GenericApp(threading.Thread):
                 self._run = False
 
         self.log.info("Close device")
+        self.commands.close()
         self.lib.close()
         sys.exit(exit_code)
 
+    def wait_event(self, timeout=None):
+        """ Block until an event arrives or stop() is called, return None on wakeup or timeout. """
+        if timeout is None:
+            timeout = EVENT_WAIT_TIMEOUT
+        try:
+            evt = self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if evt is self._WAKEUP:
+            return None
+        return evt
+
+    def pending_events(self):
+        """ Return the number of received events that have not been dispatched yet. """
+        return self._events.qsize()
+
     def stop(self):
         """ Terminate main execution loop. """
         self._run = False
+        self._events.put(self._WAKEUP)
 
     def reset(self):
         """ Reset device, meant to be overridden by child classes. """
 
+GenericApp._build_dispatch_table()
+
 class BluetoothApp(GenericApp):
     """ Application class for Bluetooth devices. """
     def __init__(self, connector, apis=BT_XAPI):
@@ -123,19 +260,26 @@ class BluetoothApp(GenericApp):
         self.address_type = None
         super().__init__(connector=connector, apis=apis)
 
-    def _event_handler(self, evt):
-        """ Internal Bluetooth event handler. """
-        if evt == "bt_evt_system_boot":
-            # Check Bluetooth stack version
-            version = "{major}.{minor}.{patch}".format(**vars(evt))
-            self.log.info("Bluetooth stack booted: v%s-b%s", version, evt.build)
-            if version != self.lib.bt.__version__:
-                self.log.warning("BGAPI version mismatch: %s (target) != %s (host)", version, self.lib.bt.__version__)
-            # Get Bluetooth address
-            _, self.address, self.address_type = self.lib.bt.system.get_identity_address()
-            self.log.info("Bluetooth %s address: %s",
-                "static random" if self.address_type else "public device",
-                self.address)
+    @handles("bt_evt_system_boot")
+    def _on_system_boot(self, evt):
+        """ Internal Bluetooth boot event handler. """
+        # Check Bluetooth stack version
+        version = "{major}.{minor}.{patch}".format(**vars(evt))
+        self.log.info("Bluetooth stack booted: v%s-b%s", version, evt.build)
+        if version != self.lib.bt.__version__:
+            self.log.warning("BGAPI version mismatch: %s (target) != %s (host)", version, self.lib.bt.__version__)
+        # Get Bluetooth address
+        _, self.address, self.address_type = self.lib.bt.system.get_identity_address()
+        self.log.info("Bluetooth %s address: %s",
+            "static random" if self.address_type else "public device",
+            self.address)
+
+    @handles("cpc_evt_endpoint_reset")
+    def _on_cpc_reset(self, evt):
+        """ Bring the device back to a well defined state after the CPC endpoint was reopened. """
+        self.log.warning("CPC endpoint recovered after %.3f s, resetting device", evt.downtime)
+        # The boot event of the reset restarts the application, e.g. scanning
+        self.reset()
 
     def reset(self):
         """ Reset Bluetooth device. """
@@ -149,16 +293,16 @@ class BtMeshApp(GenericApp):
     def __init__(self, connector, apis=[BT_XAPI, BTMESH_XAPI]):
         super().__init__(connector=connector, apis=apis)
 
-    def _event_handler(self, evt):
-        """ Internal Bluetooth event handler. """
-        if evt == "bt_evt_system_boot":
-            # Check Bluetooth stack version
-            version = "{major}.{minor}.{patch}".format(**vars(evt))
-            self.log.info("Bluetooth stack booted: v%s-b%s", version, evt.build)
-            if version != self.lib.bt.__version__:
-                self.log.warning("BGAPI version mismatch: %s (target) != %s (host)", version, self.lib.bt.__version__)
-            # Initialize Bluetooth Mesh device
-            self.lib.btmesh.node.init()
+    @handles("bt_evt_system_boot")
+    def _on_system_boot(self, evt):
+        """ Internal Bluetooth mesh boot event handler. """
+        # Check Bluetooth stack version
+        version = "{major}.{minor}.{patch}".format(**vars(evt))
+        self.log.info("Bluetooth stack booted: v%s-b%s", version, evt.build)
+        if version != self.lib.bt.__version__:
+            self.log.warning("BGAPI version mismatch: %s (target) != %s (host)", version, self.lib.bt.__version__)
+        # Initialize Bluetooth Mesh device
+        self.lib.btmesh.node.init()
 
     def reset(self):
         """ Reset for Bluetooth mesh device """
@@ -172,7 +316,7 @@ class ArgumentParser(argparse.ArgumentParser):
     """ Custom argument parser for GenericApp and its derivatives """
     def __init__(self, *args, single_mode=True, epilog=None, formatter_class=CustomHelpFormatter, **kwargs):
         self.single_mode = single_mode
-        self.cpc_options = 'common.cpc_connector' in sys.modules
+        self.cpc_options = 'cpc_connector' in sys.modules
         if self.single_mode:
             nargs = "?"
             cpc_const = []
@@ -223,6 +367,24 @@ class ArgumentParser(argparse.ArgumentParser):
                 "--cpc_tracing",
                 help="Enable CPC tracing",
                 action="store_true")
+            self.add_argument(
+                "--cpc_tx_window",
+                type=int,
+                help="CPC transmit window size, falls back to 1 if the library rejects it",
+                default=1)
+        self.add_argument(
+            "--record",
+            help="Capture the traffic of the connections to this file, numbered per connection,"
+                 " gzip compressed if it ends in .gz")
+        self.add_argument(
+            "--replay",
+            nargs=None if single_mode else "+",
+            help="Play back capture files instead of opening connections")
+        self.add_argument(
+            "--replay_speed",
+            type=float,
+            help="Replay speed as a multiple of the recorded pace, 0 replays as fast as possible",
+            default=1.0)
         self.add_argument(
             "-l", "--log",
             type=str.upper,
@@ -242,6 +404,15 @@ class ArgumentParser(argparse.ArgumentParser):
             log_format = LOG_FORMAT
         logging.basicConfig(level=args.log, format=log_format)
         # Check connection parameters
+        if args.replay:
+            if args.conn or (self.cpc_options and args.cpc is not None):
+                self.print_usage()
+                print(f"{self.prog}: error: --replay can't be combined with connections")
+                sys.exit(-1)
+            if args.single_mode:
+                args.replay = [args.replay]
+            args.cpc = None
+            return args
         if not self.cpc_options:
             # cpc attribute is always granted
             args.cpc = None
@@ -289,7 +460,8 @@ def get_connector(args=None):
                 cpc_conn = cpc_connector.SerialConnectorCPC(
                     lib_path=args.cpc_lib_path,
                     cpc_instance=cpc,
-                    tracing=args.cpc_tracing)
+                    tracing=args.cpc_tracing,
+                    tx_window_size=args.cpc_tx_window)
             except ConnectorException as err:
                 logging.error("%s", err)
                 logging.error("Is CPC daemon instance '%s' running?", cpc)
@@ -297,6 +469,11 @@ def get_connector(args=None):
             connector.append(cpc_conn)
     if args.conn:
         connector += [connector_from_str(conn) for conn in args.conn]
+    if args.replay:
+        connector = [ReplayConnector(path, args.replay_speed, apis=[BT_XAPI]) for path in args.replay]
+    elif args.record:
+        connector = [RecordingConnector(conn, capture_path(args.record, index, len(connector)))
+                     for index, conn in enumerate(connector)]
     if args.single_mode:
         return connector[0]
     return connector
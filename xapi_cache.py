@@ -0,0 +1,125 @@
+"""
+Cached loading of BGAPI XAPI definitions.
+
+Parsing sl_bt.xapi is the slowest part of creating a BGLib instance. The
+parsed API is pickled to a __pycache__ directory next to the XAPI file, keyed
+on the hash of the file and the pybgapi version, and kept in memory so that
+all Apps of a process share one instance.
+
+An application may declare the BGAPI classes it uses. BGLib then creates
+the commands of those classes only, and the definitions of other classes
+are loaded when one of their events arrives.
+"""
+
+import hashlib
+import importlib.metadata
+import logging
+import os
+import pickle
+import threading
+
+from bgapi.apiparser import ParsedApi
+
+log = logging.getLogger(__name__)
+
+_memo = {}
+_memo_lock = threading.Lock()
+
+def parser_version():
+    """ Return the installed pybgapi version, the pickles contain its classes. """
+    try:
+        return importlib.metadata.version("pybgapi")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+def file_hash(path):
+    """ Return the SHA-256 hex digest of a file and the parser version. """
+    digest = hashlib.sha256(parser_version().encode())
+    with open(path, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+def cache_path(path, digest):
+    """ Return the pickle path of an XAPI file with the given hash. """
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(os.path.dirname(os.path.abspath(path)), "__pycache__",
+        f"{name}.{digest[:16]}.pickle")
+
+class TrimmedApi(ParsedApi):
+    """ ParsedApi limited to some classes, the others are looked up in the full API on demand. """
+    def __init__(self, api, class_names, path, use_cache=True):
+        # The parsing constructor of ParsedApi is bypassed, the attributes are copied
+        self.filename = api.filename
+        self.description = api.description
+        self.types = api.types
+        self.device_id = api.device_id
+        self.device_name = api.device_name
+        self.name = api.name
+        self.version = api.version
+        self.names = [name for name in api.names if name in class_names]
+        for name in self.names:
+            api_class = api[name]
+            # Drop the reference to the full API, so that it can be freed
+            api_class.api = self
+            self[name] = api_class
+            self[api_class.index] = api_class
+        self._path = path
+        self._use_cache = use_cache
+
+    def __missing__(self, key):
+        """ Resolve an undeclared class, e.g. for the Deserializer on an unexpected event. """
+        api_class = load_api(self._path, use_cache=self._use_cache)[key]
+        log.debug("Loaded undeclared BGAPI class %s", api_class.name)
+        self[api_class.name] = api_class
+        self[api_class.index] = api_class
+        return api_class
+
+def load_api(path, use_cache=True, classes=None):
+    """ Return the ParsedApi of an XAPI file, from memory, the pickle cache or the XML.
+
+    classes optionally maps device names, e.g. "bt", to the names of the
+    classes to include, see TrimmedApi.
+    """
+    digest = file_hash(path)
+    key = (os.path.abspath(path), digest)
+    if classes:
+        key += (frozenset((name, frozenset(names)) for name, names in classes.items()),)
+    with _memo_lock:
+        api = _memo.get(key)
+        if api is None:
+            api = _load(path, digest, use_cache)
+            if classes and api.device_name in classes:
+                # Only the trimmed API is kept in memory
+                api = TrimmedApi(api, classes[api.device_name], path, use_cache)
+            _memo[key] = api
+    return api
+
+def load_apis(apis, use_cache=True, classes=None):
+    """ Resolve a path, ParsedApi or a list of them as accepted by BGLib. """
+    if not isinstance(apis, (list, tuple)):
+        apis = [apis]
+    return [load_api(api, use_cache, classes) if isinstance(api, str) else api for api in apis]
+
+def _load(path, digest, use_cache):
+    pickle_path = cache_path(path, digest)
+    if use_cache:
+        try:
+            with open(pickle_path, "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            # Stale format, e.g. written by another pybgapi version
+            log.warning("Ignoring XAPI cache %s: %s", pickle_path, err)
+    api = ParsedApi(path)
+    if use_cache:
+        try:
+            os.makedirs(os.path.dirname(pickle_path), exist_ok=True)
+            # Write and rename, so a concurrent start never reads a partial file
+            tmp_path = f"{pickle_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(api, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, pickle_path)
+        except OSError as err:
+            log.warning("Can't write XAPI cache %s: %s", pickle_path, err)
+    return api